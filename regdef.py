@@ -1,17 +1,95 @@
 #!/usr/bin/env python3
 
 import io
+import os
 import re
 import sys
 import copy
 import json
+import filecmp
+import tempfile
 import math
+import hashlib
+import mmap
+import stat
+import array
+import struct
+import time
+import heapq
+import contextlib
+import collections
+import collections.abc
+import asyncio
+import weakref
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only used to speed up batch conversions
+    np = None
+
+
+def _word_typecode(word_n):
+    """array.array typecode of unsigned word_n-bit words."""
+    for typecode in 'BHILQ':
+        if array.array(typecode).itemsize * 8 == word_n:
+            return typecode
+    raise ValueError('No array type for %d-bit words' % word_n)
+
+
+def _pos_min(pos):
+    """Lowest bit of field position (int or (high, low) tuple)."""
+    return min(pos) if isinstance(pos, tuple) else pos
+
+
+def _pos_max(pos):
+    """Highest bit of field position (int or (high, low) tuple)."""
+    return max(pos) if isinstance(pos, tuple) else pos
+
+
+class RegisterLayout:
+    """
+    Field layout of a register: names, lengths and positions of fields with precomputed
+    shifts and masks. Layouts are interned (see intern()), so registers with the same
+    fields share a single layout object and its tuples.
+    """
+    __slots__ = ('names', 'lengths', 'positions', 'shifts', 'masks', '__weakref__')
+
+    # layouts are kept only as long as some register uses them
+    _interned = weakref.WeakValueDictionary()
+
+    def __init__(self, names, lengths, positions):
+        self.names = names
+        self.lengths = lengths
+        self.positions = positions
+        shifts = []
+        next_pos = 0
+        for n in lengths:
+            shifts.append(next_pos)
+            next_pos += n
+        self.shifts = tuple(shifts)
+        self.masks = tuple((1 << n) - 1 for n in lengths)
+
+    @classmethod
+    def intern(cls, names, lengths, positions):
+        """The layout object for given names, lengths and positions (tuples or None)."""
+        key = (names, lengths, positions)
+        layout = cls._interned.get(key)
+        if layout is None:
+            layout = cls._interned[key] = cls(names, lengths, positions)
+        return layout
 
 
 class Register:
     """
     Simple class for visualisation of register field values.
+
+    Field layout is kept in tuples (fields start from LSB), with precomputed
+    shifts and masks (not shifted) used by the integer field accessors.
+    The tuples belong to RegisterLayout shared by all registers with the same fields.
     """
+    __slots__ = ('name', 'value', 'layout', 'names', 'lengths', 'positions', 'shifts', 'masks')
+
     def __init__(self, group_names, group_lengths, positions=None, name='NONE', value=0):
         """Basic constructor, it is more convenient to use from_xxx() classmethods."""
         # check if groups are consistent
@@ -26,9 +104,19 @@ class Register:
         # save values
         self.name = name
         self.value = value
-        self.names = group_names
-        self.lengths = group_lengths
-        self.positions = positions
+        # field accessors are precomputed in the (shared) layout
+        layout = RegisterLayout.intern(tuple(group_names), tuple(group_lengths),
+                                       tuple(positions) if positions is not None else None)
+        self.layout = layout
+        self.names = layout.names
+        self.lengths = layout.lengths
+        self.positions = layout.positions
+        self.shifts = layout.shifts
+        self.masks = layout.masks
+
+    def __reduce__(self):
+        # layout is interned again when unpickled (e.g. in worker processes)
+        return self.__class__, (self.names, self.lengths, self.positions, self.name, self.value)
 
     @classmethod
     def from_value(cls, value, group_names=None, group_lengths=None, **kwargs):
@@ -60,6 +148,66 @@ class Register:
         Reserved:31:17 COUNTFLAG:@1 Reserved:@13 CLKSOURCE:2 TICKINT:1 ENABLE:0
         Bits 31 to 17  One bit      13 bits      Bit 2       Bit 1     Bit 0
         """
+        names, lengths, positions = cls.field_positions(fields_specs)
+
+        # test if everything is consistent, i.e. all increasing or all decreasing
+        # flatten the position data
+        positions_flat = []
+        for pos in positions:
+            if isinstance(pos, tuple):
+                positions_flat.append(max(pos))
+                positions_flat.append(min(pos))
+            else:
+                positions_flat.append(pos)
+        descreasing = all(earlier > later for earlier, later in zip(positions_flat, positions_flat[1:]))
+
+        # if it was not decreasing than check if it is increasing
+        if not descreasing:
+            positions_flat = []
+            for pos in positions:
+                if isinstance(pos, tuple):
+                    positions_flat.append(min(pos))
+                    positions_flat.append(max(pos))
+                else:
+                    positions_flat.append(pos)
+            increasing = all(earlier < later for earlier, later in zip(positions_flat, positions_flat[1:]))
+
+            assert increasing, 'Positions list was neither increasing nor descreasing: %s' % positions
+
+        # ok, now fill in the missing holes in positions with reserved areas
+        assert len(names) == len(lengths) == len(positions), 'Yyy...something is not yes...'
+        new_names = []
+        new_lengths = []
+        new_positions = []
+        prev_max = -1
+        for i in range(len(positions)):
+            if _pos_min(positions[i]) - (prev_max + 1) > 0:
+                new_names.append('_')
+                new_lengths.append(_pos_min(positions[i]) - (prev_max + 1))
+                if new_lengths[-1] == 1:
+                    new_positions.append(prev_max + 1)
+                else:
+                    new_positions.append((prev_max + 1, _pos_min(positions[i]) - 1))
+            new_names.append(names[i])
+            new_lengths.append(lengths[i])
+            new_positions.append(positions[i])
+            prev_max = _pos_max(positions[i])
+
+        names = new_names
+        lengths = new_lengths
+        positions = new_positions
+
+        # create register object
+        return cls(names, lengths, positions=positions, **kwargs)
+
+    @staticmethod
+    def field_positions(fields_specs):
+        """
+        Parse fields specs (see from_specs()) into (names, lengths, positions) of fields
+        in the increasing order, with positions of fields given as NAME:@NUM_BITS filled in,
+        but without checking that the positions are consistent and without reserved
+        fields for the holes between fields.
+        """
         names = []
         lengths = []
         positions = []
@@ -95,25 +243,13 @@ class Register:
             #  print('Assuming increasing order (from 0) because only %d positions were given' % n_positions)
             positions_given = (0, 1)
         else:
-            positions_given = list(filter(None, positions))
-
-        # for min/max on either int or a tuple
-        def min_any(arg):
-            if isinstance(arg, tuple):
-                return min(arg)
-            else:
-                return arg
-        def max_any(arg):
-            if isinstance(arg, tuple):
-                return max(arg)
-            else:
-                return arg
+            positions_given = [pos for pos in positions if pos is not None]
 
         # assume order
         p1, p2 = positions_given[:2]
         # simplify if tuples
-        p1 = min_any(p1)
-        p2 = min_any(p2)
+        p1 = _pos_min(p1)
+        p2 = _pos_min(p2)
         assert p1 != p2, 'Could not assume order, positions: %s' % positions
         assuming_decreasing = p1 > p2
 
@@ -141,61 +277,12 @@ class Register:
                 positions[0] = (0, lengths[0] - 1)
         for i in range(0, len(positions)):
             if positions[i] is None:
-                prev = max_any(positions[i - 1])
+                prev = _pos_max(positions[i - 1])
                 if lengths[i] == 1:
                     positions[i] = prev + 1
                 else:
                     positions[i] = (prev + 1, prev + 1 + lengths[i] - 1)
-
-        # test if everything is consistent, i.e. all increasing or all decreasing
-        # flatten the position data
-        positions_flat = []
-        for pos in positions:
-            if isinstance(pos, tuple):
-                positions_flat.append(max(pos))
-                positions_flat.append(min(pos))
-            else:
-                positions_flat.append(pos)
-        descreasing = all(earlier > later for earlier, later in zip(positions_flat, positions_flat[1:]))
-
-        # if it was not decreasing than check if it is increasing
-        if not descreasing:
-            positions_flat = []
-            for pos in positions:
-                if isinstance(pos, tuple):
-                    positions_flat.append(min(pos))
-                    positions_flat.append(max(pos))
-                else:
-                    positions_flat.append(pos)
-            increasing = all(earlier < later for earlier, later in zip(positions_flat, positions_flat[1:]))
-
-            assert increasing, 'Positions list was neither increasing nor descreasing: %s' % positions
-
-        # ok, now fill in the missing holes in positions with reserved areas
-        assert len(names) == len(lengths) == len(positions), 'Yyy...something is not yes...'
-        new_names = []
-        new_lengths = []
-        new_positions = []
-        prev_max = -1
-        for i in range(len(positions)):
-            if min_any(positions[i]) - (prev_max + 1) > 0:
-                new_names.append('_')
-                new_lengths.append(min_any(positions[i]) - (prev_max + 1))
-                if new_lengths[-1] == 1:
-                    new_positions.append(prev_max + 1)
-                else:
-                    new_positions.append((prev_max + 1, min_any(positions[i]) - 1))
-            new_names.append(names[i])
-            new_lengths.append(lengths[i])
-            new_positions.append(positions[i])
-            prev_max = max_any(positions[i])
-
-        names = new_names
-        lengths = new_lengths
-        positions = new_positions
-
-        # create register object
-        return cls(names, lengths, positions=positions, **kwargs)
+        return names, lengths, positions
 
     def set(self, value):
         self.value = value
@@ -204,15 +291,42 @@ class Register:
     def n_bits(self):
         return sum(self.lengths)
 
+    def field_index(self, name):
+        """Index of the first field with given name."""
+        try:
+            return self.names.index(name)
+        except ValueError:
+            raise KeyError('No field %s in register %s' % (name, self.name)) from None
+
+    def get_field(self, name):
+        i = self.field_index(name)
+        return (self.value >> self.shifts[i]) & self.masks[i]
+
+    def set_field(self, name, value):
+        i = self.field_index(name)
+        mask = self.masks[i]
+        assert 0 <= value <= mask, 'value %d does not fit in %d-bit field %s' \
+            % (value, self.lengths[i], name)
+        shift = self.shifts[i]
+        self.value = (self.value & ~(mask << shift)) | (value << shift)
+
+    def fields(self, reserved_regex=None):
+        """
+        List of (name, value) for all fields (starting from LSB).
+        If reserved_regex is given then fields matching it are skipped.
+        """
+        value = self.value
+        return [(name, (value >> shift) & mask)
+                for name, shift, mask in zip(self.names, self.shifts, self.masks)
+                if reserved_regex is None or not re.match(reserved_regex, name)]
+
     @property
     def bin(self):
-        return '0b{bits:0>{n_bits}}'.format(
-            bits=bin(self.value)[2:], n_bits=self.n_bits)
+        return '0b{:0{n_bits}b}'.format(self.value, n_bits=self.n_bits)
 
     @property
     def hex(self):
-        return '0x{chars:0>{n_chars}}'.format(
-            chars=hex(self.value)[2:], n_chars=self.n_bits//8)
+        return '0x{:0{n_chars}x}'.format(self.value, n_chars=(self.n_bits + 3) // 4)
 
     def pprint(self):
         print(self.repr_long())
@@ -221,37 +335,93 @@ class Register:
         return 'Register(%d-bit, %s: %s)' % (self.n_bits, self.name, self.hex)
 
     def repr_long(self):
-        ostream = io.StringIO()
-        print('Register(%d-bit, %s):' % (self.n_bits, self.name), file=ostream)
+        lines = ['Register(%d-bit, %s):' % (self.n_bits, self.name)]
         name_len = max([len(n) for n in self.names])
-        #  bits = bin(self.value)[2:]
-        i = 0
-        for i in range(len(self.names)):
-            group_name, group_len = self.names[i], self.lengths[i]
-            group_value = self.bin[2:][i:i+group_len]
-            if self.positions is None:
-                endpos = self.n_bits-i-1
-                startpos = endpos-group_len+1
+        fmt = '  {pos:>5} {nbits:>3} │ {name:{name_len}}: {value:0{n}b}'
+        for i, (group_name, value) in enumerate(self.fields()):
+            group_len = self.lengths[i]
+            pos = self.positions[i] if self.positions is not None else None
+            if pos is None:
+                startpos, endpos = self.shifts[i], self.shifts[i] + group_len - 1
+            elif isinstance(pos, tuple):
+                startpos, endpos = pos
             else:
-                pos = self.positions[i]
-                if isinstance(pos, tuple):
-                    startpos, endpos = pos
-                else:
-                    startpos, endpos = pos, pos
+                startpos, endpos = pos, pos
             pos_str = '%d:%d' % (startpos, endpos)
-            fmt = '  {pos:>5} {nbits:>3} │ {name:{name_len}}: {values}'
-            text = fmt.format(name=group_name, name_len=name_len,
-                              values=group_value, pos=pos_str,
-                              nbits='#%d' % group_len)
-            print(text, file=ostream)
-            i += group_len
-        text = ostream.getvalue()
-        ostream.close()
-        return text
+            lines.append(fmt.format(name=group_name, name_len=name_len, value=value,
+                                    n=group_len, pos=pos_str, nbits='#%d' % group_len))
+        return '\n'.join(lines) + '\n'
 
     def __repr__(self):
         return self.repr_short()
 
+    def field_layout(self, reserved_regex='reserved|RESERVED|_'):
+        """
+        List of (name, shift, mask) for all non-reserved fields, with the same
+        bit positions as used by ccode() (mask is not shifted).
+        """
+        return [(name, shift, mask)
+                for name, shift, mask in zip(self.names, self.shifts, self.masks)
+                if not re.match(reserved_regex, name)]
+
+    def decode_many(self, raws, reserved_regex='reserved|RESERVED|_'):
+        """
+        Decode many raw register values at once.
+
+        raws - sequence of raw values: numpy array, array.array (e.g. array('I')) or a list
+        reserved_regex - fields matching it are skipped, same as in ccode()
+
+        Returns dict {field_name: column} where each field is extracted the same way
+        as FROM_RAW/from_raw() in the generated code: ((raw) & (MASK << POS)) >> POS.
+        Columns are numpy arrays if numpy is available, else array.array('Q')
+        (or lists for registers wider than 64 bits).
+        """
+        layout = self.field_layout(reserved_regex)
+        if np is not None and self.n_bits <= 64:
+            raws = np.asarray(raws, dtype=np.uint64)
+            return {name: (raws >> np.uint64(shift)) & np.uint64(mask)
+                    for name, shift, mask in layout}
+        column = (lambda values: array.array('Q', values)) if self.n_bits <= 64 else list
+        return {name: column((raw >> shift) & mask for raw in raws)
+                for name, shift, mask in layout}
+
+    def encode_many(self, columns, reserved_regex='reserved|RESERVED|_'):
+        """
+        Pack many registers from field columns, the reverse of decode_many().
+
+        columns - dict {field_name: column}, all columns have to be of the same length,
+                  missing fields are treated as 0 (as with designated initializers)
+
+        Raises ValueError for unknown fields or columns of different lengths.
+
+        Field values are truncated to field width (as bitfields in the generated
+        code are) and combined like RAW/raw(): (field << POS) | ...
+        Returns numpy array of uint64 if numpy is available, else array.array('Q')
+        (or list for registers wider than 64 bits).
+        """
+        layout = {name: (shift, mask) for name, shift, mask in self.field_layout(reserved_regex)}
+        unknown = set(columns.keys()) - set(layout.keys())
+        if unknown:
+            raise ValueError('Unknown fields for register %s: %s' % (self.name, sorted(unknown)))
+        lengths = set(len(col) for col in columns.values())
+        if len(lengths) > 1:
+            raise ValueError('Columns have different lengths: %s' % sorted(lengths))
+        n_values = lengths.pop() if lengths else 0
+
+        if np is not None and self.n_bits <= 64:
+            raws = np.zeros(n_values, dtype=np.uint64)
+            for name, col in columns.items():
+                shift, mask = layout[name]
+                col = np.asarray(col, dtype=np.uint64)
+                raws |= (col & np.uint64(mask)) << np.uint64(shift)
+            return raws
+
+        raws = [0] * n_values
+        for name, col in columns.items():
+            shift, mask = layout[name]
+            raws = [raw | ((value & mask) << shift) for raw, value in zip(raws, col)]
+        return array.array('Q', raws) if self.n_bits <= 64 else raws
+
     def get_reg_n(self):
         n = sum(self.lengths)
         valid_int_lengths = [8, 16, 32, 64]
@@ -264,6 +434,65 @@ class Register:
             'Could not find an integer size that would hold %d bits' % n
         return reg_n
 
+    def n_words(self, word_n=32):
+        """Number of word_n-bit words needed to hold the register."""
+        return (self.n_bits + word_n - 1) // word_n
+
+    def field_pieces(self, i, word_n=32, field_word_n=None):
+        """
+        Split field i at word boundaries, list of (word, word_shift, field_word, field_shift, n):
+        n bits at word_shift of register word `word` are bits at field_shift of `field_word`
+        of the field value. If field_word_n is given the field value is split into words
+        too (as arrays in the generated code), else field_word is always 0.
+        """
+        start, length = self.shifts[i], self.lengths[i]
+        pieces = []
+        bit = 0
+        while bit < length:
+            word, word_shift = divmod(start + bit, word_n)
+            field_word, field_shift = divmod(bit, field_word_n) if field_word_n else (0, bit)
+            n = min(word_n - word_shift, length - bit)
+            if field_word_n:
+                n = min(n, field_word_n - field_shift)
+            pieces.append((word, word_shift, field_word, field_shift, n))
+            bit += n
+        return pieces
+
+    def to_words(self, word_n=32):
+        """Register value as array of word_n-bit words (least significant word first)."""
+        mask = (1 << word_n) - 1
+        return array.array(_word_typecode(word_n),
+                           ((self.value >> (i * word_n)) & mask for i in range(self.n_words(word_n))))
+
+    def set_words(self, words, word_n=32):
+        """Set register value from word_n-bit words (least significant word first)."""
+        self.value = sum(word << (i * word_n) for i, word in enumerate(words))
+
+    def get_field_words(self, words, name, word_n=32):
+        """
+        Read field from raw register words (as from to_words()) without converting
+        the whole register, only the words that the field uses are read.
+        """
+        value = 0
+        for word, word_shift, _, field_shift, n in self.field_pieces(self.field_index(name), word_n):
+            value |= ((words[word] >> word_shift) & ((1 << n) - 1)) << field_shift
+        return value
+
+    def set_field_words(self, words, name, value, word_n=32):
+        """Write field to raw register words in place, only the words that the field uses are modified."""
+        i = self.field_index(name)
+        assert 0 <= value <= self.masks[i], 'value %d does not fit in %d-bit field %s' \
+            % (value, self.lengths[i], name)
+        for word, word_shift, _, field_shift, n in self.field_pieces(i, word_n):
+            mask = ((1 << n) - 1) << word_shift
+            words[word] = (words[word] & ~mask) | (((value >> field_shift) << word_shift) & mask)
+
+    def _word_layout(self, word_n, reserved_regex):
+        """List of (name, length, pieces) of non-reserved fields for multi-word code."""
+        return [(name, length, self.field_pieces(i, word_n, word_n if length > 64 else None))
+                for i, (name, length) in enumerate(zip(self.names, self.lengths))
+                if not re.match(reserved_regex, name)]
+
     def code_masks(self, address, prefix='',
                    reg_t=None, reg_n=None, address_t='uint8_t',
                    reserved_regex='reserved|RESERVED|_', cpp=True):
@@ -273,7 +502,9 @@ class Register:
         reg_t - if present defines the type of variable used for register (no checks
                 of variable size) higher priority than reg_n
         reg_n - if present defines the number of bits in integer used for register value
-                else the value is taken automatically as the lowest that is enough
+                else the value is taken automatically as the lowest that is enough;
+                registers wider than that (or than 64 bits) use arrays of reg_n-bit
+                (default 32-bit) words
         address_t - type of variable that holds `address`
         prefix - added before union name
         reserved_regex - regex which, if matches on field name, makes the filed be treated
@@ -286,8 +517,9 @@ class Register:
         n = sum(self.lengths)
         if reg_t is None:
             if reg_n is None:
-                reg_n = self.get_reg_n()
-            assert reg_n >= n, 'Cannot hold %d bits in %d-bit integer' % (n, reg_n)
+                reg_n = self.get_reg_n() if n <= 64 else 32
+            if n > reg_n:
+                return self._code_masks_words(address, prefix, reg_n, address_t, reserved_regex, cpp)
             reg_t = 'uint{n}_t'.format(n=reg_n)
 
         reg_name = self.name.upper()
@@ -312,12 +544,7 @@ class Register:
         ]
 
         # generate fields definitions
-        next_pos = 0
-        # reverse to stat from the ones for bit 0
-        #  for n, name in zip(reversed(self.lengths), reversed(self.names)):
-        for n, name in zip(self.lengths, self.names):
-            pos = next_pos
-            next_pos = pos + n
+        for n, name, pos in zip(self.lengths, self.names, self.shifts):
             # ignore reserved fields
             if re.match(reserved_regex, name):
                 continue
@@ -333,27 +560,31 @@ class Register:
     ###  e.g. https://stackoverflow.com/questions/6043483/why-bit-endianness-is-an-issue-in-bitfields
     def ccode(self, address,
               reg_t=None, reg_n=None, address_t='uint8_t', prefix='',
-              reserved_regex='reserved|RESERVED|_', cpp=False):
+              reserved_regex='reserved|RESERVED|_', cpp=False, helpers=False):
         """
         Generate C/C++ code for register definition
 
         reg_t - if present defines the type of variable used for register (no checks
                 of variable size) higher priority than reg_n
         reg_n - if present defines the number of bits in integer used for register value
-                else the value is taken automatically as the lowest that is enough
+                else the value is taken automatically as the lowest that is enough;
+                registers wider than that (or than 64 bits) use arrays of reg_n-bit
+                (default 32-bit) words
         address_t - type of variable that holds `address`
         prefix - added before union name
         reserved_regex - regex which, if matches on field name, makes the filed be treated
                          as reserved field - it is given no name
         cpp - whether to generate type definitions for C++ or for C
+        helpers - whether to add helpers modifying single fields in raw values, see _field_helpers()
         """
 
         # find int size, variable length must be one of theses from stdint.h
         n = sum(self.lengths)
         if reg_t is None:
             if reg_n is None:
-                reg_n = self.get_reg_n()
-            assert reg_n >= n, 'Cannot hold %d bits in %d-bit integer' % (n, reg_n)
+                reg_n = self.get_reg_n() if n <= 64 else 32
+            if n > reg_n:
+                return self._ccode_words(address, reg_n, address_t, prefix, reserved_regex, cpp)
             reg_t = 'uint{n}_t'.format(n=reg_n)
 
         if cpp:
@@ -362,7 +593,7 @@ struct {name} {{
     static constexpr {addr_t} address{addr_arr} = {addr};
     static constexpr size_t n_bits = {n};
 {accessor}
-{initialiser}
+{initialiser}{helpers}
 {struct}
 }};
             """.strip()
@@ -385,7 +616,7 @@ static {name} from_raw({reg_t} raw) {{
 {addr}
 #define {name}_N_BITS    ({n})
 {accessor}
-{initialiser}
+{initialiser}{helpers}
 typedef struct {name} {{
 {struct}
 }} {name};
@@ -407,10 +638,7 @@ typedef struct {name} {{
         lines = []
         field_masks = []
         init_fields = []
-        next_pos = 0
-        for n, name in zip(self.lengths, self.names):  # reverse to stat from the ones for bit 0
-            pos = next_pos
-            next_pos = pos + n
+        for n, name, pos in zip(self.lengths, self.names, self.shifts):
             # remove names from reserved fields
             reserved = re.match(reserved_regex, name)
             lines.append(1 * 4 * ' ' + struct_templ.format(reg_t=reg_t, name=name if not reserved else '', n=n))
@@ -466,11 +694,901 @@ typedef struct {name} {{
             struct=struct_code,
             accessor=accessor if len(field_masks) > 0 else '',
             initialiser=initialiser if len(field_masks) > 0 else '',
+            helpers=''.join('\n' + line for line in self._field_helpers(reg_name, reg_t, reserved_regex, cpp))
+            if helpers else '',
         )
 
-def parse_regdef_json(file_name, comments=True, **ccode_kwargs):
+    def _field_helpers(self, reg_name, reg_t, reserved_regex, cpp, base=None):
+        """
+        Lines of code of helpers modifying single fields directly in raw register value
+        (without conversion to struct and back). For each field there is a mask, bits()
+        (field value moved to its position), get(), update() (returns new raw value) and
+        set() (modifies raw value in place); update_raw(raw, mask, bits) writes many fields
+        at once. If `base` is given, C helpers are defined using the ones of register `base`
+        (C++ structs of aliases derive them).
+        Raises ValueError if C++ helpers would have the same name as a field or a member.
+        """
+        fields = [(name, shift, mask << shift) for name, shift, mask in zip(self.names, self.shifts, self.masks)
+                  if not re.match(reserved_regex, name)]
+        if not fields:
+            return []
+        suffix = 'ULL' if self.n_bits > 32 else 'U'
+        if cpp:
+            members = ['address', 'n_bits', 'raw', 'from_raw'] + [name for name, _, _ in fields]
+            helper_names = ['update_raw'] + ['%s_%s' % (kind, name) for name, _, _ in fields
+                                             for kind in ['mask', 'bits', 'get', 'update', 'set']]
+            colliding = set(members) & set(helper_names)
+            if colliding:
+                raise ValueError('Fields of register %s have the same names as generated helpers: %s'
+                                 % (self.name, ', '.join(sorted(colliding))))
+            lines = ['']
+            for name, shift, mask in fields:
+                lines.extend([
+                    '    static constexpr {t} mask_{f} = 0x{mask:x}{s};',
+                    '    static constexpr {t} bits_{f}({t} value) {{ return ({t}) ((value << {shift}U) & mask_{f}); }}',
+                    '    static constexpr {t} get_{f}({t} raw) {{ return ({t}) ((raw & mask_{f}) >> {shift}U); }}',
+                    '    static constexpr {t} update_{f}({t} raw, {t} value) {{ return update_raw(raw, mask_{f}, bits_{f}(value)); }}',
+                    '    static inline void set_{f}({t} &raw, {t} value) {{ raw = update_{f}(raw, value); }}',
+                ])
+                lines[-5:] = [line.format(t=reg_t, f=name, shift=shift, mask=mask, s=suffix) for line in lines[-5:]]
+            lines.append('    static constexpr {t} update_raw({t} raw, {t} mask, {t} bits) {{ return ({t}) ((raw & ~mask) | bits); }}'
+                         .format(t=reg_t))
+            lines.append('')
+            return lines
+
+        if base is not None:
+            lines = []
+            for name, shift, mask in fields:
+                lines.extend([
+                    '#define {r}_{F}_FMASK   {b}_{F}_FMASK',
+                    '#define {r}_{F}_BITS(value)   {b}_{F}_BITS(value)',
+                    '#define {r}_{F}_GET(raw)   {b}_{F}_GET(raw)',
+                    '#define {r}_{F}_UPDATE(raw, value)   {b}_{F}_UPDATE(raw, value)',
+                    '#define {r}_{F}_SET(raw, value)   {b}_{F}_SET(raw, value)',
+                ])
+                lines[-5:] = [line.format(r=reg_name, b=base, F=name.upper()) for line in lines[-5:]]
+            lines.append('#define {r}_UPDATE(raw, mask, bits)   {b}_UPDATE(raw, mask, bits)'.format(r=reg_name, b=base))
+            return lines
+
+        lines = []
+        for name, shift, mask in fields:
+            lines.extend([
+                '#define {r}_{F}_FMASK   (({t}) 0x{mask:x}{s})',
+                '#define {r}_{F}_BITS(value)   (({t}) ((({t}) (value) << {shift}U) & {r}_{F}_FMASK))',
+                '#define {r}_{F}_GET(raw)   (({t}) (((raw) & {r}_{F}_FMASK) >> {shift}U))',
+                '#define {r}_{F}_UPDATE(raw, value)   {r}_UPDATE(raw, {r}_{F}_FMASK, {r}_{F}_BITS(value))',
+                '#define {r}_{F}_SET(raw, value)   ((raw) = {r}_{F}_UPDATE(raw, value))',
+            ])
+            lines[-5:] = [line.format(r=reg_name, F=name.upper(), t=reg_t, shift=shift, mask=mask, s=suffix)
+                          for line in lines[-5:]]
+        lines.append('#define {r}_UPDATE(raw, mask, bits)   (({t}) (((raw) & ({t}) ~({t}) (mask)) | (bits)))'
+                     .format(r=reg_name, t=reg_t))
+        return lines
+
+    def ccode_alias(self, address, base, reg_t=None, reg_n=None, address_t='uint8_t', prefix='',
+                    reserved_regex='reserved|RESERVED|_', cpp=False, helpers=False):
+        """
+        Generate C/C++ code for a register with the same layout as register `base`
+        generated before with ccode() with the same arguments: the struct and conversions
+        of `base` are reused and only the address constants are defined.
+        C: typedef and RAW/FROM_RAW macros using the ones of `base`,
+        C++: struct derived from `base` with own address and from_raw() returning it.
+        """
+        n = self.n_bits
+        words = False
+        if reg_t is None:
+            if reg_n is None:
+                reg_n = self.get_reg_n() if n <= 64 else 32
+            words = n > reg_n
+            reg_t = 'uint{n}_t'.format(n=reg_n)
+        has_fields = any(not re.match(reserved_regex, name) for name in self.names)
+        reg_name = prefix + self.name
+        base_name = prefix + base
+
+        if cpp:
+            if isinstance(address, list):
+                addr_arr = '[%d]' % len(address)
+                addr = '{%s}' % ', '.join('%s' % a for a in address)
+            else:
+                addr_arr, addr = '', address
+            lines = [
+                'struct %s : %s {' % (reg_name, base_name),
+                '    static constexpr %s address%s = %s;' % (address_t, addr_arr, addr),
+            ]
+            if has_fields:
+                raw_t = 'const %s *' % reg_t if words else '%s ' % reg_t
+                lines.extend([
+                    '',
+                    '    static %s from_raw(%sraw) {' % (reg_name, raw_t),
+                    '        return {%s::from_raw(raw)};' % base_name,
+                    '    }',
+                ])
+            lines.append('};')
+            return '\n'.join(lines)
+
+        if isinstance(address, list):
+            lines = ['#define %s_ADDRESS_%d   (%s)' % (reg_name, i, a) for i, a in enumerate(address)]
+        else:
+            lines = ['#define %s_ADDRESS   (%s)' % (reg_name, address)]
+        lines.append('#define %s_N_BITS    (%d)' % (reg_name, n))
+        if words:
+            lines.append('#define %s_N_WORDS   (%d)' % (reg_name, self.n_words(reg_n)))
+        if has_fields:
+            if words:
+                lines.extend('#define %s_RAW_%d(reg)   %s_RAW_%d(reg)' % (reg_name, i, base_name, i)
+                             for i in range(self.n_words(reg_n)))
+                lines.append('#define %s_RAW(reg, raw)   %s_RAW(reg, raw)' % (reg_name, base_name))
+            else:
+                lines.append('#define %s_RAW(reg)   %s_RAW(reg)' % (reg_name, base_name))
+            lines.append('#define %s_FROM_RAW(raw) %s_FROM_RAW(raw)' % (reg_name, base_name))
+        if helpers and not words:
+            lines.extend(self._field_helpers(reg_name, reg_t, reserved_regex, cpp, base=base_name))
+        lines.append('typedef %s %s;' % (base_name, reg_name))
+        return '\n'.join(lines)
+
+    def _ccode_words(self, address, word_n, address_t, prefix, reserved_regex, cpp):
+        """
+        ccode() for registers wider than a word: raw value is an array of word_n-bit
+        words (least significant first), each conversion touches only the words that
+        the field uses. Reserved fields are not included in the struct and fields
+        wider than 64 bits are arrays of words.
+        """
+        assert word_n in [8, 16, 32, 64], 'Word size must be 8, 16, 32 or 64 bits, got %d' % word_n
+        word_t = 'uint%d_t' % word_n
+        u = 'ULL' if word_n == 64 else 'U'
+        reg_name = prefix + self.name
+        n_words = self.n_words(word_n)
+        layout = self._word_layout(word_n, reserved_regex)
+        reg = '' if cpp else 'reg.'
+
+        struct = []
+        words = [[] for _ in range(n_words)]
+        inits = []
+        for name, length, pieces in layout:
+            if length > 64:
+                n_field_words = (length + word_n - 1) // word_n
+                struct.append('    %s %s[%d];' % (word_t, name, n_field_words))
+                field_words = [[] for _ in range(n_field_words)]
+            else:
+                field_t = word_t if length <= word_n else 'uint64_t'
+                struct.append('    %s %s:%d;' % (field_t, name, length))
+                field_words = [[]]
+            for word, word_shift, field_word, field_shift, n in pieces:
+                field = '%s%s%s' % (reg, name, '[%d]' % field_word if length > 64 else '')
+                # register word from field bits
+                value = field if field_shift == 0 else '(%s >> %dU)' % (field, field_shift)
+                if n < length and n < word_n:
+                    value = '(%s & %#x%s)' % (value, (1 << n) - 1, u)
+                words[word].append('((%s) %s << %dU)' % (word_t, value, word_shift))
+                # field bits from register word
+                value = ('raw[%d]' if cpp else '(raw)[%d]') % word
+                if word_shift:
+                    value = '(%s >> %dU)' % (value, word_shift)
+                if n < word_n:
+                    value = '(%s & %#x%s)' % (value, (1 << n) - 1, u)
+                if length > 64 or length <= word_n:
+                    field_words[field_word].append('(%s << %dU)' % (value, field_shift))
+                else:
+                    field_words[field_word].append('((%s) %s << %dU)' % (field_t, value, field_shift))
+            # casts avoid narrowing errors in C++ for words smaller than int
+            if length > 64:
+                inits.append('.%s = {%s}' % (name, ', '.join(
+                    '(%s) (%s)' % (word_t, ' | '.join(w)) for w in field_words)))
+            else:
+                inits.append('.%s = (%s) (%s)' % (name, field_t, ' | '.join(field_words[0])))
+        words = [' | '.join(w) if w else '0' for w in words]
+
+        if not isinstance(address, list):
+            addr_arr = ''
+            addr = address if cpp else '#define %s_ADDRESS   (%s)' % (reg_name, address)
+        elif cpp:
+            addr_arr = '[%d]' % len(address)
+            addr = '{%s}' % ', '.join('%s' % a for a in address)
+        else:
+            addr_arr = ''
+            addr = '\n'.join('#define %s_ADDRESS_%d   (%s)' % (reg_name, i, a) for i, a in enumerate(address))
+
+        if cpp:
+            lines = [
+                'struct %s {' % reg_name,
+                '    static constexpr %s address%s = %s;' % (address_t, addr_arr, addr),
+                '    static constexpr size_t n_bits = %d;' % self.n_bits,
+                '    static constexpr size_t n_words = %d;' % n_words,
+            ]
+            if layout:
+                lines.append('')
+                for i, word in enumerate(words):
+                    lines.extend([
+                        '    inline %s raw_%d() {' % (word_t, i),
+                        '        return %s;' % word,
+                        '    }',
+                    ])
+                lines.append('    inline void raw(%s *words) {' % word_t)
+                lines.extend('        words[%d] = raw_%d();' % (i, i) for i in range(n_words))
+                lines.append('    }')
+                lines.append('')
+                lines.append('    static %s from_raw(const %s *raw) {' % (reg_name, word_t))
+                lines.append('        return {')
+                lines.append(',\n'.join('            %s' % init for init in inits))
+                lines.append('        };')
+                lines.append('    }')
+                lines.append('')
+            lines.extend(struct)
+            lines.append('};')
+        else:
+            lines = [
+                addr,
+                '#define %s_N_BITS    (%d)' % (reg_name, self.n_bits),
+                '#define %s_N_WORDS   (%d)' % (reg_name, n_words),
+            ]
+            if layout:
+                lines.extend('#define %s_RAW_%d(reg)   (%s)' % (reg_name, i, word) for i, word in enumerate(words))
+                lines.append('#define %s_RAW(reg, raw)   do { %s } while (0)' % (reg_name, ' '.join(
+                    '(raw)[%d] = %s_RAW_%d(reg);' % (i, reg_name, i) for i in range(n_words))))
+                lines.append('#define %s_FROM_RAW(raw) ((%s) { %s })' % (reg_name, reg_name, ', '.join(inits)))
+            lines.append('typedef struct %s {' % reg_name)
+            lines.extend(struct)
+            lines.append('} %s;' % reg_name)
+        return '\n'.join(lines)
+
+    def _code_masks_words(self, address, prefix, word_n, address_t, reserved_regex, cpp):
+        """
+        code_masks() for registers wider than a word: for each field its absolute
+        position (_POS), index of its first word (_WORD), position in that word
+        (_WORD_POS) and mask in that word (_MASK), and for fields crossing word
+        boundaries masks in the following words (_MASK_1 for word _WORD + 1, ...).
+        """
+        assert word_n in [8, 16, 32, 64], 'Word size must be 8, 16, 32 or 64 bits, got %d' % word_n
+        word_t = 'uint%d_t' % word_n
+        u = 'ULL' if word_n == 64 else 'U'
+        reg_name = self.name.upper()
+
+        if cpp:
+            address_templ = 'constexpr {addr_t} {name}_ADDRESS = {addr}U;'
+            size_templ = 'constexpr size_t {name}_{what} = {n}U;'
+            mask_templ = 'constexpr {word_t} {name}_{what} = 0b{bits}{u}{shift};'
+        else:
+            address_templ = '#define {name}_ADDRESS  (({addr_t}) ({addr}U))'
+            size_templ = '#define {name}_{what}   ({n}U)'
+            mask_templ = '#define {name}_{what}   (0b{bits}{u}{shift})'
+
+        lines = [
+            address_templ.format(name=prefix + reg_name, addr_t=address_t, addr=address),
+            size_templ.format(name=prefix + reg_name, what='NBITS', n=self.n_bits),
+            size_templ.format(name=prefix + reg_name, what='NWORDS', n=self.n_words(word_n)),
+        ]
+        for i, name in enumerate(self.names):
+            if re.match(reserved_regex, name):
+                continue
+            field = '%s_%s' % (reg_name, name.upper())
+            pieces = self.field_pieces(i, word_n)
+            first_word, word_pos = pieces[0][:2]
+            lines.append(size_templ.format(name=field, what='POS', n=self.shifts[i]))
+            lines.append(size_templ.format(name=field, what='WORD', n=first_word))
+            lines.append(size_templ.format(name=field, what='WORD_POS', n=word_pos))
+            for word, word_shift, _, _, n in pieces:
+                k = word - first_word
+                lines.append(mask_templ.format(
+                    name=field, what='MASK' if k == 0 else 'MASK_%d' % k, word_t=word_t,
+                    bits='1' * n, u=u, shift=' << %s_WORD_POS' % field if k == 0 else ''))
+        return '\n'.join(lines)
+
+
+class CodeCache:
+    """
+    Persistent (JSON file) cache of parsed registers and their generated code.
+
+    Entries are keyed by a hash of register name, specs, address and code generation
+    kwargs, so only registers that changed have to be parsed and generated again.
+    The whole cache is invalidated when regdef.py itself changes.
+    Only entries used since loading are saved, so stale ones are dropped.
+    """
+    VERSION = 1
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.generator = self.generator_hash()
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(file_name):
+            with open(file_name) as fp:
+                try:
+                    data = json.load(fp)
+                except ValueError:
+                    data = {}
+            if data.get('version') == self.VERSION and data.get('generator') == self.generator:
+                self.entries = data.get('entries', {})
+
+    @staticmethod
+    def generator_hash():
+        with open(os.path.abspath(__file__), 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+
+    @staticmethod
+    def key(name, specs, address, kwargs):
+        data = json.dumps([name, specs, address, kwargs], sort_keys=True)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns (Register, code) or None if there is no such entry."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used[key] = entry
+        positions = [tuple(pos) if isinstance(pos, list) else pos for pos in entry['positions']]
+        reg = Register(entry['names'], entry['lengths'], positions=positions, name=entry['name'])
+        return reg, entry['code']
+
+    def put(self, key, reg, code):
+        self.used[key] = self.entries[key] = {
+            'name': reg.name,
+            'names': reg.names,
+            'lengths': reg.lengths,
+            'positions': reg.positions,
+            'code': code,
+        }
+
+    def save(self):
+        data = {'version': self.VERSION, 'generator': self.generator, 'entries': self.used}
+        return write_if_changed(self.file_name, json.dumps(data, sort_keys=True))
+
+
+class Timings:
+    """
+    Wall time and number of calls of code generation phases (reading JSON, cache lookups,
+    Register.from_specs(), ccode(), writing output, ...) and the slowest registers.
+
+    Pass an instance as timings= to iter_regdef_json()/parse_regdef_json() and print
+    report() afterwards. Only n_slowest registers are kept, so memory use is bounded.
+    """
+
+    def __init__(self, n_slowest=10):
+        self.phases = {}  # name -> [seconds, calls]
+        self.n_slowest = n_slowest
+        self.slowest = []  # min-heap of (seconds, register name)
+
+    def phase(self, name):
+        """Context manager adding its wall time to given phase."""
+        return _TimingsPhase(self, name)
+
+    def add(self, name, seconds, calls=1):
+        phase = self.phases.setdefault(name, [0.0, 0])
+        phase[0] += seconds
+        phase[1] += calls
+
+    def add_register(self, name, seconds):
+        if len(self.slowest) < self.n_slowest:
+            heapq.heappush(self.slowest, (seconds, name))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, name))
+
+    def iter(self, name, iterable):
+        """Wrap an iterable adding time of each step to given phase."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def merge(self, other):
+        for name, (seconds, calls) in other.phases.items():
+            self.add(name, seconds, calls)
+        for seconds, name in other.slowest:
+            self.add_register(name, seconds)
+
+    def report(self):
+        lines = ['{:<12} {:>10} {:>12} {:>14}'.format('phase', 'calls', 'total [ms]', 'per call [us]')]
+        for name, (seconds, calls) in sorted(self.phases.items(), key=lambda p: -p[1][0]):
+            lines.append('{:<12} {:>10} {:>12.3f} {:>14.3f}'.format(
+                name, calls, seconds * 1e3, seconds * 1e6 / calls if calls else 0))
+        if self.slowest:
+            lines.append('')
+            lines.append('slowest registers [us]:')
+            name_len = max(len(name) for seconds, name in self.slowest)
+            for seconds, name in sorted(self.slowest, reverse=True):
+                lines.append('  {:<{}} {:>10.3f}'.format(name, name_len, seconds * 1e6))
+        return '\n'.join(lines)
+
+
+class _TimingsPhase:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+
+
+_NO_PHASE = contextlib.nullcontext()
+
+
+def _no_phase(name):
+    return _NO_PHASE
+
+
+def write_if_changed(file_name, text):
+    """
+    Write text to a file only if its contents would change, so that file
+    modification time is preserved otherwise. Returns True if file has been written.
+    """
+    if os.path.exists(file_name):
+        with open(file_name) as fp:
+            if fp.read() == text:
+                return False
+    with open(file_name, 'w') as fp:
+        fp.write(text)
+    return True
+
+
+def write_chunks_if_changed(file_name, chunks, timings=None):
+    """
+    Streaming variant of write_if_changed(), chunks of text are written to a temporary
+    file as they come and it replaces file_name only if the contents differ.
+    timings - optional Timings, time of writing is added to 'write' phase
+    """
+    timed = timings.phase if timings is not None else _no_phase
+    dir_name = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_name = tempfile.mkstemp(dir=dir_name, prefix='.%s.' % os.path.basename(file_name))
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            for chunk in chunks:
+                with timed('write'):
+                    fp.write(chunk)
+        with timed('compare'):
+            same = os.path.exists(file_name) and filecmp.cmp(tmp_name, file_name, shallow=False)
+        if same:
+            return False
+        if os.path.exists(file_name):
+            os.chmod(tmp_name, os.stat(file_name).st_mode)
+        else:
+            os.chmod(tmp_name, 0o666 & ~_umask())
+        os.replace(tmp_name, file_name)
+        return True
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def iter_json_object(fp, chunk_size=2**16):
+    """
+    Generator of (key, value) pairs of the top-level JSON object read from a file
+    in chunks, so that the whole file is never in memory at once (only single values).
+    Unlike json.load() duplicate keys are all yielded.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        data = fp.read(chunk_size)
+        eof = not data
+        buf = buf[pos:] + data
+        pos = 0
+
+    def next_char():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                raise ValueError('Unexpected end of JSON file')
+            read_more()
+
+    def expect(chars):
+        nonlocal pos
+        char = next_char()
+        if char not in chars:
+            raise ValueError('Expected one of "%s" in JSON file but got "%s"' % (chars, char))
+        pos += 1
+        return char
+
+    def decode():
+        nonlocal pos
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # values like numbers could have been cut at the end of buffer
+                if end < len(buf) or eof:
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+
+    expect('{')
+    if next_char() == '}':
+        return
+    while True:
+        next_char()
+        key = decode()
+        expect(':')
+        next_char()
+        value = decode()
+        yield key, value
+        if expect(',}') == '}':
+            return
+
+
+def iter_json_chunks(items):
+    """
+    Inverse of iter_json_object(), generator of chunks of text of a JSON object with given
+    (key, value) pairs formatted as regdef JSON (comments preceded by an empty line),
+    so that big objects can be written without being in memory at once.
+    """
+    yield '{\n'
+    sep = '\n'
+    for key, value in items:
+        if sep != '\n' and key.strip().startswith('//'):
+            sep += '\n'
+        yield '%s    %s: %s' % (sep, json.dumps(key), json.dumps(value, indent=4).replace('\n', '\n    '))
+        sep = ',\n'
+    yield '\n}\n'
+
+
+def iter_regdef_items(file_name):
+    """
+    Generator of (name, definition) pairs of a register description file, either regdef JSON
+    or CMSIS-SVD (files ending with .svd, see iter_svd()), comments have names starting with //.
+    """
+    if file_name.lower().endswith('.svd'):
+        yield from iter_svd(file_name)
+    else:
+        with open(file_name) as fp:
+            yield from iter_json_object(fp)
+
+
+def iter_registers(file_name):
+    """
+    Generator of registers of a register description file (regdef JSON or CMSIS-SVD) as dicts
+    {'name': ..., 'address': ..., 'reg': Register}, without generating any code.
+    """
+    for reg_name, reg_def in iter_regdef_items(file_name):
+        if not reg_name or not reg_def or reg_name.strip().startswith('//'):
+            continue
+        specs, address, options = split_regdef(reg_def)
+        yield {'name': reg_name, 'address': address, 'reg': Register.from_specs(specs, name=reg_name),
+               'cache_reads': options.get('cache_reads', False)}
+
+
+# elements of SVD which registers inherit properties from (like size) and their properties
+_SVD_SCOPES = {'device', 'peripheral', 'cluster'}
+_SVD_PROPERTIES = {'name', 'description', 'baseAddress', 'addressOffset', 'size', 'dim', 'dimIncrement', 'dimIndex'}
+_SVD_SCALE = {'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+
+
+def _svd_int(text):
+    """Integer of SVD (decimal, 0x hexadecimal or # binary, optionally scaled by k/M/G/T)."""
+    text = text.strip().lower()
+    scale = _SVD_SCALE.get(text[-1:], 1) if not text.startswith(('0x', '#')) else 1
+    if scale != 1:
+        text = text[:-1]
+    if text.startswith('#'):
+        return int(text[1:].replace('x', '0'), 2)  # x are "don't care" bits
+    return int(text, 16 if text.startswith('0x') else 10) * scale
+
+
+def _svd_dim_index(dim, dim_index):
+    """Names of elements of SVD array, e.g. "0-3", "A-D" or "RX,TX"."""
+    if dim_index is None:
+        return [str(i) for i in range(dim)]
+    dim_index = ''.join(dim_index.split())
+    if ',' in dim_index or '-' not in dim_index:
+        return dim_index.split(',')
+    first, last = dim_index.split('-')
+    if first.isdigit():
+        return [str(i) for i in range(int(first), int(last) + 1)]
+    return [chr(c) for c in range(ord(first), ord(last) + 1)]
+
+
+def _svd_instances(props, offset):
+    """
+    Instances of SVD element with given properties (dict of texts) as [(name, [offsets])],
+    offset is its value of given property plus dimIncrement for array elements.
+    Arrays with name ending with [%s] are a single instance with many offsets (as a list
+    of addresses in regdef JSON), ones with %s in name are separate instances.
+    """
+    name = props['name']
+    base = _svd_int(props[offset]) if props.get(offset) is not None else 0
+    if props.get('dim') is None:
+        return [(name, [base])]
+    dim = _svd_int(props['dim'])
+    increment = _svd_int(props['dimIncrement'])
+    if name.endswith('[%s]'):
+        return [(name[:-len('[%s]')], [base + i * increment for i in range(dim)])]
+    return [(name.replace('%s', index), [base + i * increment])
+            for i, index in enumerate(_svd_dim_index(dim, props.get('dimIndex')))]
+
+
+def _svd_defs(register, size):
+    """Field specs string of SVD register element (see Register.from_specs()), reserved bits up to size."""
+    fields = []  # (lsb, msb, name)
+    for field in register.iterfind('fields/field'):
+        name = field.findtext('name').strip()
+        if field.findtext('bitOffset') is not None:
+            lsb = _svd_int(field.findtext('bitOffset'))
+            msb = lsb + _svd_int(field.findtext('bitWidth', '1')) - 1
+        elif field.findtext('lsb') is not None:
+            lsb, msb = _svd_int(field.findtext('lsb')), _svd_int(field.findtext('msb'))
+        elif field.findtext('bitRange') is not None:
+            msb, lsb = (int(bit) for bit in field.findtext('bitRange').strip(' []').split(':'))
+        else:
+            raise ValueError('Field %s of register %s has no position' % (name, register.findtext('name')))
+        props = {'name': name, 'lsb': str(lsb)}
+        props.update((tag, field.findtext(tag)) for tag in ['dim', 'dimIncrement', 'dimIndex'])
+        for name, offsets in _svd_instances(props, 'lsb'):
+            fields.extend((offset, offset + msb - lsb, name) for offset in offsets)
+    if not fields:
+        # the whole register is a single field
+        name = register.findtext('name').strip().replace('[%s]', '').replace('%s', '').lower()
+        fields.append((0, size - 1, name))
+    fields.sort()
+    defs = ['%s:%d' % (name, lsb) if lsb == msb else '%s:%d:%d' % (name, msb, lsb) for lsb, msb, name in fields]
+    if fields[-1][1] < size - 1:
+        defs.append('_:%d' % (size - 1) if fields[-1][1] == size - 2 else '_:%d:%d' % (size - 1, fields[-1][1] + 1))
+    return ' '.join(defs)
+
+
+def iter_svd(file_name):
+    """
+    Generator of (name, definition) pairs of registers of a CMSIS-SVD file in the form of regdef
+    JSON, with a comment (name starting with //) before registers of each peripheral.
+
+    The file is read incrementally with iterparse() and each register (and peripheral) element
+    is dropped as soon as it is converted, so memory does not depend on size of the XML, only
+    (name, offsets, specs) of registers of each peripheral are kept for derivedFrom.
+    Registers are named PERIPHERAL_REGISTER (PERIPHERAL_CLUSTER_REGISTER in clusters)
+    with absolute addresses, arrays of peripherals, clusters, registers and fields are
+    expanded, as are peripherals and registers derived from ones before them.
     """
-    Generates C code for register definitions given a file with definition of registers
+    stack = []  # open elements
+    scopes = []  # properties of open device, peripheral and cluster elements
+    peripherals = {}  # name -> [(name, offsets, defs)] of registers, offsets relative to peripheral
+    layouts = {}  # the same specs of different registers are kept only once
+
+    def definitions(peripheral, registers, instances):
+        for name, bases in instances:
+            if not peripheral.get('commented'):
+                yield '// %s' % name, ' '.join((peripheral.get('description') or '').split())
+            for reg_name, offsets, defs in registers:
+                addresses = ['0x%08x' % (base + offset) for base in bases for offset in offsets]
+                yield '%s_%s' % (name, reg_name), {
+                    'address': addresses if len(addresses) > 1 else addresses[0],
+                    'address_t': 'uint32_t',
+                    'defs': defs.split(),
+                }
+        peripheral['commented'] = len(instances) == 1
+
+    for event, elem in ElementTree.iterparse(file_name, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            stack.append(elem)
+            if tag in _SVD_SCOPES:
+                scopes.append({'size': scopes[-1]['size'] if scopes else '32', 'registers': [], 'defs': {},
+                               'derivedFrom': elem.get('derivedFrom')})
+            continue
+        stack.pop()
+
+        if tag == 'register':
+            peripheral = scopes[1]
+            props = {key: elem.findtext(key) for key in _SVD_PROPERTIES}
+            size = _svd_int(props['size'] or scopes[-1]['size'])
+            defs = _svd_defs(elem, size)
+            derived = elem.get('derivedFrom')
+            if derived is not None and elem.find('fields') is None:
+                # only registers of the same peripheral, from the innermost cluster out
+                name = derived.split('.')[-1]
+                defs = next((scope['defs'][name] for scope in reversed(scopes[1:]) if name in scope['defs']), None)
+                if defs is None:
+                    raise ValueError('Register %s is derived from unknown register %s' % (props['name'], derived))
+            defs = scopes[-1]['defs'][props['name']] = layouts.setdefault(defs, defs)
+            registers = _svd_instances(props, 'addressOffset')
+            for cluster in reversed(scopes[2:]):
+                registers = [('%s_%s' % (cluster_name, name), [c + r for c in cluster_offsets for r in offsets])
+                             for cluster_name, cluster_offsets in _svd_instances(cluster, 'addressOffset')
+                             for name, offsets in registers]
+            registers = [(name, tuple(offsets), defs) for name, offsets in registers]
+            peripheral['registers'].extend(registers)
+            if peripheral.get('instances') is None:
+                peripheral['instances'] = _svd_instances(peripheral, 'baseAddress')
+            if len(peripheral['instances']) == 1:
+                yield from definitions(peripheral, registers, peripheral['instances'])
+            stack[-1].remove(elem)
+        elif tag == 'peripheral':
+            peripheral = scopes.pop()
+            registers = []
+            if peripheral['derivedFrom'] is not None:
+                if peripheral['derivedFrom'] not in peripherals:
+                    raise ValueError('Peripheral %s is derived from unknown peripheral %s'
+                                     % (peripheral['name'], peripheral['derivedFrom']))
+                names = set(name for name, offsets, defs in peripheral['registers'])
+                registers = [register for register in peripherals[peripheral['derivedFrom']]
+                             if register[0] not in names]
+                peripheral['registers'].extend(registers)
+            # arrays of peripherals are written at the end, one peripheral after another
+            instances = peripheral.get('instances') or _svd_instances(peripheral, 'baseAddress')
+            if len(instances) > 1:
+                registers = peripheral['registers']
+            if registers:
+                yield from definitions(peripheral, registers, instances)
+            peripherals[peripheral['name']] = peripheral['registers']
+            stack[-1].remove(elem)
+        elif tag == 'cluster':
+            scopes.pop()
+            stack[-1].remove(elem)
+        elif tag in _SVD_PROPERTIES and stack and stack[-1].tag in _SVD_SCOPES:
+            scopes[-1][tag] = elem.text.strip() if elem.text else None
+        elif tag == 'enumeratedValues':
+            elem.clear()
+
+
+def iter_regdef_json(file_name, comments=True, cache=None, dispatch=None, shadow=False,
+                     frame=None, dedup=False, timings=None, **ccode_kwargs):
+    """
+    Streaming variant of parse_regdef_json(), yields one (code, register) pair at a time
+    in the order of the JSON file, without loading whole file into memory.
+    For comments (keys starting with //) register is None, else it is a dict
+    {'name': ..., 'address': ..., 'reg': Register}.
+    Raises ValueError for a register defined more than once.
+    dispatch - if given, code of address dispatch table is yielded at the end
+               (with register None), the value is passed as method to dispatch_code()
+    shadow - if True, code of shadow image of the registers is yielded at the end
+             (with register None), see shadow_code()
+    frame - if given, code packing registers into bus frames is yielded at the end
+            (with register None), the value is a dict of frame_code() options
+            (addr_bytes, value_bytes, byteorder)
+    dedup - if True, code of registers with the same layout as some register before
+            only reuses its code, see Register.ccode_alias()
+    timings - optional Timings collecting time spent in each phase
+    """
+    timed = timings.phase if timings is not None else _no_phase
+    entries = []
+    shadows = []
+    layouts = {}  # (layout, code generation kwargs) -> name of the first register with it
+    table_kwargs = _pick(ccode_kwargs, 'prefix', 'address_t', 'cpp')
+    names = set()
+    with contextlib.closing(iter_regdef_items(file_name)) as items:
+        if timings is not None:
+            items = timings.iter('json', items)
+        for reg_name, reg_def in items:
+            # ignore empty nodes or ones with name starting with //
+            if reg_name and reg_name.strip().startswith('//'):
+                if comments:
+                    yield reg_name, None
+                continue
+            if not reg_name or not reg_def:
+                continue
+            # json.load() would silently keep only the last one, code of both would not compile
+            if reg_name in names:
+                raise ValueError('Register %s is defined more than once in %s' % (reg_name, file_name))
+            names.add(reg_name)
+            start = time.perf_counter() if timings is not None else None
+            specs, address, reg_def = split_regdef(reg_def)
+            cache_reads = reg_def.pop('cache_reads', False)
+
+            # construct the kwargs by taking defaults from ccode_kwargs
+            # and then overwriting the ones that were defined in json
+            kwargs = copy.copy(ccode_kwargs)
+            kwargs.update(reg_def)
+            # tables of all registers need the widest address type of any register (e.g. from SVD)
+            if 'address_t' in reg_def and _type_bits(reg_def['address_t']) > _type_bits(
+                    table_kwargs.get('address_t', 'uint8_t')):
+                table_kwargs['address_t'] = reg_def['address_t']
+
+            cached = None
+            if cache is not None:
+                with timed('cache'):
+                    key = cache.key(reg_name, specs, address, kwargs)
+                    cached = cache.get(key)
+            if cached is not None:
+                reg, reg_code = cached
+            else:
+                with timed('from_specs'):
+                    reg = Register.from_specs(specs, name=reg_name)
+                reg_code = None
+            base = None
+            if dedup:
+                options = json.dumps({k: v for k, v in kwargs.items() if k != 'address_t'}, sort_keys=True)
+                base = layouts.setdefault((reg.layout, options), reg_name)
+            if base is not None and base != reg_name:
+                reg_code = reg.ccode_alias(address, base, **kwargs)
+                full_code = None
+            elif reg_code is None:
+                with timed('ccode'):
+                    reg_code = full_code = reg.ccode(address, **kwargs)
+                #  reg_code = reg.code_masks(address, **kwargs)
+            else:
+                full_code = reg_code
+            # aliases are cached without code, it depends on the registers before
+            if cache is not None and (cached is None or (cached[1] is None and full_code is not None)):
+                with timed('cache'):
+                    cache.put(key, reg, full_code)
+
+            register = {'name': reg_name, 'address': address, 'reg': reg, 'cache_reads': cache_reads}
+            if dispatch:
+                entries.extend(dispatch_entries([register], **_pick(kwargs, 'reserved_regex')))
+            if shadow or frame is not None:
+                shadows.extend(shadow_entries([register], **_pick(kwargs, 'reserved_regex')))
+            if timings is not None:
+                timings.add_register(reg_name, time.perf_counter() - start)
+            yield reg_code, register
+
+    if dispatch:
+        with timed('dispatch'):
+            code = dispatch_code(entries, method=dispatch,
+                                 **table_kwargs)
+        if comments:
+            yield '// Address dispatch table', None
+        yield code, None
+    if shadow:
+        if comments:
+            yield '// Shadow image', None
+        with timed('shadow'):
+            code = shadow_code(shadows, **table_kwargs)
+        yield code, None
+    if frame is not None:
+        if comments:
+            yield '// Frame packing', None
+        with timed('frame'):
+            code = frame_code(shadows, **table_kwargs, **frame)
+        yield code, None
+
+
+def split_regdef(reg_def):
+    """
+    Split register definition from JSON into (specs, address, options), where specs is
+    for Register.from_specs() and options is a dict of all the other keys.
+    """
+    options = dict(reg_def)
+    if 'defs' in options:
+        specs = ' '.join(options.pop('defs'))
+    else:
+        specs = options.pop('def')
+    address = options.pop('address')
+    return specs, address, options
+
+
+def _type_bits(type_name):
+    """Width of C integer type like uint32_t, 0 for other types."""
+    match = re.search(r'(\d+)_t$', type_name)
+    return int(match.group(1)) if match else 0
+
+
+def _pick(kwargs, *names):
+    """Subset of kwargs with given names."""
+    return {name: kwargs[name] for name in names if name in kwargs}
+
+
+def parse_regdef_json(file_name, comments=True, cache=None, dispatch=None, shadow=False,
+                      frame=None, dedup=False, timings=None, **ccode_kwargs):
+    """
+    Generates C code for register definitions given a file with definition of registers.
+    Returns (code, registers) lists, see iter_regdef_json() for a streaming variant.
     The register fields description is the same as for Register.from_specs().
     The syntax of JSON file is as follows and has 2 variants:
 
@@ -492,43 +1610,1917 @@ def parse_regdef_json(file_name, comments=True, **ccode_kwargs):
     ]
 }
 
-    All other fields are optional and are passed to the Register.ccode() method.
+    "cache_reads": true makes reads of the register cached in the shadow image (see shadow_code()),
+    all other fields are optional and are passed to the Register.ccode() method.
 
+    cache - optional CodeCache, registers found in it are not parsed nor generated again
+    dispatch - if given, code of address dispatch table is added, see dispatch_code()
+    shadow - if True, code of shadow image of the registers is added, see shadow_code()
+    frame - if given, code packing registers into bus frames is added, see frame_code()
+    dedup - if True, registers with the same layout reuse code of the first one, see Register.ccode_alias()
+    timings - optional Timings collecting time spent in each phase
     ccode_kwargs - passed to ccode, overwritten by configurations in json
     """
-    with open(file_name) as fp:
-        reg_defs = json.load(fp)
-    #  __import__('pprint').pprint(reg_defs)
-
     code = []
     registers = []
-    for reg_name, reg_def in reg_defs.items():
-        # ignore empty nodes or ones with name starting with //
-        if reg_name and reg_name.strip().startswith('//'):
-            if comments:
-                code.append(reg_name)
+    for reg_code, register in iter_regdef_json(file_name, comments=comments, cache=cache,
+                                               dispatch=dispatch, shadow=shadow, frame=frame, dedup=dedup,
+                                               timings=timings, **ccode_kwargs):
+        code.append(reg_code)
+        if register is not None:
+            registers.append(register)
+
+    return code, registers
+
+
+CHECK_ERRORS = ['invalid', 'duplicate', 'order', 'overlap', 'over-width', 'collision']
+
+
+def sweep_intervals(intervals, start=None):
+    """
+    Sweep over (start, end, item) intervals (end exclusive) in order of their starts,
+    yields ('overlap', item, other_item) for every pair of overlapping intervals and
+    ('gap', start, end) for ranges between intervals that no interval covers (also
+    before the first interval if `start` is given).
+    O(n log n + k) for k overlapping pairs, intervals still active are kept in a heap.
+    """
+    active = []  # (end, n, item)
+    covered = start
+    for n, (begin, end, item) in enumerate(sorted(intervals, key=lambda interval: interval[:2])):
+        while active and active[0][0] <= begin:
+            heapq.heappop(active)
+        for _, _, other in active:
+            yield 'overlap', other, item
+        if covered is not None and begin > covered:
+            yield 'gap', covered, begin
+        covered = end if covered is None else max(covered, end)
+        heapq.heappush(active, (end, n, item))
+
+
+def check_fields(name, specs, max_bits=None, gaps=False):
+    """
+    Problems of fields of a single register as (kind, name, message), see check_regdef_json().
+    Returns (problems, n_bits), n_bits is None if the specs are invalid.
+    """
+    try:
+        names, lengths, positions = Register.field_positions(specs)
+    except (AssertionError, ValueError, IndexError) as e:
+        return [('invalid', name, 'invalid fields: %s' % e)], None
+    if not names:
+        return [('invalid', name, 'no fields')], None
+    problems = []
+    intervals = [(_pos_min(pos), _pos_max(pos) + 1, field) for field, pos in zip(names, positions)]
+    # usually fields are ordered and disjoint, which a single pass shows
+    ordered = all(end <= begin for (_, end, _), (begin, _, _) in zip(intervals, intervals[1:]))
+    if not ordered or gaps:
+        overlaps = False
+        for kind, a, b in sweep_intervals(intervals, start=0):
+            if kind == 'overlap':
+                overlaps = True
+                problems.append(('overlap', name, 'fields %s and %s overlap' % (a, b)))
+            elif gaps:
+                problems.append(('gap', name, 'bits %d..%d are not in any field' % (a, b - 1)))
+        if not ordered and not overlaps:
+            problems.append(('order', name, 'fields are neither in increasing nor in decreasing order'))
+    n_bits = max(end for _, end, _ in intervals)
+    if max_bits is not None:
+        problems.extend(('over-width', name, 'field %s (bits %d..%d) does not fit in %d bits'
+                         % (field, low, end - 1, max_bits))
+                        for low, end, field in intervals if end > max_bits)
+    return problems, n_bits
+
+
+def check_regdef_json(file_name, max_bits=None, address_bits=None, gaps=False):
+    """
+    Validate whole register map without generating code, generator of problems
+    (kind, register name, message), kinds in CHECK_ERRORS or 'gap' (only if gaps is True).
+
+    Fields of each register are checked for overlaps, order and width (bits above
+    max_bits, or above "reg_n" of the register if given) while the file is streamed.
+    Then addresses of all registers are sorted and swept once to find collisions
+    (registers occupying the same address), so the whole check is O(n log n).
+    address_bits - if given, a register occupies ceil(n_bits / address_bits) addresses
+                   (e.g. 8 for byte addressed memory), else a single one
+    gaps - report also bits not in any field and addresses not used by any register
+    """
+    intervals = []  # (start, end, (name, index))
+    names = set()
+    for reg_name, reg_def in iter_regdef_items(file_name):
+        if not reg_name or reg_name.strip().startswith('//') or not reg_def:
+            continue
+        if reg_name in names:
+            yield 'duplicate', reg_name, 'register is defined more than once'
             continue
-        if not reg_name or not reg_def:
+        names.add(reg_name)
+        try:
+            specs, address, options = split_regdef(reg_def)
+            addresses = address if isinstance(address, list) else [address]
+            addresses = [parse_address(a) for a in addresses]
+        except (KeyError, ValueError, TypeError) as e:
+            yield 'invalid', reg_name, 'invalid definition: %s' % e
             continue
-        if 'defs' in reg_def.keys():
-            specs = ' '.join(reg_def.pop('defs'))
+        problems, n_bits = check_fields(reg_name, specs, max_bits=options.get('reg_n', max_bits), gaps=gaps)
+        yield from problems
+        span = -(-n_bits // address_bits) if address_bits and n_bits else 1
+        for i, a in enumerate(addresses):
+            intervals.append((a, a + span, (reg_name, i if isinstance(address, list) else None)))
+
+    def describe(item):
+        name, i = item
+        return name if i is None else '%s[%d]' % (name, i)
+
+    starts = {item: begin for begin, _, item in intervals}
+    for kind, a, b in sweep_intervals(intervals):
+        if kind == 'overlap':
+            yield 'collision', b[0], '%s at %#04x collides with %s at %#04x' % (
+                describe(b), starts[b], describe(a), starts[a])
+        elif gaps:
+            yield 'gap', None, 'addresses %#04x..%#04x are not used by any register' % (a, b - 1)
+
+
+def parse_address(address):
+    """Convert address from JSON (e.g. "0x30" or 48) to an integer."""
+    return int(address, 0) if isinstance(address, str) else int(address)
+
+
+def address_index(registers):
+    """
+    Build address -> (name, index, reg) mapping from registers returned by parse_regdef_json().
+    For registers with a list of addresses, index is the position in that list, else None.
+    """
+    index = {}
+    for register in registers:
+        address = register['address']
+        if isinstance(address, list):
+            addresses = enumerate(address)
         else:
-            specs = reg_def.pop('def')
+            addresses = [(None, address)]
+        for i, a in addresses:
+            index[parse_address(a)] = (register['name'], i, register['reg'])
+    return index
+
+
+class LazyRegisterMap(collections.abc.Mapping):
+    """
+    Register map from register description JSON which parses registers only when used.
+
+    Only raw specs strings and addresses are kept after reading the file. Mapping values
+    are dicts as returned by parse_regdef_json() ({'name': ..., 'address': ..., 'reg': ...}),
+    built on first access and memoized, the same for generated code (see code()).
+    Iteration order is the order of the JSON file, comments are skipped.
+
+    ccode_kwargs - passed to ccode, overwritten by configurations in json
+    """
 
-        address = reg_def.pop('address')
+    def __init__(self, file_name, **ccode_kwargs):
+        self.file_name = file_name
+        self.ccode_kwargs = ccode_kwargs
+        self._entries = {}  # name -> (specs, address, options)
+        self._registers = {}
+        self._code = {}
+        self._addresses = None
+        for reg_name, reg_def in iter_regdef_items(file_name):
+            if not reg_name or not reg_def or reg_name.strip().startswith('//'):
+                continue
+            self._entries[reg_name] = split_regdef(reg_def)
+
+    def __getitem__(self, name):
+        register = self._registers.get(name)
+        if register is None:
+            specs, address, options = self._entries[name]
+            register = self._registers[name] = {
+                'name': name,
+                'address': address,
+                'reg': Register.from_specs(specs, name=name),
+                'cache_reads': options.get('cache_reads', False),
+            }
+        return register
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def code(self, name):
+        """Code generated by Register.ccode() for given register."""
+        code = self._code.get(name)
+        if code is None:
+            specs, address, options = self._entries[name]
+            kwargs = copy.copy(self.ccode_kwargs)
+            kwargs.update(options)
+            kwargs.pop('cache_reads', None)
+            code = self._code[name] = self[name]['reg'].ccode(address, **kwargs)
+        return code
+
+    def addresses(self):
+        """Mapping address -> (name, index), index as in address_index(), built on first use."""
+        if self._addresses is None:
+            self._addresses = {}
+            for name, (specs, address, options) in self._entries.items():
+                if isinstance(address, list):
+                    for i, a in enumerate(address):
+                        self._addresses[parse_address(a)] = (name, i)
+                else:
+                    self._addresses[parse_address(address)] = (name, None)
+        return self._addresses
+
+    def lookup(self, address):
+        """Register dict and index in its address list (or None) for given address."""
+        name, i = self.addresses()[address]
+        return self[name], i
+
+    def address_index(self):
+        """Lazy equivalent of address_index(), registers are parsed when looked up."""
+        return _LazyAddressIndex(self)
+
+
+class _LazyAddressIndex(collections.abc.Mapping):
+    def __init__(self, regmap):
+        self.regmap = regmap
+
+    def __getitem__(self, address):
+        register, i = self.regmap.lookup(address)
+        return register['name'], i, register['reg']
+
+    def __iter__(self):
+        return iter(self.regmap.addresses())
 
-        # construct the kwargs by taking defaults from ccode_kwargs
-        # and then overwriting the ones that were defined in json
-        kwargs = copy.copy(ccode_kwargs)
-        kwargs.update(reg_def)
+    def __len__(self):
+        return len(self.regmap.addresses())
 
+
+class RegDB:
+    """
+    Compiled register map (.regdb file written by compile_regdb()) mapped with mmap.
+
+    The file holds fully resolved field names, lengths, positions and addresses, so
+    Register objects are built without running Register.from_specs(). Tables are
+    accessed directly from the mapped memory, only strings are decoded when needed.
+
+    Layout (little-endian): header, registers table (REGISTER_WORDS x uint32 per register),
+    fields table (FIELD_WORDS x uint32 per field), addresses table (2 x uint32 per address),
+    strings. Strings are referenced by (offset, length) in the strings section.
+    """
+    MAGIC = b'REGDB\x00\x00\x00'
+    VERSION = 1
+    HEADER = struct.Struct('<8sHH20s20sQQIIIIII')
+    REGISTER_WORDS = 8  # name off/len, first field, n_fields, first address, n_addresses | list flag, options off/len
+    FIELD_WORDS = 6  # name off/len, length, position kind (0: None, 1: int, 2: tuple), position values
+    ADDRESS_LIST = 0x80000000
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < self.HEADER.size:
+            self.mm.close()
+            raise ValueError('Truncated regdb file: %s' % file_name)
+        header = self.HEADER.unpack_from(self.mm)
+        (magic, self.version, _, self.generator, self.source_hash, self.source_size,
+         self.source_mtime_ns, self.n_registers, self.n_fields, self.n_addresses,
+         self.strings_size, source_off, source_len) = header
+        if magic != self.MAGIC:
+            self.mm.close()
+            raise ValueError('Not a regdb file: %s' % file_name)
+        if self.version != self.VERSION:
+            self.mm.close()
+            raise ValueError('Unsupported regdb version %d: %s' % (self.version, file_name))
+        size = self.HEADER.size + 4 * (self.n_registers * self.REGISTER_WORDS + self.n_fields * self.FIELD_WORDS
+                                       + self.n_addresses * 2) + self.strings_size
+        if len(self.mm) < size:
+            self.mm.close()
+            raise ValueError('Truncated regdb file: %s' % file_name)
+
+        view = memoryview(self.mm)
+        offset = self.HEADER.size
+        sections = []
+        for n_words in [self.n_registers * self.REGISTER_WORDS, self.n_fields * self.FIELD_WORDS,
+                        self.n_addresses * 2]:
+            sections.append(_uint32_table(view[offset:offset + 4 * n_words]))
+            offset += 4 * n_words
+        self.regs, self.fields, self.addresses = sections
+        self.strings = view[offset:offset + self.strings_size]
+        self._decoded = {}  # offset -> str, field names repeat a lot
+        self.source = self.string(source_off, source_len)
+        self._index = None
+
+    def close(self):
+        for table in [self.regs, self.fields, self.addresses, self.strings]:
+            if isinstance(table, memoryview):
+                table.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.n_registers
+
+    def string(self, offset, length):
+        s = self._decoded.get(offset)
+        if s is None:
+            s = self._decoded[offset] = str(self.strings[offset:offset + length], 'utf-8')
+        return s
+
+    def name(self, i):
+        r = i * self.REGISTER_WORDS
+        return self.string(self.regs[r], self.regs[r + 1])
+
+    def index(self, name):
+        """Index of register with given name."""
+        if self._index is None:
+            self._index = {self.name(i): i for i in range(self.n_registers)}
+        return self._index[name]
+
+    def address(self, i):
+        """Address as given in JSON, a string or a list of strings."""
+        r = i * self.REGISTER_WORDS
+        first, count = self.regs[r + 4], self.regs[r + 5]
+        addresses = [self.string(self.addresses[2 * a], self.addresses[2 * a + 1])
+                     for a in range(first, first + (count & ~self.ADDRESS_LIST))]
+        return addresses if count & self.ADDRESS_LIST else addresses[0]
+
+    def options(self, i):
+        """Remaining keys of the register definition from JSON (e.g. ccode() arguments)."""
+        r = i * self.REGISTER_WORDS
+        length = self.regs[r + 7]
+        return json.loads(self.string(self.regs[r + 6], length)) if length else {}
+
+    def register(self, i):
+        """Build Register with index i."""
+        r = i * self.REGISTER_WORDS
+        first, n_fields = self.regs[r + 2], self.regs[r + 3]
+        words = self.fields[first * self.FIELD_WORDS:(first + n_fields) * self.FIELD_WORDS].tolist()
+        string = self.string
+        n = self.FIELD_WORDS
+        names = [string(off, length) for off, length in zip(words[0::n], words[1::n])]
+        positions = [None if kind == 0 else a if kind == 1 else (a, b)
+                     for kind, a, b in zip(words[3::n], words[4::n], words[5::n])]
+        return Register(names, words[2::n], positions=positions, name=self.name(i))
+
+    def registers(self):
+        """All registers as dicts, the same as returned by parse_regdef_json()."""
+        registers = []
+        for i in range(self.n_registers):
+            options = self.options(i)
+            registers.append({'name': self.name(i), 'address': self.address(i), 'reg': self.register(i),
+                              'cache_reads': options.get('cache_reads', False)})
+        return registers
+
+    def source_path(self):
+        """Path of the source JSON file (stored relative to the regdb file)."""
+        return os.path.join(os.path.dirname(os.path.abspath(self.file_name)), self.source)
+
+    def is_fresh(self):
+        """Whether the file has been compiled by this version of regdef.py from current source."""
+        if self.generator != bytes.fromhex(CodeCache.generator_hash()):
+            return False
+        source = self.source_path()
+        if not os.path.exists(source):
+            return True  # nothing to rebuild from
+        stat = os.stat(source)
+        if stat.st_size != self.source_size:
+            return False
+        if stat.st_mtime_ns == self.source_mtime_ns:
+            return True
+        return _file_hash(source) == self.source_hash
+
+
+def _uint32_table(view):
+    """Zero-copy uint32 view of little-endian data (a copy on big-endian hosts)."""
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    table = array.array('I', view.tobytes())
+    table.byteswap()
+    return table
+
+
+def _file_hash(file_name):
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(2**20), b''):
+            sha.update(chunk)
+    return sha.digest()
+
+
+def regdb_file_name(regdef_file):
+    """Default compiled file name, e.g. tmc5041.regdef.json -> tmc5041.regdb"""
+    base = regdef_file[:-len('.json')] if regdef_file.endswith('.json') else regdef_file
+    if base.endswith('.regdef'):
+        base = base[:-len('.regdef')]
+    return base + '.regdb'
+
+
+def compile_regdb(regdef_file, regdb_file=None):
+    """
+    Compile register description JSON into a binary .regdb file, see RegDB.
+    Comments are not stored. Returns the name of the written file.
+    """
+    regdb_file = regdb_file or regdb_file_name(regdef_file)
+    strings = bytearray()
+    string_index = {}
+
+    def string(s):
+        ref = string_index.get(s)
+        if ref is None:
+            data = s.encode('utf-8')
+            ref = string_index[s] = (len(strings), len(data))
+            strings.extend(data)
+        return ref
+
+    regs = array.array('I')
+    fields = array.array('I')
+    addresses = array.array('I')
+    source_hash = hashlib.sha1()
+    with open(regdef_file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(2**20), b''):
+            source_hash.update(chunk)
+    stat = os.stat(regdef_file)
+
+    for reg_name, reg_def in iter_regdef_items(regdef_file):
+        if not reg_name or not reg_def or reg_name.strip().startswith('//'):
+            continue
+        specs, address, options = split_regdef(reg_def)
         reg = Register.from_specs(specs, name=reg_name)
-        code.append(reg.ccode(address, **kwargs))
-        #  code.append(reg.code_masks(address, **kwargs))
+        address_list = address if isinstance(address, list) else [address]
+        n_addresses = len(address_list) | (RegDB.ADDRESS_LIST if isinstance(address, list) else 0)
+        regs.extend(string(reg_name))
+        regs.extend([len(fields) // RegDB.FIELD_WORDS, len(reg.names),
+                     len(addresses) // 2, n_addresses])
+        regs.extend(string(json.dumps(options, sort_keys=True)) if options else (0, 0))
+        for name, length, pos in zip(reg.names, reg.lengths, reg.positions):
+            fields.extend(string(name))
+            if pos is None:
+                fields.extend([length, 0, 0, 0])
+            elif isinstance(pos, tuple):
+                fields.extend([length, 2, pos[0], pos[1]])
+            else:
+                fields.extend([length, 1, pos, 0])
+        for a in address_list:
+            addresses.extend(string(str(a)))
+
+    source = os.path.relpath(os.path.abspath(regdef_file), os.path.dirname(os.path.abspath(regdb_file)))
+    source_ref = string(source)
+    header = RegDB.HEADER.pack(
+        RegDB.MAGIC, RegDB.VERSION, 0, bytes.fromhex(CodeCache.generator_hash()), source_hash.digest(),
+        stat.st_size, stat.st_mtime_ns, len(regs) // RegDB.REGISTER_WORDS, len(fields) // RegDB.FIELD_WORDS,
+        len(addresses) // 2, len(strings), source_ref[0], source_ref[1])
+    if sys.byteorder != 'little':
+        for table in [regs, fields, addresses]:
+            table.byteswap()
+
+    # write to a temporary file, so that readers never see partially written file
+    dir_name = os.path.dirname(os.path.abspath(regdb_file))
+    fd, tmp_name = tempfile.mkstemp(dir=dir_name, prefix='.%s.' % os.path.basename(regdb_file))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(header)
+            for table in [regs, fields, addresses]:
+                table.tofile(fp)
+            fp.write(strings)
+        os.chmod(tmp_name, 0o666 & ~_umask())
+        os.replace(tmp_name, regdb_file)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return regdb_file
+
+
+def load_regdb(file_name):
+    """
+    Open compiled register map. file_name is either a .regdb file or register description
+    JSON (then the default .regdb file next to it is used). The .regdb file is compiled
+    again if it does not exist, is stale or has been written by another version of regdef.py.
+    Raises FileNotFoundError (missing) or ValueError (invalid) for a .regdb file that cannot
+    be compiled again because its source is not known.
+    """
+    if file_name.endswith('.regdb'):
+        regdb_file, regdef_file = file_name, None
+    else:
+        regdb_file, regdef_file = regdb_file_name(file_name), file_name
+    error = None
+    if os.path.exists(regdb_file):
+        try:
+            db = RegDB(regdb_file)
+        except ValueError as e:
+            db, error = None, e
+        if db is not None:
+            if db.is_fresh():
+                return db
+            regdef_file = regdef_file or db.source_path()
+            db.close()
+    if regdef_file is None:
+        if error is not None:
+            raise ValueError('%s, cannot compile it again without source JSON' % error)
+        raise FileNotFoundError('Cannot compile %s, no source JSON' % regdb_file)
+    return RegDB(compile_regdb(regdef_file, regdb_file))
+
+
+def dispatch_entries(registers, reserved_regex='reserved|RESERVED|_'):
+    """
+    Compact description of registers for dispatch_code(), list of
+    (name, [(address, instance), ...], n_bits, valid_mask, reserved_mask),
+    instance is the index in the register's list of addresses (0 for single address).
+    """
+    entries = []
+    for register in registers:
+        reg = register['reg']
+        address = register['address']
+        addresses = address if isinstance(address, list) else [address]
+        assert reg.n_bits <= 64, 'Dispatch table supports registers up to 64 bits, %s has %d bits' \
+            % (register['name'], reg.n_bits)
+        valid = reserved = 0
+        for name, shift, mask in zip(reg.names, reg.shifts, reg.masks):
+            if re.match(reserved_regex, name):
+                reserved |= mask << shift
+            else:
+                valid |= mask << shift
+        entries.append((register['name'], [(parse_address(a), i) for i, a in enumerate(addresses)],
+                        reg.n_bits, valid, reserved))
+    return entries
 
-        registers.append({'name': reg_name, 'address': address, 'reg': reg})
 
-    return code, registers
+def find_perfect_hash(addresses, tries=100):
+    """
+    Find a perfect hash (hash and displace) for given addresses:
+    slot(a) = h(a, mult2, k2) ^ displacements[h(a, mult1, k1)]
+    where h(a, mult, k) = ((a * mult) mod 2**32) >> (32 - k) and table size is 2**k2.
+    Returns (mult1, k1, mult2, k2, displacements) or None if not found.
+    """
+    import random
+    rand = random.Random(len(addresses))  # deterministic output
+
+    def h(a, mult, k):
+        return ((a * mult) & 0xffffffff) >> (32 - k)
+
+    k2 = max(1, (len(addresses) - 1).bit_length())
+    k1 = max(1, k2 - 2)
+    for _ in range(tries):
+        mult1, mult2 = rand.getrandbits(32) | 1, rand.getrandbits(32) | 1
+        buckets = [[] for _ in range(2**k1)]
+        for a in addresses:
+            buckets[h(a, mult1, k1)].append(h(a, mult2, k2))
+        # place biggest buckets first, each with displacement that avoids used slots
+        used = set()
+        displacements = [0] * len(buckets)
+        for b in sorted(range(len(buckets)), key=lambda b: -len(buckets[b])):
+            slots = buckets[b]
+            if not slots:
+                continue
+            for d in range(2**k2):
+                placed = set(slot ^ d for slot in slots)
+                if len(placed) == len(slots) and not (placed & used):
+                    used |= placed
+                    displacements[b] = d
+                    break
+            else:
+                break
+        else:
+            return mult1, k1, mult2, k2, displacements
+    return None
+
+
+# dense dispatch tables are refused if they would have more entries per address
+DENSE_MAX_SPAN = 16
+
+
+def dispatch_code(entries, prefix='', address_t='uint8_t', method='auto', cpp=False):
+    """
+    Generate C/C++ code with a constant table mapping each register address
+    to register index, instance (index in address list), n_bits, masks and name,
+    and a lookup function `const {prefix}reg_info *{prefix}reg_lookup(address)`
+    returning NULL for unknown addresses.
+
+    entries - as returned by dispatch_entries()
+    method - table layout: 'dense' array indexed by address (unless the addresses are too
+             sparse for it, see DENSE_MAX_SPAN), 'sorted' table searched with binary search,
+             'hash' perfect hash table or 'auto' to choose based on how sparse the address space is
+    cpp - whether to generate code for C++ or for C
+    """
+    # the first register defined at given address is used for dispatching
+    by_address = {}
+    conflicts = []
+    for index, (name, addresses, n_bits, valid, reserved) in enumerate(entries):
+        for address, instance in addresses:
+            if address in by_address:
+                conflicts.append('// WARNING: address %#04x of %s already used by %s'
+                                 % (address, name, entries[by_address[address][0]][0]))
+                print(conflicts[-1][3:], file=sys.stderr)
+                continue
+            by_address[address] = (index, instance)
+    addresses = sorted(by_address)
+    assert addresses, 'No registers to generate dispatch table'
+    span = addresses[-1] - addresses[0] + 1
+
+    perfect_hash = None
+    if method == 'dense' and span > DENSE_MAX_SPAN * len(addresses):
+        # e.g. 32-bit addresses of memory mapped peripherals, the table would not even fit in memory
+        print('WARNING: dense dispatch table would have %d entries for %d addresses, using hash or sorted'
+              % (span, len(addresses)), file=sys.stderr)
+        method = 'auto'
+    if method == 'auto':
+        if span <= 4 * len(addresses):
+            method = 'dense'
+        elif len(addresses) <= 16:
+            # binary search over so few entries is as fast and needs no extra table
+            method = 'sorted'
+        else:
+            perfect_hash = find_perfect_hash(addresses)
+            method = 'hash' if perfect_hash is not None else 'sorted'
+    elif method == 'hash':
+        perfect_hash = find_perfect_hash(addresses)
+        assert perfect_hash is not None, 'Could not find perfect hash for %d addresses' % len(addresses)
+    assert method in ['dense', 'sorted', 'hash'], 'Unknown dispatch method: %s' % method
+
+    mask_t = 'uint64_t' if any(e[2] > 32 for e in entries) else 'uint32_t'
+    index_t = 'uint8_t' if len(entries) <= 2**8 else 'uint16_t' if len(entries) <= 2**16 else 'uint32_t'
+    n_instances = max(len(e[1]) for e in entries)
+    instance_t = 'uint8_t' if n_instances <= 2**8 else 'uint16_t' if n_instances <= 2**16 else 'uint32_t'
+    info = prefix + 'reg_info'
+
+    lines = conflicts + [
+        'typedef struct %s {' % info,
+        '    %s address;' % address_t,
+        '    %s index;' % index_t,
+        '    %s instance;' % instance_t,
+        '    uint8_t n_bits;',
+        '    %s valid_mask;' % mask_t,
+        '    %s reserved_mask;' % mask_t,
+        '    const char *name;',
+        '} %s;' % info,
+        '',
+        'enum %sreg_index {' % prefix,
+    ]
+    lines.extend('    %s%s_INDEX = %d,' % (prefix, e[0], i) for i, e in enumerate(entries))
+    lines.append('    %sREG_COUNT = %d' % (prefix, len(entries)))
+    lines.append('};')
+    lines.append('')
+
+    def entry_init(address):
+        if address not in by_address:
+            return '{0, 0, 0, 0, 0, 0, NULL}'
+        index, instance = by_address[address]
+        name, _, n_bits, valid, reserved = entries[index]
+        return '{{{addr:#04x}, {index}, {instance}, {n_bits}, {valid:#x}{u}, {reserved:#x}{u}, "{name}"}}'.format(
+            addr=address, index=index, instance=instance, n_bits=n_bits,
+            valid=valid, reserved=reserved, name=name, u='ULL' if mask_t == 'uint64_t' else 'U')
+
+    if method == 'dense':
+        slots = range(addresses[0], addresses[-1] + 1)
+        comment = 'dense table indexed by (address - %#04x)' % addresses[0]
+    elif method == 'sorted':
+        slots = addresses
+        comment = 'table sorted by address for binary search'
+    else:
+        mult1, k1, mult2, k2, displacements = perfect_hash
+        slots = [None] * 2**k2
+        for address in addresses:
+            slot = ((address * mult2) & 0xffffffff) >> (32 - k2)
+            slots[slot ^ displacements[((address * mult1) & 0xffffffff) >> (32 - k1)]] = address
+        comment = 'perfect hash table indexed by h2(address) ^ displacements[h1(address)]'
+        disp_t = 'uint8_t' if k2 <= 8 else 'uint16_t' if k2 <= 16 else 'uint32_t'
+        lines.append('static const %s %sreg_displacements[%d] = {' % (disp_t, prefix, len(displacements)))
+        for i in range(0, len(displacements), 16):
+            lines.append('    %s,' % ', '.join('%d' % d for d in displacements[i:i + 16]))
+        lines.append('};')
+        lines.append('')
+
+    table = prefix + 'reg_table'
+    lines.append('// %s' % comment)
+    lines.append('static const %s %s[%d] = {' % (info, table, len(slots)))
+    lines.extend('    %s,' % entry_init(address) for address in slots)
+    lines.append('};')
+    lines.append('')
+    lines.append('static inline const %s *%sreg_lookup(%s address) {' % (info, prefix, address_t))
+    if method == 'dense':
+        lines.extend([
+            '    size_t i = (size_t) address - %#04xU;' % addresses[0],
+            '    if (i >= %d || %s[i].name == NULL)' % (len(slots), table),
+            '        return NULL;',
+            '    return &%s[i];' % table,
+        ])
+    elif method == 'sorted':
+        lines.extend([
+            '    size_t lo = 0, hi = %d;' % len(slots),
+            '    while (lo < hi) {',
+            '        size_t mid = lo + (hi - lo) / 2;',
+            '        if (%s[mid].address < address)' % table,
+            '            lo = mid + 1;',
+            '        else',
+            '            hi = mid;',
+            '    }',
+            '    if (lo == %d || %s[lo].address != address)' % (len(slots), table),
+            '        return NULL;',
+            '    return &%s[lo];' % table,
+        ])
+    else:
+        lines.extend([
+            '    uint32_t h1 = (uint32_t) ((uint32_t) address * %#010xU) >> %dU;' % (mult1, 32 - k1),
+            '    uint32_t h2 = (uint32_t) ((uint32_t) address * %#010xU) >> %dU;' % (mult2, 32 - k2),
+            '    uint32_t i = h2 ^ %sreg_displacements[h1];' % prefix,
+            '    if (%s[i].name == NULL || %s[i].address != address)' % (table, table),
+            '        return NULL;',
+            '    return &%s[i];' % table,
+        ])
+    lines.append('}')
+
+    return '\n'.join(lines)
+
+
+def shadow_entries(registers, reserved_regex='reserved|RESERVED|_'):
+    """
+    Compact description of registers for shadow_code() and frame_code(), list of
+    (name, [address, ...], reg_n, has_fields, cache_reads).
+    """
+    entries = []
+    for register in registers:
+        reg = register['reg']
+        address = register['address']
+        addresses = address if isinstance(address, list) else [address]
+        has_fields = any(not re.match(reserved_regex, name) for name in reg.names)
+        assert reg.n_bits <= 64, 'Shadow image supports registers up to 64 bits, %s has %d bits' \
+            % (register['name'], reg.n_bits)
+        entries.append((register['name'], [parse_address(a) for a in addresses],
+                        reg.get_reg_n(), has_fields, register.get('cache_reads', False)))
+    return entries
+
+
+def shadow_code(entries, prefix='', address_t='uint8_t', cpp=False):
+    """
+    Generate C/C++ code of a shadow image of device registers: one uintN_t slot
+    per address (N from Register.get_reg_n()) with dirty and valid bitmaps.
+
+    Setters `{prefix}shadow_set_NAME(shadow, [i,] reg)` only update the image and mark
+    the slot dirty if the value changed (or was not known), `{prefix}shadow_flush(shadow)`
+    writes all dirty slots using transport->write(), merging slots at adjacent addresses
+    into burst transactions. Getters `{prefix}shadow_read_NAME(shadow, [i,] &reg)` use
+    transport->read(), unless the register has "cache_reads" set and its value is known.
+
+    entries - as returned by shadow_entries()
+    cpp - whether to generate code for C++ (register structs with from_raw()/raw()) or for C
+    """
+    slots = []  # (address, name, instance or None)
+    owners = {}
+    for name, addresses, reg_n, has_fields, cache_reads in entries:
+        for i, address in enumerate(addresses):
+            assert address not in owners, 'Address %#04x of %s already used by %s' \
+                % (address, name, owners[address])
+            owners[address] = name
+            slots.append((address, name, i if len(addresses) > 1 else None))
+    assert slots, 'No registers to generate shadow image'
+    slots.sort()
+    slot_index = {(name, i): index for index, (address, name, i) in enumerate(slots)}
+
+    # longest run of adjacent addresses limits the size of a burst
+    max_burst = run = 1
+    for (a1, _, _), (a2, _, _) in zip(slots, slots[1:]):
+        run = run + 1 if a2 == a1 + 1 else 1
+        max_burst = max(max_burst, run)
+
+    word_t = 'uint64_t' if any(e[2] > 32 for e in entries) else 'uint32_t'
+    n_words = (len(slots) + 31) // 32
+    image_size = sum(e[2] // 8 * len(e[1]) for e in entries)
+    offset_t = 'uint16_t' if image_size < 2**16 else 'uint32_t'
+    slot_t = 'uint16_t' if len(slots) < 2**16 else 'uint32_t'
+    p = prefix
+    shadow = p + 'shadow'
+
+    lines = [
+        'typedef %s %sshadow_word;' % (word_t, p),
+        '',
+        'typedef struct %sshadow_transport {' % p,
+        '    // both return 0 on success, values are in order of increasing addresses',
+        '    int (*write)(void *ctx, %s address, const %sshadow_word *values, size_t count);' % (address_t, p),
+        '    int (*read)(void *ctx, %s address, %sshadow_word *values, size_t count);' % (address_t, p),
+        '    void *ctx;',
+        '} %sshadow_transport;' % p,
+        '',
+        'typedef struct %sshadow_image {' % p,
+    ]
+    for name, addresses, reg_n, has_fields, cache_reads in entries:
+        arr = '[%d]' % len(addresses) if len(addresses) > 1 else ''
+        lines.append('    uint%d_t %s%s;' % (reg_n, name, arr))
+    lines.extend([
+        '} %sshadow_image;' % p,
+        '',
+        'typedef struct %s {' % shadow,
+        '    %sshadow_image image;' % p,
+        '    uint32_t dirty[%d];' % n_words,
+        '    uint32_t valid[%d];' % n_words,
+        '    const %sshadow_transport *transport;' % p,
+        '} %s;' % shadow,
+        '',
+        'typedef struct %sshadow_slot {' % p,
+        '    %s address;' % address_t,
+        '    %s offset;' % offset_t,
+        '    uint8_t size;',
+        '} %sshadow_slot;' % p,
+        '',
+        'enum { %sSHADOW_N_SLOTS = %d, %sSHADOW_MAX_BURST = %d };' % (p, len(slots), p, max_burst),
+        '',
+        '// slots sorted by address',
+        'static const %sshadow_slot %sshadow_slots[%d] = {' % (p, p, len(slots)),
+    ])
+    for address, name, i in slots:
+        member = name if i is None else '%s[%d]' % (name, i)
+        lines.append('    {%#04x, offsetof(%sshadow_image, %s), sizeof(((%sshadow_image *) 0)->%s)},'
+                     % (address, p, member, p, member))
+    lines.extend([
+        '};',
+        '',
+        'static inline void %s_init(%s *s, const %sshadow_transport *transport) {' % (shadow, shadow, p),
+        '    for (size_t i = 0; i < %d; i++)' % n_words,
+        '        s->dirty[i] = s->valid[i] = 0;',
+        '    s->transport = transport;',
+        '}',
+        '',
+        '// forget all known values, e.g. after reset of the device',
+        'static inline void %s_invalidate(%s *s) {' % (shadow, shadow),
+        '    for (size_t i = 0; i < %d; i++)' % n_words,
+        '        s->dirty[i] = s->valid[i] = 0;',
+        '}',
+        '',
+        'static inline %sshadow_word %s_load(const %s *s, size_t slot) {' % (p, shadow, shadow),
+        '    const unsigned char *ptr = (const unsigned char *) &s->image + %sshadow_slots[slot].offset;' % p,
+        '    switch (%sshadow_slots[slot].size) {' % p,
+        '        case 1: return *(const uint8_t *) ptr;',
+        '        case 2: return *(const uint16_t *) ptr;',
+        '        case 4: return *(const uint32_t *) ptr;',
+        '        default: return *(const %s *) ptr;' % word_t,
+        '    }',
+        '}',
+        '',
+        '// write all dirty slots, returns 0 or the first error returned by transport->write()',
+        'static inline int %s_flush(%s *s) {' % (shadow, shadow),
+        '    %sshadow_word burst[%sSHADOW_MAX_BURST];' % (p, p),
+        '    size_t slot = 0;',
+        '    while (slot < %sSHADOW_N_SLOTS) {' % p,
+        '        if (!(s->dirty[slot / 32] & (1UL << (slot % 32)))) {',
+        '            slot++;',
+        '            continue;',
+        '        }',
+        '        size_t start = slot, count = 0;',
+        '        do {',
+        '            burst[count++] = %s_load(s, slot++);' % shadow,
+        '        } while (slot < %sSHADOW_N_SLOTS && (s->dirty[slot / 32] & (1UL << (slot %% 32)))' % p,
+        '                 && %sshadow_slots[slot].address == %sshadow_slots[slot - 1].address + 1);' % (p, p),
+        '        int err = s->transport->write(s->transport->ctx, %sshadow_slots[start].address, burst, count);' % p,
+        '        if (err)',
+        '            return err;',
+        '        for (size_t i = start; i < slot; i++)',
+        '            s->dirty[i / 32] &= ~(1UL << (i % 32));',
+        '    }',
+        '    return 0;',
+        '}',
+    ])
+
+    for name, addresses, reg_n, has_fields, cache_reads in entries:
+        reg_name = p + name
+        reg_t = 'uint%d_t' % reg_n
+        many = len(addresses) > 1
+        index_arg = ', size_t i' if many else ''
+        member = 's->image.%s%s' % (name, '[i]' if many else '')
+        if many:
+            slot_expr = 'slots[i]'
+            slot_table = ['    static const %s slots[%d] = {%s};' % (
+                slot_t, len(addresses), ', '.join(str(slot_index[(name, i)]) for i in range(len(addresses))))]
+        else:
+            slot_expr = '%d' % slot_index[(name, None)]
+            slot_table = []
+        call_index = 'i, ' if many else ''
+
+        lines.append('')
+        lines.append('static inline void %s_set_%s_raw(%s *s%s, %s raw) {' % (shadow, name, shadow, index_arg, reg_t))
+        lines.extend(slot_table)
+        lines.extend([
+            '    size_t slot = %s;' % slot_expr,
+            '    uint32_t bit = 1UL << (slot % 32);',
+            '    if ((s->valid[slot / 32] & bit) && %s == raw)' % member,
+            '        return;',
+            '    %s = raw;' % member,
+            '    s->valid[slot / 32] |= bit;',
+            '    s->dirty[slot / 32] |= bit;',
+            '}',
+            '',
+            'static inline int %s_read_%s_raw(%s *s%s, %s *raw) {' % (shadow, name, shadow, index_arg, reg_t),
+        ])
+        lines.extend(slot_table)
+        lines.append('    size_t slot = %s;' % slot_expr)
+        if cache_reads:
+            lines.extend([
+                '    uint32_t bit = 1UL << (slot % 32);',
+                '    if (s->valid[slot / 32] & bit) {',
+                '        *raw = %s;' % member,
+                '        return 0;',
+                '    }',
+            ])
+        lines.extend([
+            '    %sshadow_word value;' % p,
+            '    int err = s->transport->read(s->transport->ctx, %sshadow_slots[slot].address, &value, 1);' % p,
+            '    if (err)',
+            '        return err;',
+            '    *raw = (%s) value;' % reg_t,
+        ])
+        if cache_reads:
+            lines.extend([
+                '    if (!(s->dirty[slot / 32] & bit)) {',
+                '        %s = *raw;' % member,
+                '        s->valid[slot / 32] |= bit;',
+                '    }',
+            ])
+        lines.extend([
+            '    return 0;',
+            '}',
+        ])
+        if not has_fields:
+            continue
+        if cpp:
+            to_raw, from_raw = 'reg.raw()', '%s::from_raw(raw)' % reg_name
+        else:
+            to_raw, from_raw = '%s_RAW(reg)' % reg_name, '%s_FROM_RAW(raw)' % reg_name
+        lines.extend([
+            '',
+            'static inline void %s_set_%s(%s *s%s, %s reg) {' % (shadow, name, shadow, index_arg, reg_name),
+            '    %s_set_%s_raw(s, %s(%s) %s);' % (shadow, name, call_index, reg_t, to_raw),
+            '}',
+            '',
+            'static inline int %s_read_%s(%s *s%s, %s *reg) {' % (shadow, name, shadow, index_arg, reg_name),
+            '    %s raw;' % reg_t,
+            '    int err = %s_read_%s_raw(s, %s&raw);' % (shadow, name, call_index),
+            '    if (!err)',
+            '        *reg = %s;' % from_raw,
+            '    return err;',
+            '}',
+        ])
+
+    return '\n'.join(lines)
+
+
+def frame_code(entries, prefix='', address_t='uint8_t', cpp=False, addr_bytes=1, value_bytes=4,
+               byteorder='big'):
+    """
+    Generate C/C++ code packing (address, value) records directly into caller-provided
+    byte buffers of bus frames and unpacking them (same records as capture_record_struct(),
+    so frames are identical to the ones of pack_frame()).
+
+    `{prefix}frame_pack(buf, address, value)` writes a single record and returns pointer
+    past it, `{prefix}frame_pack_many(buf, records, count)` packs an array of records into
+    one contiguous frame and `{prefix}frame_pack_NAME(buf, [i,] reg)` packs a register
+    with its address. `{prefix}frame_unpack()`/`{prefix}frame_unpack_many()` read records back.
+
+    entries - as returned by shadow_entries()
+    cpp - whether to generate code for C++ (register structs with raw()) or for C
+    """
+    assert addr_bytes in _CAPTURE_INT_FORMATS and value_bytes in _CAPTURE_INT_FORMATS, \
+        'Address/value sizes must be one of %s bytes' % sorted(_CAPTURE_INT_FORMATS)
+    for name, addresses, reg_n, has_fields, cache_reads in entries:
+        assert reg_n <= value_bytes * 8, 'Register %s has %d bits, more than %d value bytes' \
+            % (name, reg_n, value_bytes)
+    p = prefix
+    word_t = 'uint64_t' if value_bytes > 4 else 'uint32_t'
+    # addresses are shifted in an unsigned type wide enough for all address bytes (and not promoted
+    # to int), address_t may be narrower, e.g. uint8_t register addresses in 4-byte bus addresses
+    addr_word_t = 'uint64_t' if addr_bytes > 4 else 'uint32_t'
+    record_bytes = addr_bytes + value_bytes
+
+    def shifts(n_bytes):
+        # shift of each byte in buffer order
+        order = range(n_bytes - 1, -1, -1) if byteorder == 'big' else range(n_bytes)
+        return [8 * k for k in order]
+
+    addr_shifts = list(enumerate(shifts(addr_bytes)))
+    value_shifts = [(addr_bytes + j, shift) for j, shift in enumerate(shifts(value_bytes))]
+
+    lines = [
+        'enum { %sFRAME_ADDR_BYTES = %d, %sFRAME_VALUE_BYTES = %d, %sFRAME_RECORD_BYTES = %d };  // %s endian'
+        % (p, addr_bytes, p, value_bytes, p, record_bytes, byteorder),
+        '',
+        'typedef %s %sframe_word;' % (word_t, p),
+        '',
+        'typedef struct %sframe_record {' % p,
+        '    %s address;' % address_t,
+        '    %sframe_word value;' % p,
+        '} %sframe_record;' % p,
+        '',
+        'static inline uint8_t *%sframe_pack(uint8_t *buf, %s address, %sframe_word value) {'
+        % (p, address_t, p),
+    ]
+    lines.extend('    buf[%d] = (uint8_t) ((%s) address >> %dU);' % (k, addr_word_t, shift) for k, shift in addr_shifts)
+    lines.extend('    buf[%d] = (uint8_t) (value >> %dU);' % (k, shift) for k, shift in value_shifts)
+    lines.extend([
+        '    return buf + %d;' % record_bytes,
+        '}',
+        '',
+        'static inline const uint8_t *%sframe_unpack(const uint8_t *buf, %s *address, %sframe_word *value) {'
+        % (p, address_t, p),
+        '    *address = (%s) (%s);' % (address_t, ' | '.join(
+            '((%s) buf[%d] << %dU)' % (addr_word_t, k, shift) for k, shift in addr_shifts)),
+        '    *value = %s;' % ' | '.join(
+            '((%sframe_word) buf[%d] << %dU)' % (p, k, shift) for k, shift in value_shifts),
+        '    return buf + %d;' % record_bytes,
+        '}',
+        '',
+        '// pack records into one contiguous frame, returns number of bytes written',
+        'static inline size_t %sframe_pack_many(uint8_t *buf, const %sframe_record *records, size_t count) {'
+        % (p, p),
+        '    uint8_t *ptr = buf;',
+        '    for (size_t i = 0; i < count; i++)',
+        '        ptr = %sframe_pack(ptr, records[i].address, records[i].value);' % p,
+        '    return (size_t) (ptr - buf);',
+        '}',
+        '',
+        '// unpack records from a frame of given size, returns number of records read',
+        'static inline size_t %sframe_unpack_many(const uint8_t *buf, size_t size, %sframe_record *records,'
+        ' size_t max_count) {' % (p, p),
+        '    size_t count = 0;',
+        '    for (; count < max_count && size >= %d; count++, size -= %d)' % (record_bytes, record_bytes),
+        '        buf = %sframe_unpack(buf, &records[count].address, &records[count].value);' % p,
+        '    return count;',
+        '}',
+    ])
+
+    for name, addresses, reg_n, has_fields, cache_reads in entries:
+        reg_name = p + name
+        reg_t = 'uint%d_t' % reg_n
+        many = len(addresses) > 1
+        index_arg = ', size_t i' if many else ''
+        call_index = 'i, ' if many else ''
+        lines.append('')
+        lines.append('static inline uint8_t *%sframe_pack_%s_raw(uint8_t *buf%s, %s raw) {'
+                     % (p, name, index_arg, reg_t))
+        if many:
+            lines.append('    static const %s addresses[%d] = {%s};' % (
+                address_t, len(addresses), ', '.join('%#04x' % a for a in addresses)))
+            address = 'addresses[i]'
+        else:
+            address = '%#04x' % addresses[0]
+        lines.extend([
+            '    return %sframe_pack(buf, %s, raw);' % (p, address),
+            '}',
+        ])
+        if not has_fields:
+            continue
+        to_raw = 'reg.raw()' if cpp else '%s_RAW(reg)' % reg_name
+        lines.extend([
+            '',
+            'static inline uint8_t *%sframe_pack_%s(uint8_t *buf%s, %s reg) {' % (p, name, index_arg, reg_name),
+            '    return %sframe_pack_%s_raw(buf, %s(%s) %s);' % (p, name, call_index, reg_t, to_raw),
+            '}',
+        ])
+
+    return '\n'.join(lines)
+
+
+_CAPTURE_INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+def capture_record_struct(addr_bytes=1, value_bytes=4, byteorder='big'):
+    """struct.Struct for a single (address, value) record of a binary capture."""
+    assert addr_bytes in _CAPTURE_INT_FORMATS and value_bytes in _CAPTURE_INT_FORMATS, \
+        'Address/value sizes must be one of %s bytes' % sorted(_CAPTURE_INT_FORMATS)
+    return struct.Struct('%s%s%s' % ('>' if byteorder == 'big' else '<',
+                                     _CAPTURE_INT_FORMATS[addr_bytes],
+                                     _CAPTURE_INT_FORMATS[value_bytes]))
+
+
+def read_capture(file_name, fmt='csv', start=0, end=None, **record_kwargs):
+    """
+    Generator of (address, value) transactions read from a capture file.
+
+    The file is mmap'ed so that only the part being processed has to be in memory.
+    fmt - 'csv': lines "ADDRESS,VALUE" (any int() literal, e.g. 0x30,0x11f05),
+                 lines not starting with a digit (headers, comments) are skipped
+          'bin': packed records, see capture_record_struct() for record_kwargs
+    start, end - byte range of the file to read (must be aligned to records/lines)
+    Raises ValueError for a csv line that is not ADDRESS,VALUE.
+    """
+    with open(file_name, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if fmt == 'bin':
+                record = capture_record_struct(**record_kwargs)
+                end -= (end - start) % record.size
+                with memoryview(mm) as view:
+                    with view[start:end] as chunk:
+                        yield from record.iter_unpack(chunk)
+                return
+            pos = start
+            while pos < end:
+                eol = mm.find(b'\n', pos, end)
+                if eol < 0:
+                    eol = end
+                line = mm[pos:eol].strip()
+                if line[:1].isdigit():
+                    try:
+                        address, value = line.split(b',')[:2]
+                        address, value = int(address, 0), int(value, 0)
+                    except ValueError:
+                        raise ValueError('%s: invalid capture line at offset %d: %r'
+                                         % (file_name, pos, line.decode(errors='replace'))) from None
+                    yield address, value
+                pos = eol + 1
+
+
+def pack_frame(records, buffer=None, offset=0, **record_kwargs):
+    """
+    Pack (address, value) records into a contiguous frame, the same as generated
+    frame_pack_many() (see frame_code(), record_kwargs as for capture_record_struct()).
+    Records are written directly into `buffer` (anything writable supporting the buffer
+    protocol, e.g. bytearray or memoryview of mmap) starting at `offset`, if no buffer
+    is given a new bytearray is allocated. Returns the buffer.
+    """
+    record = capture_record_struct(**record_kwargs)
+    if buffer is None:
+        records = list(records)
+        buffer = bytearray(offset + len(records) * record.size)
+    pos = offset
+    for address, value in records:
+        record.pack_into(buffer, pos, address, value)
+        pos += record.size
+    return buffer
+
+
+def unpack_frame(buffer, offset=0, count=None, **record_kwargs):
+    """
+    Generator of (address, value) records of a frame packed by pack_frame() or by
+    generated frame_pack() (without copying the buffer).
+    """
+    record = capture_record_struct(**record_kwargs)
+    with memoryview(buffer) as view:
+        end = len(view) if count is None else offset + count * record.size
+        end -= (end - offset) % record.size
+        with view[offset:end] as records:
+            yield from record.iter_unpack(records)
+
+
+def capture_chunks(file_name, chunk_size, fmt='csv', **record_kwargs):
+    """
+    Generator of (start, end) byte ranges splitting a capture file into chunks of
+    approximately chunk_size bytes, aligned to records (bin) or lines (csv).
+    """
+    size = os.path.getsize(file_name)
+    if fmt == 'bin':
+        record_size = capture_record_struct(**record_kwargs).size
+        chunk_size = max(record_size, chunk_size - chunk_size % record_size)
+        for start in range(0, size, chunk_size):
+            yield start, min(start + chunk_size, size)
+        return
+    if size == 0:
+        return
+    with open(file_name, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                eol = mm.find(b'\n', min(start + chunk_size, size) - 1)
+                end = size if eol < 0 else eol + 1
+                yield start, end
+                start = end
+
+
+def decode_transactions(transactions, index, reserved_regex='reserved|RESERVED|_'):
+    """
+    Generator turning (address, value) transactions into
+    (address, value, name, index, fields) where fields is a list of (field_name, field_value).
+    For addresses not found in the index (see address_index()) name is None.
+    """
+    layouts = {}
+    for address, value in transactions:
+        entry = index.get(address)
+        if entry is None:
+            yield address, value, None, None, []
+            continue
+        name, i, reg = entry
+        layout = layouts.get(name)
+        if layout is None:
+            layout = layouts[name] = reg.field_layout(reserved_regex)
+        yield address, value, name, i, [(f, (value >> shift) & mask) for f, shift, mask in layout]
+
+
+def format_transaction(address, value, name, i, fields):
+    """Single line, human-readable representation of a decoded transaction."""
+    if name is None:
+        return '0x%02x ? 0x%08x' % (address, value)
+    if i is not None:
+        name = '%s[%d]' % (name, i)
+    return ' '.join(['0x%02x %s 0x%08x' % (address, name, value)]
+                    + ['%s=%d' % field for field in fields])
+
+
+_decode_worker_index = None
+
+
+def _decode_worker_init(index):
+    global _decode_worker_index
+    _decode_worker_index = index
+
+
+def _decode_worker_chunk(args):
+    file_name, start, end, fmt, record_kwargs = args
+    transactions = read_capture(file_name, fmt, start, end, **record_kwargs)
+    return [format_transaction(*t) for t in decode_transactions(transactions, _decode_worker_index)]
+
+
+def decode_capture(file_name, registers, fmt='csv', jobs=1, chunk_size=16 * 2**20, **record_kwargs):
+    """
+    Generator of formatted lines for all transactions from a capture file.
+
+    registers - as returned by parse_regdef_json() or LazyRegisterMap (then only registers
+                found in the capture are parsed)
+    jobs - if > 1, the file is split into chunks of chunk_size bytes that are decoded
+           in a process pool, results are yielded in the original order
+    """
+    if isinstance(registers, LazyRegisterMap):
+        index = registers.address_index()
+    else:
+        index = address_index(registers)
+    if jobs <= 1:
+        transactions = read_capture(file_name, fmt, **record_kwargs)
+        for t in decode_transactions(transactions, index):
+            yield format_transaction(*t)
+        return
+
+    import multiprocessing
+    tasks = ((file_name, start, end, fmt, record_kwargs)
+             for start, end in capture_chunks(file_name, chunk_size, fmt, **record_kwargs))
+    with multiprocessing.Pool(jobs, initializer=_decode_worker_init, initargs=(index, )) as pool:
+        for lines in pool.imap(_decode_worker_chunk, tasks):
+            yield from lines
+
+
+class SnapshotDiff:
+    """
+    Field by field comparison of register snapshots (full register images dumped as
+    (address, value) records, in the same formats as capture files, see read_capture())
+    with a golden image.
+
+    Snapshots are kept as vectors aligned with sorted register addresses. Whole registers
+    are compared first with XOR against the golden image masked with precomputed masks
+    of non-reserved bits (for many snapshots at once with numpy if available), only the
+    registers that differ are decoded field by field.
+    Registers that are not in the golden image are not compared.
+    """
+
+    def __init__(self, registers, reserved_regex='reserved|RESERVED|_'):
+        """registers - as returned by parse_regdef_json() (or values of LazyRegisterMap)"""
+        index = address_index(registers)
+        self.addresses = sorted(index)
+        self.positions = {address: j for j, address in enumerate(self.addresses)}
+        self.entries = [index[address] for address in self.addresses]  # (name, index, reg)
+        layouts = {}
+        for name, i, reg in self.entries:
+            if name not in layouts:
+                layouts[name] = reg.field_layout(reserved_regex)
+        self.layouts = [layouts[name] for name, i, reg in self.entries]
+        masks = [sum(mask << shift for _, shift, mask in layout) for layout in self.layouts]
+        self.vectorized = np is not None and all(reg.n_bits <= 64 for _, _, reg in self.entries)
+        self.masks = np.array(masks, dtype=np.uint64) if self.vectorized else masks
+
+    def vector(self, transactions):
+        """
+        Snapshot from (address, value) transactions as (values, present) vectors aligned
+        with self.addresses. Unknown addresses are ignored, later values overwrite earlier ones.
+        """
+        values = [0] * len(self.addresses)
+        present = [False] * len(self.addresses)
+        positions = self.positions
+        for address, value in transactions:
+            j = positions.get(address)
+            if j is not None:
+                values[j] = value
+                present[j] = True
+        if self.vectorized:
+            return np.array(values, dtype=np.uint64), np.array(present, dtype=bool)
+        return values, present
+
+    def read(self, file_name, fmt='csv', **record_kwargs):
+        """Snapshot read from a file, see vector() and read_capture()."""
+        return self.vector(read_capture(file_name, fmt, **record_kwargs))
+
+    def changes(self, j, golden_value, value):
+        """List of (field, golden_value, value) of fields that differ in register at position j."""
+        golden_value, value = int(golden_value), int(value)
+        return [(field, (golden_value >> shift) & mask, (value >> shift) & mask)
+                for field, shift, mask in self.layouts[j]
+                if ((golden_value ^ value) >> shift) & mask]
+
+    def diff(self, golden, snapshots, batch_size=256):
+        """
+        Compare golden snapshot with many snapshots in a single pass.
+
+        golden - (values, present) as returned by vector()/read()
+        snapshots - iterable of (values, present), consumed lazily in batches of batch_size
+        Generator of (snapshot_index, address, name, index, changes) for each register
+        that differs, changes is a list of (field, golden_value, value) or None if the
+        register is missing in the snapshot.
+        """
+        golden_values, golden_present = golden
+        if not self.vectorized:
+            compared = [j for j, p in enumerate(golden_present) if p]
+            for k, (values, present) in enumerate(snapshots):
+                for j in compared:
+                    if not present[j]:
+                        yield (k, self.addresses[j]) + self.entries[j][:2] + (None, )
+                    elif (values[j] ^ golden_values[j]) & self.masks[j]:
+                        yield (k, self.addresses[j]) + self.entries[j][:2] \
+                            + (self.changes(j, golden_values[j], values[j]), )
+            return
+
+        snapshots = iter(snapshots)
+        first = 0
+        while True:
+            batch = [snapshot for _, snapshot in zip(range(batch_size), snapshots)]
+            if not batch:
+                return
+            values = np.stack([values for values, present in batch])
+            present = np.stack([present for values, present in batch])
+            differs = ((values ^ golden_values) & self.masks) != 0
+            # np.nonzero() returns indices in row-major order, so snapshots stay in order
+            rows, cols = np.nonzero((differs | ~present) & golden_present)
+            for k, j in zip(rows.tolist(), cols.tolist()):
+                if not present[k, j]:
+                    changes = None
+                else:
+                    changes = self.changes(j, golden_values[j], values[k, j])
+                yield (first + k, self.addresses[j]) + self.entries[j][:2] + (changes, )
+            first += len(batch)
+
+    def diff_files(self, golden_file, file_names, fmt='csv', **record_kwargs):
+        """diff() of snapshot files, yields (file_name, address, name, index, changes)."""
+        file_names = list(file_names)
+        golden = self.read(golden_file, fmt, **record_kwargs)
+        snapshots = (self.read(file_name, fmt, **record_kwargs) for file_name in file_names)
+        for k, address, name, i, changes in self.diff(golden, snapshots):
+            yield file_names[k], address, name, i, changes
+
+
+def format_diff(file_name, address, name, i, changes):
+    """Single line, human-readable representation of a register that differs from golden image."""
+    if i is not None:
+        name = '%s[%d]' % (name, i)
+    if changes is None:
+        return '%s 0x%02x %s missing' % (file_name, address, name)
+    return ' '.join(['%s 0x%02x %s' % (file_name, address, name)]
+                    + ['%s=%d->%d' % change for change in changes])
+
+
+class RegisterView:
+    """
+    Register of a RegisterBank at a single address. The raw value and fields (properties
+    of a subclass created for each layout, see RegisterBank.view_class()) are read from
+    and written to the buffer of the bank on every access. Fields with names of RegisterView
+    attributes (e.g. offset or raw) have no property, they are available as view['offset'].
+    """
+    __slots__ = ('name', 'address', 'offset', '_buffer', '_struct')
+    _fields = ()  # (name, shift, mask) of non-reserved fields
+    _layout = {}  # name -> (shift, mask) of non-reserved fields
+
+    def __init__(self, name, address, offset, buffer, value_struct):
+        self.name = name
+        self.address = address
+        self.offset = offset
+        self._buffer = buffer
+        self._struct = value_struct
+
+    @property
+    def raw(self):
+        return self._struct.unpack_from(self._buffer, self.offset)[0]
+
+    @raw.setter
+    def raw(self, value):
+        self._struct.pack_into(self._buffer, self.offset, value)
+
+    def fields(self):
+        """List of (name, value) of non-reserved fields."""
+        raw = self.raw
+        return [(name, (raw >> shift) & mask) for name, shift, mask in self._fields]
+
+    def __getitem__(self, name):
+        """Value of field by name."""
+        shift, mask = self._layout[name]
+        return (self.raw >> shift) & mask
+
+    def __setitem__(self, name, value):
+        self.update(**{name: value})
+
+    def update(self, **fields):
+        """Write many fields with a single read-modify-write of the buffer."""
+        raw = self.raw
+        for name, value in fields.items():
+            shift, mask = self._layout[name]
+            assert 0 <= value <= mask, 'value %d does not fit in field %s' % (value, name)
+            raw = (raw & ~(mask << shift)) | (value << shift)
+        self.raw = raw
+
+    def __repr__(self):
+        return '%s(%#04x: %s)' % (self.name, self.address,
+                                  ', '.join('%s=%d' % field for field in self.fields()))
+
+
+def _field_property(name, shift, mask):
+    def get(self):
+        return (self._struct.unpack_from(self._buffer, self.offset)[0] >> shift) & mask
+
+    def set(self, value):
+        assert 0 <= value <= mask, 'value %d does not fit in field %s' % (value, name)
+        raw = self._struct.unpack_from(self._buffer, self.offset)[0]
+        self._struct.pack_into(self._buffer, self.offset, (raw & ~(mask << shift)) | (value << shift))
+
+    return property(get, set, doc='Field %s (bits %d..%d)' % (name, shift, shift + mask.bit_length() - 1))
+
+
+class RegisterBank:
+    """
+    View of a whole register bank kept in a single buffer: bytearray (e.g. simulated chip),
+    mmap of a dump file or of /dev/mem, or any writable buffer, with attribute access
+    to registers and fields, e.g. bank.SW_MODE[1].sg_stop = 1 (registers with a list
+    of addresses are tuples of RegisterView, indexed as the list). Registers with names
+    of RegisterBank attributes are available only as bank['NAME'].
+
+    Value of register at `address` is `value_bytes` bytes at (address - base) * stride
+    in the buffer. Fields are read and written directly in the buffer using offsets,
+    shifts and masks precomputed once (views are created in __init__ and their classes
+    are shared by registers with the same layout), so an access does not create Register
+    objects or copy the buffer.
+    """
+
+    # layout -> {reserved_regex: RegisterView subclass}, kept only as long as the layout is used
+    _view_classes = weakref.WeakKeyDictionary()
+
+    def __init__(self, registers, buffer, stride=4, value_bytes=None, byteorder='little', base=0,
+                 reserved_regex='reserved|RESERVED|_'):
+        """registers - as returned by parse_regdef_json() (or values of LazyRegisterMap)"""
+        value_bytes = stride if value_bytes is None else value_bytes
+        assert value_bytes in _CAPTURE_INT_FORMATS, \
+            'Value size must be one of %s bytes' % sorted(_CAPTURE_INT_FORMATS)
+        self.buffer = memoryview(buffer).cast('B')
+        self.value_struct = struct.Struct('%s%s' % ('>' if byteorder == 'big' else '<',
+                                                    _CAPTURE_INT_FORMATS[value_bytes]))
+        self._mmap = None
+        self._registers = {}
+        for register in registers:
+            name, reg, address = register['name'], register['reg'], register['address']
+            assert reg.n_bits <= value_bytes * 8, 'Register %s has %d bits, more than %d value bytes' \
+                % (name, reg.n_bits, value_bytes)
+            view_class = self.view_class(reg, reserved_regex)
+            views = []
+            for a in (address if isinstance(address, list) else [address]):
+                a = parse_address(a)
+                offset = (a - base) * stride
+                assert 0 <= offset and offset + value_bytes <= len(self.buffer), \
+                    'Register %s at %#04x is outside of the buffer' % (name, a)
+                views.append(view_class(name, a, offset, self.buffer, self.value_struct))
+            self._registers[name] = tuple(views) if isinstance(address, list) else views[0]
+        # plain instance attributes are the fastest to look up
+        for name, views in self._registers.items():
+            if name not in self.__dict__ and not hasattr(type(self), name):
+                self.__dict__[name] = views
+
+    @classmethod
+    def open(cls, registers, file_name, writable=False, **kwargs):
+        """Bank mmap'ed from a file (e.g. a dump of registers), see close()."""
+        with open(file_name, 'r+b' if writable else 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        try:
+            bank = cls(registers, mm, **kwargs)
+        except Exception:
+            mm.close()
+            raise
+        bank._mmap = mm
+        return bank
+
+    @classmethod
+    def view_class(cls, reg, reserved_regex='reserved|RESERVED|_'):
+        """RegisterView subclass with field properties for the layout of given Register."""
+        view_classes = cls._view_classes.setdefault(reg.layout, {})
+        view_class = view_classes.get(reserved_regex)
+        if view_class is None:
+            fields = tuple(reg.field_layout(reserved_regex))
+            # fields must not replace slots and methods of the view, they are only in _layout then
+            attrs = {name: _field_property(name, shift, mask) for name, shift, mask in fields
+                     if not hasattr(RegisterView, name)}
+            attrs.update(__slots__=(), _fields=fields,
+                         _layout={name: (shift, mask) for name, shift, mask in fields})
+            view_class = view_classes[reserved_regex] = type('RegisterView', (RegisterView, ), attrs)
+        return view_class
+
+    def close(self):
+        """Release the buffer (and close the file of open()), views cannot be used after that."""
+        self.buffer.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, name):
+        return self._registers[name]
+
+    def __contains__(self, name):
+        return name in self._registers
+
+    def __iter__(self):
+        return iter(self._registers)
+
+    def __len__(self):
+        return len(self._registers)
+
+
+class RegisterServer:
+    """
+    Server answering requests about register maps loaded once, over a Unix socket using
+    line-delimited JSON (one request per line, responses in the same order, so requests
+    can be pipelined). Each client is handled by an asyncio task.
+
+    Requests ("id" is optional and copied to the response, "map" can be omitted
+    if only one map is loaded):
+      {"op": "decode", "map": "tmc5041", "address": "0x30", "value": 73477}
+        -> {"ok": true, "name": "IHOLD_IRUN", "index": 0, "fields": {"ihold": 5, ...}}
+      {"op": "encode", "register": "IHOLD_IRUN", "index": 1, "fields": {"irun": 31}}
+      (or "address" instead of "register" and "index")
+        -> {"ok": true, "address": 80, "value": 7936}
+      {"op": "maps"} -> {"ok": true, "maps": {"tmc5041": 33}}
+      {"op": "stats"} -> numbers of requests/errors/clients and request latency in us
+    Errors are reported as {"ok": false, "error": "..."}.
+    """
+
+    def __init__(self, regmaps, n_latencies=10000):
+        """regmaps - dict {name: LazyRegisterMap}"""
+        self.regmaps = regmaps
+        self.layouts = {}  # (map, register) -> field layout
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_clients = 0
+        self.n_connections = 0
+        self.ops = {}
+        self.latencies = collections.deque(maxlen=n_latencies)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.started = time.time()
+
+    @classmethod
+    def from_files(cls, regdef_files, **kwargs):
+        regmaps = {}
+        for regdef_file in regdef_files:
+            name = os.path.basename(regdef_file).split('.')[0]
+            assert name not in regmaps, 'Two register maps with the same name: %s' % name
+            regmaps[name] = LazyRegisterMap(regdef_file)
+        return cls(regmaps, **kwargs)
+
+    def regmap(self, request):
+        name = request.get('map')
+        if name is None:
+            if len(self.regmaps) != 1:
+                raise KeyError('"map" is required, one of: %s' % ', '.join(sorted(self.regmaps)))
+            name = next(iter(self.regmaps))
+        if name not in self.regmaps:
+            raise KeyError('No register map %s' % name)
+        return name, self.regmaps[name]
+
+    def layout(self, map_name, register):
+        key = (map_name, register['name'])
+        layout = self.layouts.get(key)
+        if layout is None:
+            layout = self.layouts[key] = register['reg'].field_layout()
+        return layout
+
+    def decode(self, request):
+        map_name, regmap = self.regmap(request)
+        address = parse_address(request['address'])
+        value = int(request['value'])
+        try:
+            register, i = regmap.lookup(address)
+        except KeyError:
+            raise KeyError('No register at address %#04x' % address) from None
+        return {
+            'name': register['name'],
+            'index': i,
+            'fields': {name: (value >> shift) & mask for name, shift, mask in self.layout(map_name, register)},
+        }
+
+    def encode(self, request):
+        map_name, regmap = self.regmap(request)
+        if 'address' in request:
+            address = parse_address(request['address'])
+            register, i = regmap.lookup(address)
+        else:
+            register = regmap[request['register']]
+            addresses = register['address']
+            if isinstance(addresses, list):
+                addresses = addresses[request.get('index', 0)]
+            address = parse_address(addresses)
+        layout = {name: (shift, mask) for name, shift, mask in self.layout(map_name, register)}
+        value = 0
+        for name, field_value in request.get('fields', {}).items():
+            if name not in layout:
+                raise KeyError('No field %s in register %s' % (name, register['name']))
+            shift, mask = layout[name]
+            if not 0 <= field_value <= mask:
+                raise ValueError('Value %d does not fit in field %s' % (field_value, name))
+            value |= field_value << shift
+        return {'address': address, 'value': value}
+
+    def stats(self, request):
+        return {
+            'uptime_s': time.time() - self.started,
+            'requests': self.n_requests,
+            'errors': self.n_errors,
+            'clients': self.n_clients,
+            'connections': self.n_connections,
+            'ops': self.ops,
+            'latency_us': _latency_stats(self.latencies, self.latency_total, self.n_requests, self.latency_max),
+        }
+
+    def maps(self, request):
+        return {'maps': {name: len(regmap) for name, regmap in self.regmaps.items()}}
+
+    def handle(self, line):
+        """Handle single request line, returns response line."""
+        start = time.perf_counter()
+        request = {}
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            op = request.get('op')
+            handler = {'decode': self.decode, 'encode': self.encode,
+                       'stats': self.stats, 'maps': self.maps}.get(op)
+            if handler is None:
+                raise ValueError('Unknown op: %s' % op)
+            self.ops[op] = self.ops.get(op, 0) + 1
+            response = {'ok': True}
+            response.update(handler(request))
+        except Exception as e:
+            self.n_errors += 1
+            message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+            response = {'ok': False, 'error': '%s: %s' % (type(e).__name__, message)}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        elapsed = time.perf_counter() - start
+        self.n_requests += 1
+        self.latencies.append(elapsed)
+        self.latency_total += elapsed
+        self.latency_max = max(self.latency_max, elapsed)
+        return json.dumps(response) + '\n'
+
+    async def handle_client(self, reader, writer):
+        self.n_clients += 1
+        self.n_connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(self.handle(line).encode())
+                # only waits if client does not keep up with reading responses
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.n_clients -= 1
+            writer.close()
+
+    async def serve(self, path):
+        """
+        Serve requests on Unix socket path. A socket left there (e.g. by a killed server) is
+        replaced, any other file is not touched and FileExistsError is raised.
+        """
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError('%s exists and is not a socket' % path)
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle_client, path=path, limit=2**20)
+        created = os.lstat(path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # only the socket created here, not a file put there since
+            if os.path.lexists(path):
+                current = os.lstat(path)
+                if stat.S_ISSOCK(current.st_mode) and (current.st_dev, current.st_ino) == (
+                        created.st_dev, created.st_ino):
+                    os.remove(path)
+
+
+def _latency_stats(latencies, total, count, maximum):
+    """Summary of latencies in seconds (deque of the recent ones) in us."""
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e6 if latencies else 0
+
+    return {
+        'mean': total * 1e6 / count if count else 0,
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'max': maximum * 1e6,
+    }
+
+
+class LoopbackTransport:
+    """
+    In-process transport of RegisterDevice for tests: register values are kept in a dict
+    (unknown addresses read as 0) or in a RegisterBank simulating the chip.
+    latency - seconds that each transaction takes (simulated round trip)
+    """
+
+    def __init__(self, bank=None, latency=0.0):
+        self.values = {}
+        if bank is not None:
+            for name in bank:
+                views = bank[name]
+                for view in (views if isinstance(views, tuple) else [views]):
+                    self.values[view.address] = view
+        self.bank = bank
+        self.latency = latency
+        self.n_transactions = 0
+
+    async def transact(self, ops):
+        self.n_transactions += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        results = []
+        for op, address, value in ops:
+            if self.bank is None:
+                if op == 'w':
+                    self.values[address] = value
+                results.append(self.values.get(address, 0) if op == 'r' else None)
+                continue
+            view = self.values.get(address)
+            if view is None:
+                raise KeyError('No register at address %#04x' % address)
+            if op == 'w':
+                view.raw = value
+            results.append(view.raw if op == 'r' else None)
+        return results
+
+
+class RegisterDevice:
+    """
+    Asynchronous access to registers of a device over a pluggable transport, e.g.
+    `reg = await dev.read('SW_MODE', 1)`, `await dev.write(reg, 1)`.
+
+    Requests are queued and all the requests made while the previous transaction is
+    in progress (or in the same event loop iteration) are sent in a single bulk
+    transaction of at most max_batch operations, up to max_in_flight transactions are
+    pipelined. Use asyncio.gather() to issue many requests at once.
+
+    Transport is any object with a coroutine `transact(ops)`, where ops is a list of
+    (op, address, value) with op 'r' (value None) or 'w', executed in order, returning
+    a list of read values (None for writes), see LoopbackTransport.
+    """
+
+    def __init__(self, registers, transport, max_batch=64, max_in_flight=1, n_latencies=10000):
+        """registers - LazyRegisterMap or registers as returned by parse_regdef_json()"""
+        if not isinstance(registers, collections.abc.Mapping):
+            registers = {register['name']: register for register in registers}
+        self.registers = registers
+        self.transport = transport
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self._pending = []  # (op, address, value, future, time of request)
+        self._flusher = None
+        self._in_flight = set()
+        self._slots = None
+        self.n_transactions = 0
+        self.n_ops = {'r': 0, 'w': 0}
+        self.n_errors = 0
+        self.busy = 0.0  # time with a transaction in progress
+        self._busy_since = None
+        self.transaction_latencies = collections.deque(maxlen=n_latencies)
+        self.request_latencies = collections.deque(maxlen=n_latencies)
+        self.latency_total = {'transaction': 0.0, 'request': 0.0}
+        self.latency_max = {'transaction': 0.0, 'request': 0.0}
+        self.started = time.perf_counter()
+
+    @classmethod
+    def from_file(cls, regdef_file, transport, **kwargs):
+        return cls(LazyRegisterMap(regdef_file), transport, **kwargs)
+
+    def address(self, name, i=None):
+        """Address of register (i-th of its address list)."""
+        address = self.registers[name]['address']
+        if isinstance(address, list):
+            assert i is not None, 'Register %s has %d addresses, index is required' % (name, len(address))
+            address = address[i]
+        else:
+            assert i is None or i == 0, 'Register %s has a single address' % name
+        return parse_address(address)
+
+    async def read_raw(self, address):
+        return await self._submit('r', address)
+
+    async def write_raw(self, address, value):
+        await self._submit('w', address, value)
+
+    async def read(self, name, i=None):
+        """Read register, returns a new Register with the value."""
+        value = await self.read_raw(self.address(name, i))
+        reg = copy.copy(self.registers[name]['reg'])
+        reg.set(value)
+        return reg
+
+    async def write(self, reg, i=None):
+        """Write value of Register `reg` to the register with its name."""
+        await self.write_raw(self.address(reg.name, i), reg.value)
+
+    async def flush(self):
+        """Wait until all the requests made so far are done."""
+        while self._pending or self._in_flight:
+            await asyncio.gather(*(list(self._in_flight) + ([self._flusher] if self._flusher else [])),
+                                 return_exceptions=True)
+
+    def _submit(self, op, address, value=None):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, address, value, future, time.perf_counter()))
+        if self._flusher is None or self._flusher.done():
+            # started in the next loop iteration, so requests made until then are batched
+            self._flusher = asyncio.ensure_future(self._flush())
+        return future
+
+    async def _flush(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        while self._pending:
+            await self._slots.acquire()
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            if not self._in_flight:
+                self._busy_since = time.perf_counter()
+            task = asyncio.ensure_future(self._transact(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(lambda task, batch=batch: self._transaction_done(task, batch))
+
+    def _transaction_done(self, task, batch):
+        # also called when the task is cancelled before it starts, when _transact() does not run at all
+        self._in_flight.discard(task)
+        self._slots.release()
+        for _, _, _, future, _ in batch:
+            future.cancel()  # no-op for resolved futures
+
+    async def _transact(self, batch):
+        start = time.perf_counter()
+        try:
+            results = await self.transport.transact([(op, address, value) for op, address, value, _, _ in batch])
+            assert len(results) == len(batch), 'Transport returned %d results for %d operations' \
+                % (len(results), len(batch))
+        except Exception as e:
+            self.n_errors += 1
+            for _, _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            end = time.perf_counter()
+            if len(self._in_flight) <= 1:
+                self.busy += end - self._busy_since
+                self._busy_since = end
+        self.n_transactions += 1
+        self._add_latency('transaction', self.transaction_latencies, end - start)
+        for (op, _, _, future, requested), result in zip(batch, results):
+            self.n_ops[op] += 1
+            self._add_latency('request', self.request_latencies, end - requested)
+            if not future.done():
+                future.set_result(result)
+
+    def _add_latency(self, kind, latencies, elapsed):
+        latencies.append(elapsed)
+        self.latency_total[kind] += elapsed
+        self.latency_max[kind] = max(self.latency_max[kind], elapsed)
+
+    def stats(self):
+        """Counters of transactions/operations, throughput and latencies (in us)."""
+        n_ops = self.n_ops['r'] + self.n_ops['w']
+        elapsed = time.perf_counter() - self.started
+        return {
+            'transactions': self.n_transactions,
+            'reads': self.n_ops['r'],
+            'writes': self.n_ops['w'],
+            'errors': self.n_errors,
+            'pending': len(self._pending),
+            'ops_per_transaction': n_ops / self.n_transactions if self.n_transactions else 0,
+            'ops_per_s': n_ops / elapsed if elapsed else 0,
+            'ops_per_busy_s': n_ops / self.busy if self.busy else 0,
+            'transactions_per_s': self.n_transactions / elapsed if elapsed else 0,
+            'transaction_latency_us': _latency_stats(self.transaction_latencies, self.latency_total['transaction'],
+                                                     self.n_transactions, self.latency_max['transaction']),
+            'request_latency_us': _latency_stats(self.request_latencies, self.latency_total['request'],
+                                                 n_ops, self.latency_max['request']),
+        }
 
 ################################################################################
 
@@ -560,54 +3552,541 @@ def test2():
         print(c)
 
 
+def iter_output(command, items, command_line=None):
+    """
+    Generator of chunks of the output of show/code command for (code, register)
+    items as yielded by iter_regdef_json().
+    command_line - if given, a header noting how the code has been generated is added
+    """
+    if command != 'show' and command_line is not None:
+        yield ('// This code has been auto-generated using command:\n'
+               + '//   %s\n' % command_line
+               + '// See: https://github.com/yendreij/regdef-py\n'
+               + '\n')
+    for code, register in items:
+        if command == 'show':
+            if register is not None:
+                yield 'ADDRESS = %s\n' % register['address'] + register['reg'].repr_long() + '\n'
+        else:
+            yield code + '\n' + ('\n' if not code.strip().startswith('//') else '')
+
+
+def render_output(command, code, registers, command_line=None):
+    """Assemble the output of show/code command from parse_regdef_json() results."""
+    if command == 'show':
+        items = ((None, register) for register in registers)
+    else:
+        items = ((c, None) for c in code)
+    return ''.join(iter_output(command, items, command_line))
+
+
+def _part_name(comment, default):
+    """File name friendly name of a section from its comment, e.g. '// Ramp Generator' -> ramp_generator."""
+    return re.sub(r'\W+', '_', comment.strip().lstrip('/')).strip('_').lower() or default
+
+
+def _defined_symbols(code):
+    """Names of macros, types and functions defined in generated code (for the include index)."""
+    code = re.sub(r'"[^"\n]*"', '""', code)
+    patterns = [
+        r'#define\s+(\w+)',
+        r'\b(?:struct|enum|union)\s+(\w+)\s*\{',
+        r'\}\s*(\w+)\s*;',
+        r'^static inline [^(=;]*?\b(\w+)\(',
+    ]
+    symbols = []
+    for pattern in patterns:
+        symbols.extend(m for m in re.findall(pattern, code, re.MULTILINE) if m not in symbols)
+    return symbols
+
+
+def write_split_output(items, output_file, split='section', command_line=None, cpp=True, timings=None):
+    """
+    Write generated code for (code, register) items as yielded by iter_regdef_json()
+    to many headers instead of a single one, so that code can include only what it uses
+    and a change of a register rebuilds only the code that includes its header.
+
+    split - 'section' for a header per //-comment section (code before the first comment
+            goes to 'registers') or 'register' for a header per register (code that is
+            not a register, e.g. dispatch table, goes to a header named after the comment
+            preceding it)
+    output_file - umbrella header including all the headers, which are written to a directory
+                  named after it (tmc5041_regdef.gen.hpp -> tmc5041_regdef.gen/), together with
+                  include-what-you-use mapping file (tmc5041_regdef.gen.imp) with symbols
+                  defined in each header
+    Headers that are not part of the output anymore are removed from the directory.
+    Files are written only if changed, the umbrella header is touched if any part has been
+    written (build systems see only its dependency). Returns list of written headers.
+    """
+    assert split in ['section', 'register'], 'Unknown split mode: %s' % split
+    timed = timings.phase if timings is not None else _no_phase
+    ext = '.hpp' if cpp else '.h'
+    part_dir = os.path.splitext(output_file)[0]
+    part_dir_name = os.path.basename(part_dir)
+    os.makedirs(part_dir, exist_ok=True)
+    header = ''
+    if command_line is not None:
+        header = ('// This code has been auto-generated using command:\n'
+                  + '//   %s\n' % command_line
+                  + '// See: https://github.com/yendreij/regdef-py\n'
+                  + '\n')
+
+    umbrella = []  # includes of all parts, with section comments
+    symbol_parts = {}  # symbol -> part, to include parts used by other parts (e.g. shadow image)
+    mapping = []  # (symbol, part) for include-what-you-use
+    used_names = set()
+    written = []
+
+    def new_part(name):
+        base, i = name, 1
+        while name in used_names:
+            i += 1
+            name = '%s_%d' % (base, i)
+        used_names.add(name)
+        umbrella.append('#include "%s/%s%s"' % (part_dir_name, name, ext))
+        return name
+
+    def write_part(name, codes):
+        code = '\n\n'.join(codes)
+        names = set(re.findall(r'\w+', re.sub(r'"[^"\n]*"', '""', code)))
+        deps = sorted(set(symbol_parts[n] for n in names if n in symbol_parts))
+        lines = [header + '#pragma once', '']
+        if deps:
+            lines.extend('#include "%s%s"' % (dep, ext) for dep in deps)
+            lines.append('')
+        part_file = os.path.join(part_dir, name + ext)
+        with timed('write'):
+            if write_if_changed(part_file, '\n'.join(lines) + code + '\n'):
+                written.append(part_file)
+        for symbol in _defined_symbols(code):
+            symbol_parts[symbol] = name
+            mapping.append((symbol, name))
+
+    part, codes = None, []
+    comment = None
+    for code, register in items:
+        if register is None and code.strip().startswith('//'):
+            umbrella.append(code.strip())
+            if split == 'section':
+                if part is not None:
+                    write_part(part, codes)
+                part, codes = new_part(_part_name(code, 'section')), []
+            else:
+                comment = code
+            continue
+        if split == 'section':
+            if part is None:
+                part = new_part('registers')
+            codes.append(code)
+        else:
+            if register is not None:
+                name = new_part(register['name'])
+            else:
+                name = new_part(_part_name(comment or '', 'support'))
+            comment = None
+            write_part(name, [code])
+    if part is not None:
+        write_part(part, codes)
+
+    with timed('write'):
+        lines = [header + '#pragma once', '', '// IWYU pragma: begin_exports']
+        lines += umbrella + ['// IWYU pragma: end_exports']
+        # code including the umbrella header has to be rebuilt when any part changes,
+        # so its modification time is updated even if it has the same contents
+        if not write_if_changed(output_file, '\n'.join(lines) + '\n') and written:
+            os.utime(output_file)
+        entries = ['  { "symbol": ["%s", "private", "\\"%s/%s%s\\"", "public"] }' % (symbol, part_dir_name, name, ext)
+                   for symbol, name in mapping]
+        write_if_changed(part_dir + '.imp', '[\n%s\n]\n' % ',\n'.join(entries))
+
+    current = set(name + ext for name in used_names)
+    for file_name in os.listdir(part_dir):
+        if file_name.endswith(ext) and file_name not in current:
+            os.remove(os.path.join(part_dir, file_name))
+    return written
+
+
+def find_regdef_files(paths, pattern='.regdef.json'):
+    """
+    Expand a list of files and directories into a sorted list of register description files.
+    Directories are searched recursively for files with names ending with `pattern`.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if name.endswith(pattern))
+        else:
+            files.append(path)
+    return sorted(set(files))
+
+
+def output_file_name(regdef_file, command, cpp=True):
+    """Output file name for a register description, e.g. tmc5041.regdef.json -> tmc5041_regdef.gen.hpp"""
+    base = os.path.basename(regdef_file)
+    if base.endswith('.json'):
+        base = base[:-len('.json')]
+    base = base.replace('.', '_')
+    if command == 'show':
+        return base + '.txt'
+    return base + ('.gen.hpp' if cpp else '.gen.h')
+
+
+def process_regdef_file(task):
+    """
+    Generate output for a single register description file and write it (if changed).
+    Used for processing many files in a process pool, so it never raises.
+    task - (command, regdef_file, output_file, cache_file, command_line, ccode_kwargs),
+           ccode_kwargs can contain timings=N to collect Timings with N slowest registers
+           and split=MODE to write code with write_split_output()
+    Returns (regdef_file, output_file, number of registers, error message or None, Timings or None).
+    """
+    command, regdef_file, output_file, cache_file, command_line, kwargs = task
+    kwargs = dict(kwargs)
+    n_slowest = kwargs.pop('timings', None)
+    split = kwargs.pop('split', None)
+    timings = Timings(n_slowest) if n_slowest else None
+    n_registers = 0
+
+    def count(items):
+        nonlocal n_registers
+        for item in items:
+            n_registers += item[1] is not None
+            yield item
+
+    try:
+        cache = CodeCache(cache_file) if cache_file else None
+        items = count(iter_regdef_json(regdef_file, cache=cache, timings=timings, **kwargs))
+        if split and command == 'code':
+            write_split_output(items, output_file, split, command_line, kwargs.get('cpp', True), timings)
+        else:
+            write_chunks_if_changed(output_file, iter_output(command, items, command_line), timings=timings)
+        if cache is not None:
+            cache.save()
+        return regdef_file, output_file, n_registers, None, timings
+    except Exception as e:
+        return regdef_file, output_file, 0, '%s: %s' % (type(e).__name__, e), timings
+
+
+def process_regdef_files(command, regdef_files, output_dir, cache_dir=None,
+                         command_line=None, jobs=None, **kwargs):
+    """
+    Generator processing many register description files in a process pool, writing
+    outputs to output_dir. Yields results of process_regdef_file() in the order of
+    regdef_files, so that the output does not depend on number of jobs.
+    """
+    tasks = []
+    for regdef_file in regdef_files:
+        output_file = os.path.join(output_dir, output_file_name(regdef_file, command, kwargs.get('cpp', True)))
+        cache_file = os.path.join(cache_dir, os.path.basename(output_file) + '.cache') if cache_dir else None
+        tasks.append((command, regdef_file, output_file, cache_file, command_line, kwargs))
+    outputs = [task[2] for task in tasks]
+    assert len(set(outputs)) == len(outputs), 'Some files would have the same output file names'
+
+    if jobs == 1 or len(tasks) <= 1:
+        yield from map(process_regdef_file, tasks)
+        return
+
+    import multiprocessing
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(process_regdef_file, tasks)
+
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(
         description='Generates code/shows registers map defined in JSON file.'
         + ' Code requires C99/C++20.')
-    parser.add_argument('command', choices=['show', 'code'],
+    parser.add_argument('command', choices=['show', 'code', 'check', 'decode', 'diff', 'compile', 'serve',
+                                            'import-svd'],
                         help='Either show parsed, human-readable registers description,'
-                        + ' or generate code')
+                        + ' generate code, check the map for overlapping fields and colliding addresses,'
+                        + ' decode transactions from a capture file (see -i),'
+                        + ' compare register snapshots with a golden one (see --golden, --dumps),'
+                        + ' compile register description to binary .regdb file for fast loading'
+                        + ' serve decode/encode requests on a Unix socket (see --socket)'
+                        + ' or convert CMSIS-SVD files to register description json')
     parser.add_argument('-C', action='store_true',
                         help='Generated C code instead of C++')
     parser.add_argument('-c', '--no-comments', action='store_true',
                         help='Do not add keys starting with // to generated code')
     parser.add_argument('-p', '--prefix', default='',
                         help='Prefix string for the generated code')
-    parser.add_argument('-n', '--n-bits', nargs=1, default=32, type=int,
-                        help='Number of bits used for uintN_t variables for register type')
+    parser.add_argument('-n', '--n-bits', default=32, type=int,
+                        help='Number of bits used for uintN_t variables for register type,'
+                        + ' wider registers are arrays of N-bit words')
+    parser.add_argument('-d', '--dispatch', choices=['auto', 'dense', 'sorted', 'hash'],
+                        help='Generate address dispatch table with given layout'
+                        + ' (auto: chosen depending on how sparse the addresses are)')
+    parser.add_argument('-s', '--shadow', action='store_true',
+                        help='Generate shadow image of registers with dirty tracking and burst flush')
+    parser.add_argument('--frame', action='store_true',
+                        help='Generate routines packing registers into bus frame buffers as records'
+                        + ' of address and value (see --addr-bytes, --value-bytes, --byteorder)')
+    parser.add_argument('--helpers', action='store_true',
+                        help='Generate helpers getting/setting single fields directly in raw register values')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Generate struct and conversions once for registers with the same fields,'
+                        + ' the other registers are aliases with own addresses')
+    parser.add_argument('--check', action='store_true',
+                        help='Check the register maps (as check command does) before generating code'
+                        + ' and stop if there are any errors')
+    parser.add_argument('--max-bits', type=int,
+                        help='For check report fields above this bit width (or "reg_n" of the register)')
+    parser.add_argument('--address-bits', type=int,
+                        help='For check registers occupy ceil(n_bits / ADDRESS_BITS) addresses'
+                        + ' (e.g. 8 for byte addressed memory), by default a single one')
+    parser.add_argument('--gaps', action='store_true',
+                        help='For check report also bits not in any field and unused addresses')
     parser.add_argument('-o', '--output-file', required=False,
                         help='Write output to a file')
-    parser.add_argument('regdef', help='Register description json file')
+    parser.add_argument('--split', choices=['section', 'register'],
+                        help='Write code as a header per // section or per register to a directory'
+                        + ' named after the output file, which becomes an umbrella header including them'
+                        + ' (see write_split_output())')
+    parser.add_argument('-O', '--output-dir', required=False,
+                        help='Write outputs for all given register description files to this directory'
+                        + ' (e.g. tmc5041.regdef.json -> tmc5041_regdef.gen.hpp)')
+    parser.add_argument('--cache', required=False,
+                        help='Cache file for parsed registers and generated code,'
+                        + ' only registers that changed are generated again'
+                        + ' (with --output-dir it is a directory for cache files)')
+    parser.add_argument('--regdb', action='store_true',
+                        help='For show/decode load registers from compiled .regdb file next to the JSON'
+                        + ' file (compiled again if missing or stale), .regdb files can also be given directly')
+    parser.add_argument('-i', '--input', required=False,
+                        help='Capture file with (address, value) transactions for decode command')
+    parser.add_argument('-g', '--golden', required=False,
+                        help='Golden register snapshot for diff command (same format as capture files)')
+    parser.add_argument('--dumps', nargs='+', default=[],
+                        help='Register snapshots compared with the golden one by diff command')
+    parser.add_argument('-f', '--format', choices=['csv', 'bin'], default='csv',
+                        help='Format of the capture/snapshot files: "ADDRESS,VALUE" lines'
+                        + ' or packed binary records (see --addr-bytes, --value-bytes, --byteorder)')
+    parser.add_argument('--addr-bytes', type=int, default=1,
+                        help='Size of address in binary capture records and frames')
+    parser.add_argument('--value-bytes', type=int, default=4,
+                        help='Size of value in binary capture records and frames')
+    parser.add_argument('--byteorder', choices=['big', 'little'], default='big',
+                        help='Byte order of binary capture records and frames')
+    parser.add_argument('--socket', default='regdef.sock',
+                        help='Unix socket path for serve command (line-delimited JSON requests,'
+                        + ' see RegisterServer)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of processes used to process many files (default: number of CPUs)'
+                        + ' or to decode capture in chunks (default: 1)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print wall time and number of calls of each phase and the slowest'
+                        + ' registers to stderr')
+    parser.add_argument('--slowest', type=int, default=10, metavar='N',
+                        help='Number of the slowest registers reported with --timings')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile with cProfile, dump stats to FILE (for pstats) and print'
+                        + ' the top functions to stderr (only the main process is profiled)')
+    parser.add_argument('regdef', nargs='+',
+                        help='Register description json file(s) or CMSIS-SVD *.svd files, or directories'
+                        + ' with *.regdef.json files (*.svd for import-svd, many files require --output-dir)')
     args = parser.parse_args()
 
-    code, registers = parse_regdef_json(args.regdef, reg_n=args.n_bits,
-                                        comments=not args.no_comments,
-                                        prefix=args.prefix, cpp=not args.C)
-
-    out = io.StringIO()
-
-    if args.command == 'show':
-        for register in registers:
-            out.write('ADDRESS = %s\n' % register['address'])
-            out.write(register['reg'].repr_long() + '\n')
+    timings = Timings(args.slowest) if args.timings else None
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        run(parser, args, timings)
+    finally:
+        if profiler is not None:
+            import pstats
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        if timings is not None:
+            timings.add('total', time.perf_counter() - start)
+            print(timings.report(), file=sys.stderr)
+
+
+def run(parser, args, timings=None):
+    """Run the command given by parsed command line arguments."""
+    timed = timings.phase if timings is not None else _no_phase
+    frame = dict(addr_bytes=args.addr_bytes, value_bytes=args.value_bytes, byteorder=args.byteorder)
+    kwargs = dict(reg_n=args.n_bits, comments=not args.no_comments, dispatch=args.dispatch,
+                  shadow=args.shadow, frame=frame if args.frame else None, dedup=args.dedup,
+                  prefix=args.prefix, cpp=not args.C, helpers=args.helpers)
+
+    regdef_files = find_regdef_files(args.regdef, '.svd' if args.command == 'import-svd' else '.regdef.json')
+    if args.command == 'check' or args.check:
+        # as a pre-pass of another command problems go to stderr, not to the generated output
+        if args.command != 'check':
+            out = sys.stderr
+        elif args.output_file:
+            out = open(args.output_file, 'w')
+        else:
+            out = sys.stdout
+        n_errors = 0
+        for regdef_file in regdef_files:
+            problems = check_regdef_json(regdef_file, max_bits=args.max_bits,
+                                         address_bits=args.address_bits, gaps=args.gaps)
+            if timings is not None:
+                problems = timings.iter('check', problems)
+            for kind, name, message in problems:
+                n_errors += kind in CHECK_ERRORS
+                out.write('%s: %s: %s%s\n' % (regdef_file, kind, '%s: ' % name if name else '', message))
+        if out is not sys.stdout and out is not sys.stderr:
+            out.close()
+        if n_errors or args.command == 'check':
+            print('%d errors in %d files' % (n_errors, len(regdef_files)), file=sys.stderr)
+            sys.exit(1 if n_errors else 0)
+
+    if args.command == 'import-svd':
+        if len(regdef_files) != 1 and not args.output_dir:
+            parser.error('many SVD files require --output-dir')
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+        for svd_file in regdef_files:
+            chunks = iter_json_chunks(iter_svd(svd_file))
+            if timings is not None:
+                chunks = timings.iter('svd', chunks)
+            if args.output_dir:
+                json_file = os.path.splitext(os.path.basename(svd_file))[0] + '.regdef.json'
+                write_chunks_if_changed(os.path.join(args.output_dir, json_file), chunks, timings=timings)
+            elif args.output_file:
+                write_chunks_if_changed(args.output_file, chunks, timings=timings)
+            else:
+                for chunk in chunks:
+                    sys.stdout.write(chunk)
+        return
+
+    if args.command == 'serve':
+        server = RegisterServer.from_files(regdef_files)
+        print('Serving %s on %s' % (', '.join(sorted(server.regmaps)), args.socket), file=sys.stderr)
+        try:
+            asyncio.run(server.serve(args.socket))
+        except KeyboardInterrupt:
+            pass
+        except FileExistsError as e:
+            parser.error(str(e))
+        return
+
+    if args.command == 'compile':
+        if args.output_file and len(regdef_files) != 1:
+            parser.error('--output-file can be used only with a single file')
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+        for regdef_file in regdef_files:
+            regdb_file = args.output_file or regdb_file_name(regdef_file)
+            if args.output_dir:
+                regdb_file = os.path.join(args.output_dir, os.path.basename(regdb_file))
+            with timed('compile'):
+                compile_regdb(regdef_file, regdb_file)
+        return
+
+    if args.output_dir:
+        if args.command in ['decode', 'diff']:
+            parser.error('--output-dir cannot be used with %s' % args.command)
+        if args.cache:
+            os.makedirs(args.cache, exist_ok=True)
+        os.makedirs(args.output_dir, exist_ok=True)
+        results = process_regdef_files(args.command, regdef_files, args.output_dir,
+                                       cache_dir=args.cache, command_line=' '.join(sys.argv),
+                                       jobs=args.jobs, timings=args.slowest if args.timings else None,
+                                       split=args.split, **kwargs)
+        n_failed = 0
+        for regdef_file, output_file, n_registers, error, file_timings in results:
+            if timings is not None and file_timings is not None:
+                timings.merge(file_timings)
+            if error is None:
+                print('OK    %s -> %s (%d registers)' % (regdef_file, output_file, n_registers),
+                      file=sys.stderr)
+            else:
+                n_failed += 1
+                print('FAIL  %s: %s' % (regdef_file, error), file=sys.stderr)
+        print('%d files processed, %d failed' % (len(regdef_files), n_failed), file=sys.stderr)
+        sys.exit(1 if n_failed else 0)
+
+    if len(regdef_files) != 1:
+        parser.error('many register description files require --output-dir')
+    regdef_file = regdef_files[0]
+
+    registers = None
+    if args.regdb or regdef_file.endswith('.regdb'):
+        if args.command == 'code':
+            parser.error('code command requires JSON register description')
+        with timed('regdb'):
+            try:
+                db = load_regdb(regdef_file)
+            except (FileNotFoundError, ValueError) as e:
+                parser.error(str(e))
+            with db:
+                registers = db.registers()
+
+    if args.command == 'diff':
+        if not args.golden or not args.dumps:
+            parser.error('diff requires golden snapshot (-g/--golden) and snapshots to compare (--dumps)')
+        if registers is None:
+            with timed('json'):
+                registers = list(LazyRegisterMap(regdef_file).values())
+        snapshot_diff = SnapshotDiff(registers)
+        differences = snapshot_diff.diff_files(args.golden, args.dumps, fmt=args.format,
+                                               addr_bytes=args.addr_bytes, value_bytes=args.value_bytes,
+                                               byteorder=args.byteorder)
+        if timings is not None:
+            differences = timings.iter('diff', differences)
+        differ = set()
+        with (open(args.output_file, 'w') if args.output_file else contextlib.nullcontext(sys.stdout)) as out:
+            for difference in differences:
+                differ.add(difference[0])
+                with timed('write'):
+                    out.write(format_diff(*difference) + '\n')
+        print('%d of %d snapshots differ from %s' % (len(differ), len(args.dumps), args.golden),
+              file=sys.stderr)
+        sys.exit(1 if differ else 0)
+
+    if args.command == 'decode':
+        if not args.input:
+            parser.error('decode requires capture file (-i/--input)')
+        if registers is None:
+            # only registers that appear in the capture are parsed
+            with timed('json'):
+                registers = LazyRegisterMap(regdef_file)
+        lines = decode_capture(args.input, registers, fmt=args.format, jobs=args.jobs or 1,
+                               addr_bytes=args.addr_bytes, value_bytes=args.value_bytes,
+                               byteorder=args.byteorder)
+        if timings is not None:
+            lines = timings.iter('decode', lines)
+        with (open(args.output_file, 'w') if args.output_file else contextlib.nullcontext(sys.stdout)) as out:
+            for line in lines:
+                with timed('write'):
+                    out.write(line + '\n')
+        return
+
+    # stream the output, so that memory usage does not depend on size of register map
+    cache = CodeCache(args.cache) if args.cache else None
+    command_line = ' '.join(sys.argv) if args.output_file else None
+    if registers is not None:
+        items = ((None, register) for register in registers)
     else:
-        if args.output_file:
-            out.write('// This code has been auto-generated using command:\n')
-            out.write('//   %s\n' % ' '.join(sys.argv))
-            out.write('// See: https://github.com/yendreij/regdef-py\n')
-            out.write('\n')
-        for c in code:
-            out.write(c + '\n')
-            if not c.strip().startswith('//'):
-                out.write('\n')
-
-    if args.output_file:
-        with open(args.output_file, 'w') as f:
-            f.write(out.getvalue())
+        items = iter_regdef_json(regdef_file, cache=cache, timings=timings, **kwargs)
+    chunks = iter_output(args.command, items, command_line)
+
+    if args.split:
+        if args.command != 'code' or not args.output_file:
+            parser.error('--split requires code command and output file (-o)')
+        write_split_output(items, args.output_file, args.split, command_line, cpp=not args.C, timings=timings)
+    elif args.output_file:
+        # do not touch the file if nothing changed to avoid needless rebuilds
+        write_chunks_if_changed(args.output_file, chunks, timings=timings)
     else:
-        sys.stdout.write(out.getvalue())
+        for chunk in chunks:
+            with timed('write'):
+                sys.stdout.write(chunk)
+
+    if cache is not None:
+        with timed('cache'):
+            cache.save()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the generated conversion code: bitfield structs with FROM_RAW/RAW
+(Register.ccode()) against #define/constexpr masks (Register.code_masks()).
+
+For each register map, compiler and optimisation level the same conversion
+(raw -> fields -> raw) is compiled for both styles, the results are checked to be
+equal and the time per conversion and object code size are compared.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import regdef
+from bench_generator import synthetic_regdef_file
+
+
+def load_registers(file_name):
+    """List of (name, address, Register) with at least one non-reserved field and at most 32 bits."""
+    code, registers = regdef.parse_regdef_json(file_name, comments=False)
+    result = []
+    for register in registers:
+        reg = register['reg']
+        if reg.field_layout() and reg.n_bits <= 32:
+            address = register['address']
+            result.append((register['name'], address[0] if isinstance(address, list) else address, reg))
+    return result
+
+
+def conversion_source(registers, style, cpp):
+    """Source of conv_<style>_<NAME>(raws, n) functions for all registers."""
+    lines = []
+    for name, address, reg in registers:
+        fields = [field for field, shift, mask in reg.field_layout()]
+        lines.append('uint32_t conv_%s_%s(const uint32_t *raws, size_t n) {' % (style, name))
+        lines.append('    uint32_t acc = 0;')
+        lines.append('    for (size_t i = 0; i < n; i++) {')
+        if style == 'bitfield':
+            if cpp:
+                lines.append('        %s r = %s::from_raw(raws[i]);' % (name, name))
+                raw = 'r.raw()'
+            else:
+                lines.append('        %s r = %s_FROM_RAW(raws[i]);' % (name, name))
+                raw = '%s_RAW(r)' % name
+            values = ['(uint32_t) r.%s' % field for field in fields]
+        else:
+            lines.append('        uint32_t raw = raws[i];')
+            masks = ['%s_%s_MASK' % (name, field.upper()) for field in fields]
+            values = ['((raw & %s) >> %s_%s_POS)' % (mask, name, field.upper())
+                      for mask, field in zip(masks, fields)]
+            raw = '(%s)' % ' | '.join('(raw & %s)' % mask for mask in masks)
+        lines.append('        acc += (uint32_t) %s ^ (%s);' % (raw, ' + '.join(values)))
+        lines.append('    }')
+        lines.append('    return acc;')
+        lines.append('}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def main_source(registers):
+    """Source of the benchmark driver, prints "STYLE NS_PER_CONVERSION CHECKSUM" lines."""
+    lines = [
+        '#include <stdio.h>',
+        '#include <stdlib.h>',
+        '#include <stdint.h>',
+        '#include <stddef.h>',
+        '#include <time.h>',
+        '',
+        'typedef uint32_t (*conv_fn)(const uint32_t *raws, size_t n);',
+    ]
+    for style in ['bitfield', 'masks']:
+        lines.extend('uint32_t conv_%s_%s(const uint32_t *raws, size_t n);' % (style, name)
+                     for name, address, reg in registers)
+        lines.append('static const conv_fn %s_fns[] = {' % style)
+        lines.extend('    conv_%s_%s,' % (style, name) for name, address, reg in registers)
+        lines.append('};')
+    lines.append("""
+#define N_FNS (sizeof(bitfield_fns) / sizeof(bitfield_fns[0]))
+#define N_RAWS 1024
+
+static double now(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+static volatile uint32_t sink;
+
+static void run(const char *style, const conv_fn *fns, const uint32_t *raws, double min_time) {
+    uint32_t checksum = 0;
+    for (size_t f = 0; f < N_FNS; f++)
+        checksum += fns[f](raws, N_RAWS);
+    for (size_t repeat = 1; ; repeat *= 2) {
+        uint32_t acc = 0;
+        double start = now();
+        for (size_t r = 0; r < repeat; r++)
+            for (size_t f = 0; f < N_FNS; f++)
+                acc += fns[f](raws, N_RAWS);
+        double elapsed = now() - start;
+        sink = acc;
+        if (elapsed >= min_time) {
+            printf("%s %.4f %u\\n", style, elapsed * 1e9 / ((double) repeat * N_FNS * N_RAWS), checksum);
+            return;
+        }
+    }
+}
+
+int main(int argc, char **argv) {
+    static uint32_t raws[N_RAWS];
+    uint32_t x = 2463534242u;
+    for (size_t i = 0; i < N_RAWS; i++) {
+        x ^= x << 13; x ^= x >> 17; x ^= x << 5;
+        raws[i] = x;
+    }
+    double min_time = argc > 1 ? atof(argv[1]) : 0.2;
+    run("bitfield", bitfield_fns, raws, min_time);
+    run("masks", masks_fns, raws, min_time);
+    return 0;
+}""")
+    return '\n'.join(lines)
+
+
+def write_sources(build_dir, map_name, registers, cpp):
+    """Write generated headers and benchmark sources, returns (conversion sources, main source)."""
+    ext = 'cpp' if cpp else 'c'
+    hdr = 'hpp' if cpp else 'h'
+    sources = []
+    for style in ['bitfield', 'masks']:
+        if style == 'bitfield':
+            code = [reg.ccode(address, cpp=cpp) for name, address, reg in registers]
+        else:
+            code = [reg.code_masks(address, cpp=cpp) for name, address, reg in registers]
+        header = '%s_%s.gen.%s' % (map_name, style, hdr)
+        with open(os.path.join(build_dir, header), 'w') as fp:
+            fp.write('\n\n'.join(code) + '\n')
+        includes = ['#include <stdint.h>', '#include <stddef.h>']
+        if cpp:
+            includes += ['namespace regs {', '#include "%s"' % header, '}', 'using namespace regs;']
+        else:
+            includes += ['#include "%s"' % header]
+        source = os.path.join(build_dir, '%s_%s.%s' % (map_name, style, ext))
+        with open(source, 'w') as fp:
+            fp.write('\n'.join(includes) + '\n\n' + conversion_source(registers, style, cpp))
+        sources.append(source)
+    main = os.path.join(build_dir, '%s_main.%s' % (map_name, ext))
+    with open(main, 'w') as fp:
+        fp.write(main_source(registers) + '\n')
+    return sources, main
+
+
+def text_size(obj):
+    """Size of .text section(s) of an object file."""
+    out = subprocess.check_output(['size', obj], universal_newlines=True)
+    return int(out.splitlines()[1].split()[0])
+
+
+def run_benchmark(build_dir, map_name, registers, compilers, opt_levels, min_time):
+    """Yields result dicts for each compiler and optimisation level."""
+    for compiler in compilers:
+        cpp = compiler.endswith('++')
+        sources, main = write_sources(build_dir, map_name, registers, cpp)
+        std = '-std=c++2a' if cpp else '-std=gnu99'
+        for opt in opt_levels:
+            flags = [compiler, std, opt, '-w', '-I', build_dir]
+            objs = []
+            for source in sources + [main]:
+                obj = '%s.%s.o' % (source, opt[1:])
+                subprocess.check_call(flags + ['-c', source, '-o', obj])
+                objs.append(obj)
+            exe = os.path.join(build_dir, '%s_%s_%s' % (map_name, compiler.replace('+', 'x'), opt[1:]))
+            subprocess.check_call(flags + objs + ['-o', exe])
+            out = subprocess.check_output([exe, str(min_time)], universal_newlines=True)
+            times = {}
+            checksums = set()
+            for line in out.splitlines():
+                style, ns, checksum = line.split()
+                times[style] = float(ns)
+                checksums.add(checksum)
+            assert len(checksums) == 1, 'Styles give different results for %s %s %s' \
+                % (map_name, compiler, opt)
+            yield {
+                'map': map_name, 'registers': len(registers), 'compiler': compiler, 'opt': opt,
+                'bitfield_ns': times['bitfield'], 'masks_ns': times['masks'],
+                'bitfield_size': text_size(objs[0]), 'masks_size': text_size(objs[1]),
+            }
+
+
+def print_table(results, out=sys.stdout):
+    header = '{:<16} {:>5} {:<4} {:<4} {:>12} {:>9} {:>6} {:>12} {:>10} {:>6}'.format(
+        'map', 'regs', 'cc', 'opt', 'bitfield ns', 'masks ns', 'ratio',
+        'bitfield B', 'masks B', 'ratio')
+    print(header, file=out)
+    print('-' * len(header), file=out)
+    for r in results:
+        print('{map:<16} {registers:>5} {compiler:<4} {opt:<4} {bitfield_ns:>12.3f} {masks_ns:>9.3f}'
+              ' {t_ratio:>6.2f} {bitfield_size:>12} {masks_size:>10} {s_ratio:>6.2f}'.format(
+                  t_ratio=r['bitfield_ns'] / r['masks_ns'],
+                  s_ratio=r['bitfield_size'] / r['masks_size'], **r), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('regdef', nargs='*', default=['tmc5041.regdef.json'],
+                        help='Register description files to benchmark')
+    parser.add_argument('-s', '--synthetic', type=int, default=500,
+                        help='Number of registers of the synthetic map (0 to skip)')
+    parser.add_argument('--cc', nargs='+', default=['gcc', 'g++'],
+                        help='Compilers (ones ending with ++ compile C++ code)')
+    parser.add_argument('-O', '--opt', nargs='+', default=['0', '2', 's'],
+                        help='Optimisation levels (used as -O<OPT>)')
+    parser.add_argument('-t', '--min-time', type=float, default=0.2,
+                        help='Minimal measurement time for each style in seconds')
+    parser.add_argument('-b', '--build-dir', default='bench_build',
+                        help='Directory for generated sources and binaries')
+    parser.add_argument('--json', help='Also write results to this JSON file')
+    args = parser.parse_args()
+
+    os.makedirs(args.build_dir, exist_ok=True)
+    maps = list(args.regdef)
+    if args.synthetic:
+        synthetic = os.path.join(args.build_dir, 'synthetic%d.regdef.json' % args.synthetic)
+        synthetic_regdef_file(synthetic, args.synthetic)
+        maps.append(synthetic)
+
+    results = []
+    for file_name in maps:
+        map_name = os.path.basename(file_name).split('.')[0]
+        registers = load_registers(file_name)
+        for result in run_benchmark(args.build_dir, map_name, registers,
+                                    args.cc, ['-O' + opt for opt in args.opt], args.min_time):
+            results.append(result)
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+
+if __name__ == '__main__':
+    main()
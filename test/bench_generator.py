@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the Python side of the generator on synthetic register maps.
+
+Measures throughput and peak memory of Register.from_specs(), parse_regdef_json(),
+Register.ccode(), Register.code_masks() and Register.repr_long() for maps of
+increasing size. Results are written as JSON and can be compared against a stored
+baseline (exits with 1 if anything got slower or bigger by more than a threshold).
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import resource
+import argparse
+import platform
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import regdef
+
+BENCHMARKS = ['from_specs', 'parse_regdef_json', 'ccode', 'code_masks', 'repr_long']
+
+
+def synthetic_register(rand):
+    """
+    Random register description (as in regdef JSON) mixing "def"/"defs", @N widths,
+    explicit positions in increasing or decreasing order and address lists.
+    """
+    n_bits = rand.choice([8, 16, 32, 32, 32, 64])
+    fields = []  # (name, start, end)
+    pos = 0
+    while pos < n_bits:
+        length = min(rand.choice([1, 1, 1, 2, 3, 4, 5, 8, 12, 16]), n_bits - pos)
+        name = '_' if rand.random() < 0.15 else 'field%d' % len(fields)
+        fields.append((name, pos, pos + length - 1))
+        pos += length
+
+    style = rand.choice(['increasing', 'decreasing', 'widths', 'mixed'])
+    if style == 'increasing':
+        specs = ['%s:%d' % (n, s) if s == e else '%s:%d:%d' % (n, s, e) for n, s, e in fields]
+    elif style == 'decreasing':
+        specs = ['%s:%d' % (n, s) if s == e else '%s:%d:%d' % (n, e, s) for n, s, e in reversed(fields)]
+    elif style == 'widths':
+        specs = ['%s:@%d' % (n, e - s + 1) for n, s, e in fields]
+    else:  # first position explicit, the rest as widths
+        n, s, e = fields[0]
+        specs = ['%s:%d:%d' % (n, e, s) if s != e else '%s:%d' % (n, s)]
+        specs += ['%s:@%d' % (n, e - s + 1) for n, s, e in fields[1:]]
+
+    definition = {}
+    if rand.random() < 0.5:
+        definition['def'] = ' '.join(specs)
+    else:
+        definition['defs'] = specs
+    return definition
+
+
+def synthetic_regdef_file(file_name, n_registers, seed=0):
+    """Write synthetic regdef JSON with n_registers registers (streamed, one register at a time)."""
+    rand = random.Random(seed)
+    address = 0
+    with open(file_name, 'w') as fp:
+        fp.write('{\n')
+        for i in range(n_registers):
+            if i % 100 == 0:
+                fp.write('    "// Section %d": "",\n' % (i // 100))
+            definition = synthetic_register(rand)
+            if rand.random() < 0.2:
+                n_addresses = rand.choice([2, 2, 4, 8])
+                definition['address'] = ['0x%x' % (address + j) for j in range(n_addresses)]
+                address += n_addresses
+            else:
+                definition['address'] = '0x%x' % address
+                address += 1
+            fp.write('    %s: %s%s\n' % (json.dumps('REG%d' % i), json.dumps(definition),
+                                         ',' if i < n_registers - 1 else ''))
+        fp.write('}\n')
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def load_inputs(file_name, benchmark):
+    """Inputs of the benchmark, prepared before measurement."""
+    if benchmark == 'parse_regdef_json':
+        return file_name
+    specs = []
+    with open(file_name) as fp:
+        for name, definition in regdef.iter_json_object(fp):
+            if name.startswith('//'):
+                continue
+            spec = definition['def'] if 'def' in definition else ' '.join(definition['defs'])
+            specs.append((name, spec, definition['address']))
+    if benchmark == 'from_specs':
+        return specs
+    return [(regdef.Register.from_specs(spec, name=name), address) for name, spec, address in specs]
+
+
+def run_benchmark(benchmark, inputs):
+    if benchmark == 'from_specs':
+        return [regdef.Register.from_specs(spec, name=name) for name, spec, address in inputs]
+    if benchmark == 'parse_regdef_json':
+        return regdef.parse_regdef_json(inputs)
+    if benchmark == 'ccode':
+        return [reg.ccode(address) for reg, address in inputs]
+    if benchmark == 'code_masks':
+        # code_masks() takes a single address
+        return [reg.code_masks(address[0] if isinstance(address, list) else address)
+                for reg, address in inputs]
+    if benchmark == 'repr_long':
+        return [reg.repr_long() for reg, address in inputs]
+    raise ValueError('Unknown benchmark: %s' % benchmark)
+
+
+def measure(args):
+    """
+    Run a single benchmark (in a fresh process), returns (seconds, peak RSS increase in kB).
+    Results are kept until the end, so memory includes the produced objects.
+    Short benchmarks are repeated until min_time has passed and the best time is taken.
+    """
+    benchmark, file_name, min_time = args
+    inputs = load_inputs(file_name, benchmark)
+    gc.collect()
+    rss_before = peak_rss_kb()
+    start = time.perf_counter()
+    result = run_benchmark(benchmark, inputs)
+    seconds = total = time.perf_counter() - start
+    rss_after = peak_rss_kb()
+    del result
+    while total < min_time:
+        start = time.perf_counter()
+        run_benchmark(benchmark, inputs)
+        elapsed = time.perf_counter() - start
+        seconds = min(seconds, elapsed)
+        total += elapsed
+    return seconds, rss_after - rss_before
+
+
+def run_suite(sizes, benchmarks, build_dir, seed=0, min_time=0.5, log=sys.stderr):
+    results = []
+    ctx = multiprocessing.get_context('fork')
+    for size in sizes:
+        file_name = os.path.join(build_dir, 'synthetic%d_seed%d.regdef.json' % (size, seed))
+        if not os.path.exists(file_name):
+            synthetic_regdef_file(file_name, size, seed=seed)
+        for benchmark in benchmarks:
+            # each benchmark in a new process, so that peak memory is not shared between them
+            with ctx.Pool(1) as pool:
+                seconds, rss_kb = pool.apply(measure, ((benchmark, file_name, min_time), ))
+            result = {
+                'benchmark': benchmark,
+                'registers': size,
+                'seconds': seconds,
+                'registers_per_s': size / seconds if seconds > 0 else None,
+                'peak_rss_kb': rss_kb,
+            }
+            print('{benchmark:<18} {registers:>8} {seconds:>10.3f} s {registers_per_s:>12.0f} reg/s'
+                  ' {peak_rss_kb:>10} kB'.format(**result), file=log)
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print comparison with baseline results, returns list of regressions."""
+    base = {(r['benchmark'], r['registers']): r for r in baseline['results']}
+    regressions = []
+    header = '{:<18} {:>8} {:>12} {:>12} {:>7} {:>12} {:>12} {:>7}'.format(
+        'benchmark', 'regs', 'base us/reg', 'us/reg', 'ratio', 'base kB', 'kB', 'ratio')
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        b = base.get((r['benchmark'], r['registers']))
+        if b is None:
+            continue
+        t_ratio = r['seconds'] / b['seconds'] if b['seconds'] > 0 else 1
+        # small memory differences are just noise of the allocator
+        m_ratio = r['peak_rss_kb'] / b['peak_rss_kb'] if b['peak_rss_kb'] > 1024 else 1
+        flags = []
+        if t_ratio > 1 + threshold:
+            flags.append('SLOWER')
+        if m_ratio > 1 + threshold:
+            flags.append('BIGGER')
+        if flags:
+            regressions.append((r['benchmark'], r['registers'], flags))
+        print('{:<18} {:>8} {:>12.3f} {:>12.3f} {:>7.2f} {:>12} {:>12} {:>7.2f} {}'.format(
+            r['benchmark'], r['registers'],
+            b['seconds'] * 1e6 / b['registers'], r['seconds'] * 1e6 / r['registers'], t_ratio,
+            b['peak_rss_kb'], r['peak_rss_kb'], m_ratio, ' '.join(flags)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10, 1000, 100000, 1000000],
+                        help='Numbers of registers of the synthetic maps')
+    parser.add_argument('-B', '--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help='Benchmarks to run')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic maps')
+    parser.add_argument('-b', '--build-dir', default='bench_build',
+                        help='Directory for synthetic maps')
+    parser.add_argument('-m', '--min-time', type=float, default=0.5,
+                        help='Short benchmarks are repeated for this time in seconds (best time is taken)')
+    parser.add_argument('-o', '--output', help='Write results to this JSON file')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='Compare results with baseline JSON file (written with --output)')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='Relative slowdown/memory increase reported as regression')
+    args = parser.parse_args()
+
+    os.makedirs(args.build_dir, exist_ok=True)
+    results = run_suite(args.sizes, args.benchmarks, args.build_dir, seed=args.seed,
+                        min_time=args.min_time)
+    data = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(data, fp, indent=4)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d regressions' % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
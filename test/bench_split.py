@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmark of compile times of code using a monolithic generated header against
+headers split per section/register (see write_split_output()) for a large synthetic map.
+
+Translation units using a few random registers each are compiled with every layout:
+the monolithic header, the umbrella header of split headers and only the split headers
+that are used (as include-what-you-use would suggest, found in the .imp mapping file).
+Also reported is the time of rebuild after a change of a single register, i.e. of the
+translation units including the header that changes.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import regdef
+from bench_generator import synthetic_regdef_file
+
+
+def generate(file_name, build_dir, cpp):
+    """Generate all layouts, returns {layout: header} and {symbol: {split mode: header}}."""
+    hdr = '.gen.hpp' if cpp else '.gen.h'
+    headers = {'monolithic': os.path.join(build_dir, 'monolithic' + hdr)}
+    items = regdef.iter_regdef_json(file_name, cpp=cpp)
+    regdef.write_chunks_if_changed(headers['monolithic'], regdef.iter_output('code', items))
+    parts = {}
+    for split in ['section', 'register']:
+        headers[split] = os.path.join(build_dir, split + hdr)
+        regdef.write_split_output(regdef.iter_regdef_json(file_name, cpp=cpp), headers[split], split, cpp=cpp)
+        with open(os.path.splitext(headers[split])[0] + '.imp') as fp:
+            for entry in json.load(fp):
+                symbol, _, include, _ = entry['symbol']
+                parts.setdefault(symbol, {})[split] = include.strip('"')
+    return headers, parts
+
+
+def registers_with_fields(file_name):
+    with open(file_name) as fp:
+        regs = []
+        for name, definition in regdef.iter_json_object(fp):
+            if name.startswith('//'):
+                continue
+            specs, address, options = regdef.split_regdef(definition)
+            reg = regdef.Register.from_specs(specs, name=name)
+            if reg.field_layout() and reg.n_bits <= 32:
+                regs.append(name)
+    return regs
+
+
+def translation_unit(names, includes, cpp):
+    """Source of a translation unit converting raw values of given registers."""
+    if cpp:
+        lines = ['#include <cstdint>', '#include <cstddef>', 'namespace regs {']
+        lines += ['#include "%s"' % include for include in includes]
+        lines += ['}', 'using namespace regs;', '']
+        lines += ['uint32_t use_%s(uint32_t raw) { return %s::from_raw(raw).raw(); }' % (name, name)
+                  for name in names]
+    else:
+        lines = ['#include <stdint.h>', '#include <stddef.h>']
+        lines += ['#include "%s"' % include for include in includes]
+        lines += ['']
+        lines += ['uint32_t use_%s(uint32_t raw) { %s r = %s_FROM_RAW(raw); return %s_RAW(r); }'
+                  % (name, name, name, name) for name in names]
+    return '\n'.join(lines) + '\n'
+
+
+def compile_time(compiler, source, flags):
+    start = time.perf_counter()
+    subprocess.check_call([compiler] + flags + ['-c', source, '-o', source + '.o'])
+    return time.perf_counter() - start
+
+
+def run_benchmark(headers, parts, units, build_dir, compiler, flags, jobs):
+    """Yields result dicts for each layout."""
+    cpp = compiler.endswith('++')
+    ext = '.cpp' if cpp else '.c'
+    for layout in ['monolithic', 'umbrella', 'section', 'register']:
+        sources = []
+        unit_headers = []
+        for k, names in enumerate(units):
+            if layout in ['monolithic', 'umbrella']:
+                header = headers['monolithic' if layout == 'monolithic' else 'section']
+                includes = [os.path.basename(header)]
+            else:
+                includes = sorted(set(parts[name][layout] for name in names))
+            unit_headers.append(includes)
+            source = os.path.join(build_dir, '%s_%d%s' % (layout, k, ext))
+            with open(source, 'w') as fp:
+                fp.write(translation_unit(names, includes, cpp))
+            sources.append(source)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            times = list(pool.map(lambda s: compile_time(compiler, s, flags + ['-I', build_dir]), sources))
+        wall = time.perf_counter() - start
+        # change of the first register used by the first unit rebuilds units including its header
+        changed = units[0][0]
+        if layout in ['monolithic', 'umbrella']:
+            rebuilt = list(range(len(units)))
+        else:
+            changed_header = parts[changed][layout]
+            rebuilt = [k for k, includes in enumerate(unit_headers) if changed_header in includes]
+        yield {
+            'layout': layout, 'units': len(units), 'wall_s': wall, 'cpu_s': sum(times),
+            'unit_ms': sum(times) / len(times) * 1e3, 'rebuilt_units': len(rebuilt),
+            'rebuild_s': sum(times[k] for k in rebuilt),
+        }
+
+
+def print_table(results, out=sys.stdout):
+    header = '{:<12} {:>6} {:>9} {:>9} {:>10} {:>10} {:>10}'.format(
+        'layout', 'units', 'wall s', 'cpu s', 'ms/unit', 'rebuilt', 'rebuild s')
+    print(header, file=out)
+    print('-' * len(header), file=out)
+    for r in results:
+        print('{layout:<12} {units:>6} {wall_s:>9.2f} {cpu_s:>9.2f} {unit_ms:>10.1f}'
+              ' {rebuilt_units:>10} {rebuild_s:>10.2f}'.format(**r), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('-s', '--size', type=int, default=5000,
+                        help='Number of registers of the synthetic map (sections of 100 registers)')
+    parser.add_argument('-u', '--units', type=int, default=16,
+                        help='Number of translation units')
+    parser.add_argument('-r', '--registers', type=int, default=4,
+                        help='Number of registers used by each translation unit')
+    parser.add_argument('--cc', nargs='+', default=['gcc', 'g++'],
+                        help='Compilers (ones ending with ++ compile C++ code)')
+    parser.add_argument('-O', '--opt', default='2',
+                        help='Optimisation level (used as -O<OPT>)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of parallel compilations')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic map and of registers used by translation units')
+    parser.add_argument('-b', '--build-dir', default='bench_build',
+                        help='Directory for generated sources and objects')
+    parser.add_argument('--json', help='Also write results to this JSON file')
+    args = parser.parse_args()
+
+    build_dir = os.path.join(args.build_dir, 'split')
+    os.makedirs(build_dir, exist_ok=True)
+    file_name = os.path.join(args.build_dir, 'synthetic%d_seed%d.regdef.json' % (args.size, args.seed))
+    if not os.path.exists(file_name):
+        synthetic_regdef_file(file_name, args.size, seed=args.seed)
+    names = registers_with_fields(file_name)
+    rand = random.Random(args.seed)
+    units = [rand.sample(names, args.registers) for _ in range(args.units)]
+
+    results = []
+    for compiler in args.cc:
+        cpp = compiler.endswith('++')
+        headers, parts = generate(file_name, build_dir, cpp)
+        flags = ['-std=c++2a' if cpp else '-std=gnu99', '-O' + args.opt, '-w']
+        print('%s, %d registers, %d units using %d registers each' % (
+            compiler, args.size, args.units, args.registers))
+        compiler_results = list(run_benchmark(headers, parts, units, build_dir, compiler, flags, args.jobs))
+        print_table(compiler_results)
+        print()
+        results.extend(dict(r, compiler=compiler) for r in compiler_results)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,711 @@
+#!/usr/bin/env python3
+"""
+Tests of the Python API of regdef.py that has no generated code to be tested
+in C/C++ (run with `python -m unittest test_regdef` or `make run`).
+"""
+
+import io
+import os
+import sys
+import gc
+import json
+import random
+import shutil
+import socket
+import subprocess
+import asyncio
+import contextlib
+import tempfile
+import weakref
+import unittest
+from unittest import mock
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, '..'))
+import regdef
+
+TMC5041 = os.path.join(TEST_DIR, 'tmc5041.regdef.json')
+
+
+def load_registers(description):
+    """Registers of regdef JSON given as a dict."""
+    with tempfile.TemporaryDirectory() as tmp:
+        file_name = os.path.join(tmp, 'test.regdef.json')
+        with open(file_name, 'w') as fp:
+            json.dump(description, fp)
+        return load_registers_file(file_name)
+
+
+def load_registers_file(file_name):
+    return list(regdef.iter_registers(file_name))
+
+
+class WithoutNumpy(unittest.TestCase):
+    """Runs the tests with the pure Python fallbacks, see the Numpy subclasses."""
+    np = None
+
+    def setUp(self):
+        patcher = mock.patch.object(regdef, 'np', self.np)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class DecodeManyTest(WithoutNumpy):
+
+    def test_round_trip(self):
+        reg = regdef.Register.from_specs('reserved:31:12 mode:11:8 reserved:7:3 en:2 div:1:0', name='CTRL')
+        raws = [0x0, 0xf07, 0xa05, 0xffffffff]
+        columns = reg.decode_many(raws)
+        self.assertEqual(sorted(columns), ['div', 'en', 'mode'])
+        self.assertEqual(list(columns['mode']), [0, 0xf, 0xa, 0xf])
+        self.assertEqual(list(columns['en']), [0, 1, 1, 1])
+        self.assertEqual(list(columns['div']), [0, 3, 1, 3])
+        # reserved bits are dropped
+        self.assertEqual(list(reg.encode_many(columns)), [0x0, 0xf07, 0xa05, 0xf07])
+
+    def test_encode_truncates_and_defaults_to_zero(self):
+        reg = regdef.Register.from_specs('b:7:4 a:3:0', name='R')
+        self.assertEqual(list(reg.encode_many({'a': [0x1f, 2]})), [0xf, 2])
+        self.assertEqual(list(reg.encode_many({})), [])
+
+    def test_unknown_field(self):
+        reg = regdef.Register.from_specs('b:7:4 a:3:0', name='R')
+        with self.assertRaisesRegex(ValueError, "Unknown fields for register R: \\['c'\\]"):
+            reg.encode_many({'a': [1], 'c': [1]})
+
+    def test_ragged_columns(self):
+        reg = regdef.Register.from_specs('b:7:4 a:3:0', name='R')
+        with self.assertRaisesRegex(ValueError, 'different lengths'):
+            reg.encode_many({'a': [1, 2], 'b': [1]})
+
+    def test_wider_than_64_bits(self):
+        reg = regdef.Register.from_specs('hi:95:64 mid:63:32 lo:3:0', name='W')
+        raws = [(5 << 64) | (7 << 32) | 9, (1 << 96) - 1]
+        columns = reg.decode_many(raws)
+        self.assertEqual(columns, {'lo': [9, 0xf], 'mid': [7, 0xffffffff], 'hi': [5, 0xffffffff]})
+        self.assertEqual(reg.encode_many(columns), [raws[0], raws[1] & ~0xfffffff0])
+
+
+@unittest.skipIf(regdef.np is None, 'numpy is not installed')
+class DecodeManyNumpyTest(DecodeManyTest):
+    np = regdef.np
+
+
+def compile_code(code, cpp):
+    """Compiles generated code, returns (exit status, warnings and errors)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        file_name = os.path.join(tmp, 'test.cpp' if cpp else 'test.c')
+        with open(file_name, 'w') as fp:
+            fp.write('#include <stdint.h>\n#include <stddef.h>\n' + code + '\n')
+        compiler = ['g++', '-std=c++2a'] if cpp else ['gcc', '-std=gnu99']
+        result = subprocess.run(compiler + ['-fsyntax-only', '-Wall', file_name],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        return result.returncode, result.stdout
+
+
+class FieldHelpersTest(unittest.TestCase):
+
+    def test_off_by_default(self):
+        reg = regdef.Register.from_specs('a:3:0 update:7:4', name='R')
+        self.assertNotIn('update_raw', reg.ccode(0, cpp=True))
+        self.assertNotIn('_FMASK', reg.ccode(0, cpp=False))
+        self.assertIn('update_raw', reg.ccode(0, cpp=True, helpers=True))
+        self.assertIn('R_UPDATE_FMASK', reg.ccode(0, cpp=False, helpers=True))
+
+    def test_colliding_names(self):
+        reg = regdef.Register.from_specs('a:0 get_a:1 mask_raw:2', name='R')
+        with self.assertRaisesRegex(ValueError, 'Fields of register R have the same names as generated helpers: get_a'):
+            reg.ccode(0, cpp=True, helpers=True)
+        # no helpers, no collisions
+        reg.ccode(0, cpp=True)
+
+    @unittest.skipUnless(shutil.which('gcc') and shutil.which('g++'), 'gcc/g++ is not installed')
+    def test_compiles(self):
+        reg = regdef.Register.from_specs('a:3:0 update:31:4', name='R')
+        for cpp in [False, True]:
+            for helpers in [False, True]:
+                with self.subTest(cpp=cpp, helpers=helpers):
+                    # masks and helpers in the same translation unit
+                    code = reg.code_masks(0, cpp=cpp) + '\n' + reg.ccode(0, cpp=cpp, helpers=helpers)
+                    status, output = compile_code(code, cpp)
+                    self.assertEqual(status, 0, output)
+                    self.assertNotIn('MASK', output)
+
+
+class DecodeCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.registers = load_registers_file(TMC5041)
+        addresses = sorted(regdef.address_index(self.registers))
+        self.unknown = min(set(range(256)) - set(addresses))
+        addresses.append(self.unknown)
+        rnd = random.Random(0)
+        self.transactions = [(rnd.choice(addresses), rnd.getrandbits(32)) for _ in range(2000)]
+
+    def write_capture(self, name, data):
+        file_name = os.path.join(self.tmp, name)
+        with open(file_name, 'wb' if isinstance(data, bytes) else 'w') as fp:
+            fp.write(data)
+        return file_name
+
+    def test_csv_bin_and_jobs(self):
+        csv_file = self.write_capture('capture.csv', 'address,value\n' + ''.join(
+            '0x%02x,0x%08x\n' % t for t in self.transactions))
+        bin_file = self.write_capture('capture.bin', bytes(regdef.pack_frame(self.transactions)))
+        expected = [regdef.format_transaction(*t) for t in regdef.decode_transactions(
+            self.transactions, regdef.address_index(self.registers))]
+        self.assertIn('0x%02x ? ' % self.unknown, '\n'.join(expected))
+        for file_name, fmt in [(csv_file, 'csv'), (bin_file, 'bin')]:
+            for jobs in [1, 3]:
+                with self.subTest(fmt=fmt, jobs=jobs):
+                    lines = regdef.decode_capture(file_name, regdef.LazyRegisterMap(TMC5041), fmt=fmt,
+                                                  jobs=jobs, chunk_size=1000)
+                    self.assertEqual(list(lines), expected)
+
+    def test_invalid_csv_line(self):
+        file_name = self.write_capture('capture.csv', '0x10,0x1\n0x20\n')
+        with self.assertRaisesRegex(ValueError, "capture.csv: invalid capture line at offset 9: '0x20'"):
+            list(regdef.read_capture(file_name))
+
+
+class SnapshotDiffTest(WithoutNumpy):
+
+    def test_diff_files(self):
+        snapshots = {
+            'golden.csv': [(0x00, 0x008), (0x01, 0x1), (0x21, 100), (0x41, 200)],
+            # field changed, reserved bit changed, missing address, address not in golden, unknown address
+            's1.csv': [(0x00, 0x10f), (0x01, 0x1), (0x21, 100), (0x05, 7), (0xfe, 1)],
+            's2.csv': [(0x41, 200), (0x21, 100), (0x01, 0x1), (0x00, 0x00c)],
+            's3.csv': [(0x00, 0x008), (0x01, 0x1), (0x21, 100), (0x21, 101), (0x41, 200)],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, transactions in snapshots.items():
+                with open(os.path.join(tmp, name), 'w') as fp:
+                    fp.write(''.join('%#x,%#x\n' % t for t in transactions))
+            snapshot_diff = regdef.SnapshotDiff(load_registers_file(TMC5041))
+            self.assertEqual(snapshot_diff.vectorized, self.np is not None)
+            file_names = [os.path.join(tmp, name) for name in ['s1.csv', 's2.csv', 's3.csv']]
+            differences = snapshot_diff.diff_files(os.path.join(tmp, 'golden.csv'), file_names)
+            lines = [regdef.format_diff(os.path.basename(file_name), *difference)
+                     for file_name, *difference in differences]
+        self.assertEqual(lines, [
+            's1.csv 0x00 GCONF shaft1=0->1',
+            's1.csv 0x41 XACTUAL[1] missing',
+            's3.csv 0x21 XACTUAL[0] xactual=100->101',
+        ])
+
+    def test_batches(self):
+        snapshot_diff = regdef.SnapshotDiff(load_registers_file(TMC5041))
+        golden = snapshot_diff.vector([(0x21, 0), (0x41, 0)])
+        snapshots = (snapshot_diff.vector([(0x21, k % 3), (0x41, 0)]) for k in range(10))
+        differences = list(snapshot_diff.diff(golden, snapshots, batch_size=4))
+        self.assertEqual(differences, [(k, 0x21, 'XACTUAL', 0, [('xactual', 0, k % 3)])
+                                       for k in range(10) if k % 3])
+
+
+@unittest.skipIf(regdef.np is None, 'numpy is not installed')
+class SnapshotDiffNumpyTest(SnapshotDiffTest):
+    np = regdef.np
+
+
+class CodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.regdef_file = os.path.join(tmp.name, 'tmc5041.regdef.json')
+        self.output_file = os.path.join(tmp.name, 'tmc5041_regdef.gen.hpp')
+        self.cache_file = self.output_file + '.cache'
+        shutil.copy(TMC5041, self.regdef_file)
+
+    def generate(self):
+        """Runs `regdef.py code --cache`, returns names of registers whose code was generated."""
+        rendered = []
+        ccode = regdef.Register.ccode
+
+        def counting_ccode(reg, *args, **kwargs):
+            rendered.append(reg.name)
+            return ccode(reg, *args, **kwargs)
+        argv = ['regdef.py', 'code', '--cache', self.cache_file, '-o', self.output_file, self.regdef_file]
+        with mock.patch.object(sys, 'argv', argv), mock.patch.object(regdef.Register, 'ccode', counting_ccode):
+            regdef.main()
+        return rendered
+
+    def test_unchanged_and_edited(self):
+        self.assertIn('GCONF', self.generate())
+        os.utime(self.output_file, (1000, 1000))
+        with open(self.output_file) as fp:
+            code = fp.read()
+
+        self.assertEqual(self.generate(), [])
+        self.assertEqual(os.stat(self.output_file).st_mtime, 1000)
+
+        with open(self.regdef_file) as fp:
+            description = json.load(fp)
+        description['GCONF']['defs'][1] = 'poscmp_en:3'
+        with open(self.regdef_file, 'w') as fp:
+            json.dump(description, fp)
+        self.assertEqual(self.generate(), ['GCONF'])
+        self.assertNotEqual(os.stat(self.output_file).st_mtime, 1000)
+        with open(self.output_file) as fp:
+            self.assertEqual(fp.read(), code.replace('poscmp_enable', 'poscmp_en'))
+
+
+def layouts(registers):
+    return [(r['name'], r['address'], r['reg'].names, r['reg'].lengths, r['reg'].positions) for r in registers]
+
+
+class RegDBTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.regdef_file = os.path.join(tmp.name, 'tmc5041.regdef.json')
+        self.regdb_file = os.path.join(tmp.name, 'tmc5041.regdb')
+        shutil.copy(TMC5041, self.regdef_file)
+
+    def load(self):
+        """Registers from load_regdb() (see layouts()), whether the file has been compiled again."""
+        with mock.patch.object(regdef, 'compile_regdb', wraps=regdef.compile_regdb) as compile_regdb:
+            with regdef.load_regdb(self.regdef_file) as db:
+                return layouts(db.registers()), compile_regdb.called
+
+    def test_round_trip(self):
+        registers, compiled = self.load()
+        self.assertTrue(compiled)
+        self.assertEqual(registers, layouts(load_registers_file(TMC5041)))
+        self.assertEqual(self.load(), (registers, False))
+        with regdef.load_regdb(self.regdb_file) as db:
+            self.assertEqual(layouts(db.registers()), registers)
+            self.assertEqual([r['name'] for r in db.registers() if r['cache_reads']], ['GCONF'])
+
+    def test_stale_source(self):
+        self.load()
+        # same contents, only mtime changed: source hash matches
+        os.utime(self.regdef_file, (1000, 1000))
+        self.assertFalse(self.load()[1])
+        # same size, different contents
+        with open(self.regdef_file) as fp:
+            text = fp.read()
+        with open(self.regdef_file, 'w') as fp:
+            fp.write(text.replace('poscmp_enable', 'poscmp_enabl3'))
+        os.utime(self.regdef_file, (1000, 1000))
+        registers, compiled = self.load()
+        self.assertTrue(compiled)
+        self.assertIn('poscmp_enabl3', registers[0][2])
+
+    def test_generator_and_version(self):
+        self.load()
+        with mock.patch.object(regdef.CodeCache, 'generator_hash', return_value='00' * 20):
+            self.assertTrue(self.load()[1])
+        self.assertTrue(self.load()[1])
+        with open(self.regdb_file, 'r+b') as fp:
+            fp.seek(len(regdef.RegDB.MAGIC))
+            fp.write(bytes([regdef.RegDB.VERSION + 1, 0]))
+        with self.assertRaisesRegex(ValueError, 'Unsupported regdb version'):
+            regdef.RegDB(self.regdb_file)
+        self.assertTrue(self.load()[1])
+
+    def test_truncated(self):
+        registers, _ = self.load()
+        size = os.path.getsize(self.regdb_file)
+        for truncated_size in [10, size - 1]:
+            with self.subTest(size=truncated_size):
+                os.truncate(self.regdb_file, truncated_size)
+                with self.assertRaisesRegex(ValueError, 'Truncated regdb file'):
+                    regdef.RegDB(self.regdb_file)
+                self.assertEqual(self.load(), (registers, True))
+
+    def test_no_source(self):
+        self.load()
+        os.truncate(self.regdb_file, 10)
+        os.remove(self.regdef_file)
+        with self.assertRaisesRegex(ValueError, 'Truncated regdb file.*without source JSON'):
+            regdef.load_regdb(self.regdb_file)
+        os.remove(self.regdb_file)
+        with self.assertRaises(FileNotFoundError):
+            regdef.load_regdb(self.regdb_file)
+
+
+BAD_REGDEF = """{
+    "// comment": "",
+    "A": {"address": "0x00", "def": "x:3:0 y:7:4"},
+    "B": {"address": "0x01", "def": "x:3:0 y:5:2"},
+    "C": {"address": ["0x02", "0x01"], "def": "z:0"},
+    "A": {"address": "0x10", "def": "a:0"},
+    "D": {"address": "0x04", "def": "w:40:0", "reg_n": 32},
+    "E": {"def": "q:0"},
+    "F": {"address": "0x05", "def": "a:0 c:7:4 b:3:1"},
+    "G": {"address": "0x08", "def": "a:0 b:7:4"}
+}
+"""
+
+
+class CheckTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.regdef_file = os.path.join(tmp.name, 'bad.regdef.json')
+        with open(self.regdef_file, 'w') as fp:
+            fp.write(BAD_REGDEF)
+
+    def test_sweep_intervals(self):
+        intervals = [(10, 12, 'c'), (0, 4, 'a'), (2, 3, 'b'), (3, 6, 'd'), (6, 7, 'e')]
+        self.assertEqual(list(regdef.sweep_intervals(intervals)), [
+            ('overlap', 'a', 'b'), ('overlap', 'a', 'd'), ('gap', 7, 10)])
+        # intervals that only touch do not overlap
+        self.assertEqual(list(regdef.sweep_intervals(intervals[2:], start=0)), [('gap', 0, 2)])
+        self.assertEqual(list(regdef.sweep_intervals([])), [])
+
+    def test_check_regdef_json(self):
+        self.assertEqual(list(regdef.check_regdef_json(self.regdef_file)), [
+            ('overlap', 'B', 'fields x and y overlap'),
+            ('duplicate', 'A', 'register is defined more than once'),
+            ('over-width', 'D', 'field w (bits 0..40) does not fit in 32 bits'),
+            ('invalid', 'E', "invalid definition: 'address'"),
+            ('order', 'F', 'fields are neither in increasing nor in decreasing order'),
+            ('collision', 'C', 'C[1] at 0x01 collides with B at 0x01'),
+        ])
+
+    def test_gaps_and_address_bits(self):
+        problems = list(regdef.check_regdef_json(self.regdef_file, address_bits=8, gaps=True))
+        self.assertIn(('gap', 'G', 'bits 1..3 are not in any field'), problems)
+        self.assertIn(('gap', None, 'addresses 0x03..0x03 are not used by any register'), problems)
+        # 41-bit D occupies 6 byte addresses
+        self.assertIn(('collision', 'F', 'F at 0x05 collides with D at 0x04'), problems)
+        self.assertIn(('collision', 'G', 'G at 0x08 collides with D at 0x04'), problems)
+
+    def check(self, regdef_file):
+        """Runs `regdef.py check`, returns (exit status, stdout, stderr)."""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch.object(sys, 'argv', ['regdef.py', 'check', regdef_file]), \
+                contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            with self.assertRaises(SystemExit) as exit:
+                regdef.main()
+        return exit.exception.code, stdout.getvalue(), stderr.getvalue()
+
+    def test_exit_status(self):
+        status, out, err = self.check(self.regdef_file)
+        self.assertEqual(status, 1)
+        self.assertIn('%s: collision: C: C[1] at 0x01 collides with B at 0x01\n' % self.regdef_file, out)
+        self.assertEqual(err, '6 errors in 1 files\n')
+        self.assertEqual(self.check(TMC5041), (0, '', '0 errors in 1 files\n'))
+
+
+SVD = """<?xml version="1.0" encoding="utf-8"?>
+<device>
+  <name>TEST</name>
+  <size>32</size>
+  <peripherals>
+    <peripheral>
+      <name>TIMER0</name>
+      <description>Timer</description>
+      <baseAddress>0x40000000</baseAddress>
+      <registers>
+        <register>
+          <name>CTRL</name>
+          <addressOffset>0x0</addressOffset>
+          <fields>
+            <field><name>EN</name><bitOffset>0</bitOffset><bitWidth>1</bitWidth></field>
+            <field><name>MODE</name><bitOffset>1</bitOffset><bitWidth>2</bitWidth></field>
+          </fields>
+        </register>
+        <register>
+          <name>STATUS</name>
+          <addressOffset>0x4</addressOffset>
+          <size>16</size>
+          <fields>
+            <field><name>FLAGS</name><lsb>4</lsb><msb>11</msb></field>
+            <field><name>BUSY</name><bitRange>[15:15]</bitRange></field>
+          </fields>
+        </register>
+        <register>
+          <dim>2</dim>
+          <dimIncrement>4</dimIncrement>
+          <name>CNT[%s]</name>
+          <addressOffset>0x8</addressOffset>
+        </register>
+        <register>
+          <dim>2</dim>
+          <dimIncrement>0x4</dimIncrement>
+          <dimIndex>A,B</dimIndex>
+          <name>CH%s</name>
+          <addressOffset>0x10</addressOffset>
+          <fields>
+            <field><name>VAL</name><bitRange>[7:4]</bitRange></field>
+          </fields>
+        </register>
+      </registers>
+    </peripheral>
+    <peripheral derivedFrom="TIMER0">
+      <name>TIMER1</name>
+      <baseAddress>0x40001000</baseAddress>
+    </peripheral>
+    <peripheral>
+      <dim>2</dim>
+      <dimIncrement>0x100</dimIncrement>
+      <name>UART%s</name>
+      <baseAddress>0x40002000</baseAddress>
+      <size>8</size>
+      <registers>
+        <register>
+          <name>DATA</name>
+          <addressOffset>0x0</addressOffset>
+        </register>
+        <cluster>
+          <dim>2</dim>
+          <dimIncrement>0x10</dimIncrement>
+          <name>FIFO%s</name>
+          <addressOffset>0x20</addressOffset>
+          <register>
+            <name>LEVEL</name>
+            <addressOffset>0x4</addressOffset>
+            <fields><field><name>N</name><bitRange>[3:0]</bitRange></field></fields>
+          </register>
+          <register derivedFrom="LEVEL">
+            <name>LIMIT</name>
+            <addressOffset>0x8</addressOffset>
+          </register>
+        </cluster>
+      </registers>
+    </peripheral>
+  </peripherals>
+</device>
+"""
+
+
+class SVDTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.svd_file = os.path.join(tmp.name, 'test.svd')
+        with open(self.svd_file, 'w') as fp:
+            fp.write(SVD)
+        self.registers = {name: definition for name, definition in regdef.iter_svd(self.svd_file)
+                          if not name.startswith('//')}
+
+    def register(self, name):
+        definition = self.registers[name]
+        self.assertEqual(definition['address_t'], 'uint32_t')
+        return definition['address'], definition['defs']
+
+    def test_field_positions(self):
+        # bitOffset/bitWidth, lsb/msb and bitRange, reserved bits up to register size
+        self.assertEqual(self.register('TIMER0_CTRL'), ('0x40000000', ['EN:0', 'MODE:2:1', '_:31:3']))
+        self.assertEqual(self.register('TIMER0_STATUS'), ('0x40000004', ['FLAGS:11:4', 'BUSY:15']))
+        self.assertEqual(self.register('TIMER0_CHA'), ('0x40000010', ['VAL:7:4', '_:31:8']))
+        # no fields, a single one named as the register
+        self.assertEqual(self.register('UART0_DATA'), ('0x40002000', ['data:7:0']))
+
+    def test_arrays(self):
+        # [%s] is a list of addresses, %s separate registers (dimIndex names)
+        self.assertEqual(self.register('TIMER0_CNT'), (['0x40000008', '0x4000000c'], ['cnt:31:0']))
+        self.assertEqual(self.register('TIMER0_CHB'), ('0x40000014', ['VAL:7:4', '_:31:8']))
+        self.assertNotIn('TIMER0_CH%s', self.registers)
+        # arrays of peripherals and clusters
+        self.assertEqual(self.register('UART1_FIFO0_LEVEL'), ('0x40002124', ['N:3:0', '_:7:4']))
+        self.assertEqual(self.register('UART1_FIFO1_LEVEL'), ('0x40002134', ['N:3:0', '_:7:4']))
+
+    def test_derived(self):
+        for name in ['CTRL', 'STATUS', 'CNT', 'CHA', 'CHB']:
+            address, defs = self.register('TIMER0_' + name)
+            derived_address, derived_defs = self.register('TIMER1_' + name)
+            self.assertEqual(derived_defs, defs)
+            addresses = address if isinstance(address, list) else [address]
+            derived_addresses = derived_address if isinstance(derived_address, list) else [derived_address]
+            self.assertEqual([int(a, 0) + 0x1000 for a in addresses], [int(a, 0) for a in derived_addresses])
+        # register derived from one in the same cluster
+        self.assertEqual(self.register('UART0_FIFO1_LIMIT'), ('0x40002038', ['N:3:0', '_:7:4']))
+
+    def test_regdef_json(self):
+        json_file = self.svd_file[:-len('.svd')] + '.regdef.json'
+        with open(json_file, 'w') as fp:
+            fp.writelines(regdef.iter_json_chunks(regdef.iter_svd(self.svd_file)))
+        registers = load_registers_file(json_file)
+        self.assertEqual([r['name'] for r in registers], list(self.registers))
+        self.assertEqual(list(regdef.check_regdef_json(json_file)), [])
+
+
+class DispatchCodeTest(unittest.TestCase):
+
+    def test_instance_type(self):
+        for n_addresses, instance_t in [(256, 'uint8_t'), (257, 'uint16_t'), (70000, 'uint32_t')]:
+            registers = load_registers({
+                'CTRL': {'address': '0x0', 'def': 'enable:0'},
+                'BUF': {'address': ['%#x' % a for a in range(1, n_addresses + 1)], 'def': 'data:31:0'},
+            })
+            code = regdef.dispatch_code(regdef.dispatch_entries(registers), address_t='uint32_t')
+            with self.subTest(n_addresses=n_addresses):
+                self.assertIn('    %s instance;' % instance_t, code)
+                self.assertIn('{%#04x, 1, %d, 32,' % (n_addresses, n_addresses - 1), code)
+
+
+class RegisterServerTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'regdef.sock')
+        self.server = regdef.RegisterServer.from_files([TMC5041])
+
+    async def requests(self, requests):
+        """Starts the server, sends pipelined requests and returns the responses."""
+        serve = asyncio.ensure_future(self.server.serve(self.path))
+        try:
+            while True:
+                if serve.done():
+                    serve.result()
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):  # not listening yet
+                    await asyncio.sleep(0.001)
+            writer.write(''.join(json.dumps(request) + '\n' for request in requests).encode())
+            responses = [json.loads(await reader.readline()) for _ in requests]
+            writer.close()
+            return responses
+        finally:
+            serve.cancel()
+            await asyncio.gather(serve, return_exceptions=True)
+
+    def test_decode_encode(self):
+        responses = asyncio.run(self.requests([
+            {'op': 'decode', 'address': '0x00', 'value': 0x308, 'id': 1},
+            {'op': 'encode', 'register': 'GCONF', 'fields': {'shaft1': 1, 'poscmp_enable': 1}},
+            {'op': 'encode', 'register': 'GCONF', 'fields': {'shaft1': 2}},
+            {'op': 'decode', 'map': 'tmc5041', 'address': '0x02', 'value': 0},
+            {'op': 'maps'},
+        ]))
+        self.assertEqual(responses[0], {'ok': True, 'name': 'GCONF', 'index': None, 'id': 1, 'fields': {
+            'poscmp_enable': 1, 'test_mode': 0, 'shaft1': 1, 'shaft2': 1, 'lock_gconf': 0}})
+        self.assertEqual(responses[1], {'ok': True, 'address': 0, 'value': 0x108})
+        self.assertEqual(responses[2], {'ok': False, 'error': 'ValueError: Value 2 does not fit in field shaft1'})
+        self.assertEqual(responses[3], {'ok': False, 'error': 'KeyError: No register at address 0x02'})
+        self.assertEqual(responses[4]['maps'], {'tmc5041': 34})
+        self.assertFalse(os.path.lexists(self.path))
+
+    def test_stale_socket_is_replaced(self):
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.bind(self.path)
+        responses = asyncio.run(self.requests([{'op': 'maps'}]))
+        self.assertTrue(responses[0]['ok'])
+        self.assertFalse(os.path.lexists(self.path))
+
+    def test_other_file_is_left_alone(self):
+        with open(self.path, 'w') as fp:
+            fp.write('data')
+        with self.assertRaisesRegex(FileExistsError, 'is not a socket'):
+            asyncio.run(self.requests([{'op': 'maps'}]))
+        with open(self.path) as fp:
+            self.assertEqual(fp.read(), 'data')
+
+
+class RegisterBankTest(unittest.TestCase):
+
+    def test_fields(self):
+        registers = load_registers({
+            'CTRL': {'address': '0x1', 'def': 'enable:0 mode:2:1'},
+            'CHAN': {'address': ['0x2', '0x3'], 'def': 'gain:@4'},
+        })
+        bank = regdef.RegisterBank(registers, bytearray(16))
+        bank.CTRL.mode = 3
+        bank.CHAN[1].gain = 9
+        self.assertEqual(bank.CTRL.raw, 0b110)
+        self.assertEqual(bank.buffer[4:5].tobytes(), b'\x06')
+        self.assertEqual(bank['CHAN'][1].fields(), [('gain', 9)])
+        self.assertEqual(bank.CHAN[0].raw, 0)
+
+    def test_field_named_like_view_attribute(self):
+        registers = load_registers({'CTRL': {'address': '0x1', 'def': 'offset:7:4 enable:0'}})
+        bank = regdef.RegisterBank(registers, bytearray(8))
+        ctrl = bank.CTRL
+        ctrl['offset'] = 5
+        ctrl.enable = 1
+        # the attribute is still the offset of the register in the buffer
+        self.assertEqual(ctrl.offset, 4)
+        self.assertEqual(ctrl['offset'], 5)
+        self.assertEqual(ctrl.raw, 0x51)
+        self.assertEqual(dict(ctrl.fields()), {'offset': 5, 'enable': 1})
+        ctrl.update(offset=2)
+        self.assertEqual(ctrl.raw, 0x21)
+
+    def test_all_view_attributes_as_fields(self):
+        registers = load_registers({
+            'REG': {'address': '0x0', 'def': 'name:0 address:1 offset:2 raw:3 fields:4 update:5'},
+        })
+        reg = regdef.RegisterBank(registers, bytearray(4)).REG
+        for i, name in enumerate(['name', 'address', 'offset', 'raw', 'fields', 'update']):
+            reg[name] = 1
+            self.assertEqual(reg.raw, 2 ** (i + 1) - 1)
+        self.assertEqual(reg.name, 'REG')
+        self.assertEqual(reg.address, 0)
+        with self.assertRaises(KeyError):
+            reg['missing']
+
+    def test_view_classes_are_not_kept(self):
+        registers = load_registers({'REG': {'address': '0x0', 'def': 'view_classes_test:3:0'}})
+        bank = regdef.RegisterBank(registers, bytearray(4))
+        layout = weakref.ref(registers[0]['reg'].layout)
+        self.assertIn(layout(), regdef.RegisterBank._view_classes)
+        view_class = weakref.ref(type(bank.REG))
+        self.assertIs(regdef.RegisterBank.view_class(registers[0]['reg']), view_class())
+        del bank, registers
+        gc.collect()
+        self.assertIsNone(layout())
+        self.assertIsNone(view_class())
+
+
+class CancellingTransport:
+    """Transport whose transactions are cancelled (raise CancelledError or never finish)."""
+
+    def __init__(self, hang=False):
+        self.hang = hang
+
+    async def transact(self, ops):
+        if self.hang:
+            await asyncio.Event().wait()
+        raise asyncio.CancelledError()
+
+
+class RegisterDeviceTest(unittest.TestCase):
+
+    def test_read_write(self):
+        async def main():
+            dev = regdef.RegisterDevice([], regdef.LoopbackTransport())
+            await dev.write_raw(0x10, 5)
+            return await asyncio.gather(dev.read_raw(0x10), dev.read_raw(0x11))
+        self.assertEqual(asyncio.run(main()), [5, 0])
+
+    def test_transport_cancelled(self):
+        async def main():
+            dev = regdef.RegisterDevice([], CancellingTransport())
+            reads = [asyncio.ensure_future(dev.read_raw(address)) for address in range(3)]
+            await asyncio.wait_for(asyncio.gather(*reads, return_exceptions=True), 1)
+            return [read.cancelled() for read in reads]
+        self.assertEqual(asyncio.run(main()), [True] * 3)
+
+    def test_transaction_task_cancelled(self):
+        async def main(n_steps):
+            transport = CancellingTransport(hang=True)
+            dev = regdef.RegisterDevice([], transport)
+            read = asyncio.ensure_future(dev.read_raw(0x1))
+            while not dev._in_flight:
+                await asyncio.sleep(0)
+            for _ in range(n_steps):  # cancelled before the transaction starts or in the transport
+                await asyncio.sleep(0)
+            for task in dev._in_flight:
+                task.cancel()
+            await asyncio.wait_for(asyncio.gather(read, return_exceptions=True), 1)
+            # the device is still usable
+            dev.transport = regdef.LoopbackTransport()
+            return read.cancelled(), await asyncio.wait_for(dev.read_raw(0x1), 1)
+        for n_steps in [0, 3]:
+            self.assertEqual(asyncio.run(main(n_steps)), (True, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 #include "unity.h"
 #include "tmc5041_regdef.h"
+#include "wide_regdef.gen.h"
 
 void test_GCONF_address(void)
 {
@@ -100,6 +101,225 @@ void test_datasheet_examples(void)
     TEST_ASSERT_EQUAL_HEX32(TMC5041_RAMPMODE_RAW(  TMC5041_RAMPMODE_FROM_RAW  (0x00000001u)), TMC5041_RAMPMODE_RAW(rampmode));
 }
 
+void test_dispatch_lookup(void)
+{
+    const TMC5041_reg_info *info = TMC5041_reg_lookup(0x50);
+    TEST_ASSERT_NOT_NULL(info);
+    TEST_ASSERT_EQUAL_INT(TMC5041_IHOLD_IRUN_INDEX, info->index);
+    TEST_ASSERT_EQUAL_INT(1, info->instance);
+    TEST_ASSERT_EQUAL_INT(TMC5041_IHOLD_IRUN_N_BITS, info->n_bits);
+    TEST_ASSERT_EQUAL_HEX32(0x000f1f1fu, info->valid_mask);
+    TEST_ASSERT_EQUAL_HEX32(0x0000e0e0u, info->reserved_mask);
+    TEST_ASSERT_EQUAL_STRING("IHOLD_IRUN", info->name);
+
+    info = TMC5041_reg_lookup(TMC5041_GCONF_ADDRESS);
+    TEST_ASSERT_NOT_NULL(info);
+    TEST_ASSERT_EQUAL_INT(TMC5041_GCONF_INDEX, info->index);
+    TEST_ASSERT_EQUAL_INT(0, info->instance);
+
+    TEST_ASSERT_NULL(TMC5041_reg_lookup(0x02));
+    TEST_ASSERT_NULL(TMC5041_reg_lookup(0xff));
+}
+
+
+typedef struct fake_bus {
+    int n_writes;
+    uint8_t write_address[8];
+    size_t write_count[8];
+    TMC5041_shadow_word write_values[8][TMC5041_SHADOW_MAX_BURST];
+    int n_reads;
+    TMC5041_shadow_word read_value;
+} fake_bus;
+
+static int fake_write(void *ctx, uint8_t address, const TMC5041_shadow_word *values, size_t count)
+{
+    fake_bus *bus = (fake_bus *) ctx;
+    bus->write_address[bus->n_writes] = address;
+    bus->write_count[bus->n_writes] = count;
+    for (size_t i = 0; i < count; i++)
+        bus->write_values[bus->n_writes][i] = values[i];
+    bus->n_writes++;
+    return 0;
+}
+
+static int fake_read(void *ctx, uint8_t address, TMC5041_shadow_word *values, size_t count)
+{
+    fake_bus *bus = (fake_bus *) ctx;
+    (void) address;
+    for (size_t i = 0; i < count; i++)
+        values[i] = bus->read_value;
+    bus->n_reads++;
+    return 0;
+}
+
+void test_shadow_flush_bursts(void)
+{
+    fake_bus bus = {0};
+    TMC5041_shadow_transport transport = { fake_write, fake_read, &bus };
+    TMC5041_shadow shadow;
+    TMC5041_shadow_init(&shadow, &transport);
+
+    TMC5041_shadow_set_GCONF(&shadow, (TMC5041_GCONF) { .shaft1 = 1 });
+    TMC5041_shadow_set_GSTAT(&shadow, (TMC5041_GSTAT) { .reset = 1 });
+    TMC5041_shadow_set_IHOLD_IRUN(&shadow, 1, (TMC5041_IHOLD_IRUN) { .irun = 31 });
+    TMC5041_shadow_set_VCOOLTHRS_raw(&shadow, 1, 0x1234);
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_flush(&shadow));
+
+    TEST_ASSERT_EQUAL_INT(2, bus.n_writes);
+    TEST_ASSERT_EQUAL_HEX8(0x00, bus.write_address[0]);
+    TEST_ASSERT_EQUAL_INT(2, bus.write_count[0]);
+    TEST_ASSERT_EQUAL_HEX32(1 << 8, bus.write_values[0][0]);
+    TEST_ASSERT_EQUAL_HEX32(1, bus.write_values[0][1]);
+    TEST_ASSERT_EQUAL_HEX8(0x50, bus.write_address[1]);
+    TEST_ASSERT_EQUAL_INT(2, bus.write_count[1]);
+    TEST_ASSERT_EQUAL_HEX32(31 << 8, bus.write_values[1][0]);
+    TEST_ASSERT_EQUAL_HEX32(0x1234, bus.write_values[1][1]);
+
+    // nothing changed, nothing to write
+    TMC5041_shadow_set_GCONF(&shadow, (TMC5041_GCONF) { .shaft1 = 1 });
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_flush(&shadow));
+    TEST_ASSERT_EQUAL_INT(2, bus.n_writes);
+
+    TMC5041_shadow_set_GCONF(&shadow, (TMC5041_GCONF) { .shaft2 = 1 });
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_flush(&shadow));
+    TEST_ASSERT_EQUAL_INT(3, bus.n_writes);
+    TEST_ASSERT_EQUAL_INT(1, bus.write_count[2]);
+    TEST_ASSERT_EQUAL_HEX32(1 << 9, bus.write_values[2][0]);
+}
+
+void test_shadow_read_cache(void)
+{
+    fake_bus bus = {0};
+    TMC5041_shadow_transport transport = { fake_write, fake_read, &bus };
+    TMC5041_shadow shadow;
+    TMC5041_shadow_init(&shadow, &transport);
+    TMC5041_GCONF gconf;
+    TMC5041_GSTAT gstat;
+
+    // GCONF has "cache_reads", so it is read from the bus only once
+    bus.read_value = 1 << 10;
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_read_GCONF(&shadow, &gconf));
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_read_GCONF(&shadow, &gconf));
+    TEST_ASSERT_EQUAL_INT(1, bus.n_reads);
+    TEST_ASSERT_EQUAL_INT(1, gconf.lock_gconf);
+
+    TMC5041_shadow_invalidate(&shadow);
+    bus.read_value = 1 << 9;
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_read_GCONF(&shadow, &gconf));
+    TEST_ASSERT_EQUAL_INT(2, bus.n_reads);
+    TEST_ASSERT_EQUAL_INT(1, gconf.shaft2);
+
+    // GSTAT is always read from the bus
+    bus.read_value = 0x3;
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_read_GSTAT(&shadow, &gstat));
+    TEST_ASSERT_EQUAL_INT(0, TMC5041_shadow_read_GSTAT(&shadow, &gstat));
+    TEST_ASSERT_EQUAL_INT(4, bus.n_reads);
+    TEST_ASSERT_EQUAL_INT(1, gstat.drv_err1);
+}
+
+// registers packed straight into SPI frame: 1 address byte and 4 bytes of value, big endian
+void test_frame_pack(void)
+{
+    uint8_t frame[3 * TMC5041_FRAME_RECORD_BYTES];
+    uint8_t *ptr = frame;
+    ptr = TMC5041_frame_pack_IHOLD_IRUN(ptr, 1, (TMC5041_IHOLD_IRUN) { .ihold = 5, .irun = 31, .iholddelay = 1 });
+    ptr = TMC5041_frame_pack_VMAX_raw(ptr, 0, 20000);
+    TEST_ASSERT_EQUAL_INT(10, ptr - frame);
+    const uint8_t expected[10] = { 0x50, 0x00, 0x01, 0x1f, 0x05, 0x27, 0x00, 0x00, 0x4e, 0x20 };
+    TEST_ASSERT_EQUAL_HEX8_ARRAY(expected, frame, 10);
+
+    // batch of writes as one contiguous frame
+    const TMC5041_frame_record writes[3] = { {0x50, 0x00011f05u}, {0x27, 20000}, {0x00, 0x8} };
+    TEST_ASSERT_EQUAL_INT(15, TMC5041_frame_pack_many(frame, writes, 3));
+    TEST_ASSERT_EQUAL_HEX8_ARRAY(expected, frame, 10);
+
+    TMC5041_frame_record records[4];
+    TEST_ASSERT_EQUAL_INT(3, TMC5041_frame_unpack_many(frame, sizeof(frame), records, 4));
+    TEST_ASSERT_EQUAL_HEX8(0x27, records[1].address);
+    TEST_ASSERT_EQUAL_HEX32(20000, records[1].value);
+    TEST_ASSERT_EQUAL_HEX8(0x00, records[2].address);
+    TEST_ASSERT_EQUAL_HEX32(0x8, records[2].value);
+}
+
+// fields modified directly in raw value, without conversion to struct and back
+void test_field_helpers(void)
+{
+    uint32_t raw = 0x00011f05u;
+    TEST_ASSERT_EQUAL_HEX32(31, TMC5041_IHOLD_IRUN_IRUN_GET(raw));
+    TEST_ASSERT_EQUAL_HEX32(0x00010f05u, TMC5041_IHOLD_IRUN_IRUN_UPDATE(raw, 15));
+    // values are truncated to field width
+    TEST_ASSERT_EQUAL_HEX32(0x00011005u, TMC5041_IHOLD_IRUN_IRUN_UPDATE(raw, 0x30));
+    TMC5041_IHOLD_IRUN_IHOLD_SET(raw, 10);
+    TEST_ASSERT_EQUAL_HEX32(0x00011f0au, raw);
+
+    // many fields in a single masked write
+    raw = TMC5041_IHOLD_IRUN_UPDATE(raw,
+        TMC5041_IHOLD_IRUN_IHOLD_FMASK | TMC5041_IHOLD_IRUN_IHOLDDELAY_FMASK,
+        TMC5041_IHOLD_IRUN_IHOLD_BITS(3) | TMC5041_IHOLD_IRUN_IHOLDDELAY_BITS(7));
+    TEST_ASSERT_EQUAL_HEX32(0x00071f03u, raw);
+    TMC5041_IHOLD_IRUN reg = TMC5041_IHOLD_IRUN_FROM_RAW(raw);
+    TEST_ASSERT_EQUAL_INT(3, reg.ihold);
+    TEST_ASSERT_EQUAL_INT(31, reg.irun);
+    TEST_ASSERT_EQUAL_INT(7, reg.iholddelay);
+}
+
+// registers wider than 32 bits are arrays of 32-bit words (least significant first)
+void test_wide_from_raw(void)
+{
+    const uint32_t raw[3] = { 0xab00c351u, 0x12345678u, 0x80000123u };
+    WIDE_DESCRIPTOR desc = WIDE_DESCRIPTOR_FROM_RAW(raw);
+    TEST_ASSERT_EQUAL_INT(3, WIDE_DESCRIPTOR_N_WORDS);
+    TEST_ASSERT_EQUAL_INT(1, desc.valid);
+    TEST_ASSERT_EQUAL_HEX32(0xc35, desc.length);
+    TEST_ASSERT_EQUAL_HEX32(0x00, desc.flags);
+    // crosses word boundary: 8 bits from word 0 and 32 bits from word 1
+    TEST_ASSERT_TRUE(desc.buffer == 0x12345678abull);
+    TEST_ASSERT_EQUAL_HEX32(0x123, desc.next);
+    TEST_ASSERT_EQUAL_INT(1, desc.last);
+
+    uint32_t out[3];
+    WIDE_DESCRIPTOR_RAW(desc, out);
+    // reserved bits are not kept
+    TEST_ASSERT_EQUAL_HEX32(0xab00c351u, out[0]);
+    TEST_ASSERT_EQUAL_HEX32(0x12345678u, out[1]);
+    TEST_ASSERT_EQUAL_HEX32(0x80000123u, out[2]);
+}
+
+void test_wide_to_raw(void)
+{
+    WIDE_TIMESTAMP ts = { .ticks = 0xfe12345678ull };
+    TEST_ASSERT_EQUAL_HEX32(0x12345678u, WIDE_TIMESTAMP_RAW_0(ts));
+    TEST_ASSERT_EQUAL_HEX32(0xfeu, WIDE_TIMESTAMP_RAW_1(ts));
+
+    WIDE_KEY key = { .key = { 0x03020100u, 0x07060504u, 0x0b0a0908u, 0x0f0e0d0cu }, .slot = 9 };
+    uint32_t raw[WIDE_KEY_N_WORDS];
+    WIDE_KEY_RAW(key, raw);
+    TEST_ASSERT_EQUAL_HEX32(0x03020100u, raw[0]);
+    TEST_ASSERT_EQUAL_HEX32(0x0f0e0d0cu, raw[3]);
+    TEST_ASSERT_EQUAL_HEX32(9, raw[4]);
+    WIDE_KEY back = WIDE_KEY_FROM_RAW(raw);
+    TEST_ASSERT_EQUAL_HEX32(0x07060504u, back.key[1]);
+    TEST_ASSERT_EQUAL_INT(9, back.slot);
+}
+
+// with --dedup registers with the same fields reuse the struct of the first one
+void test_wide_dedup_alias(void)
+{
+    TEST_ASSERT_EQUAL_HEX8(0x40u, WIDE_TX_DESCRIPTOR_ADDRESS);
+    TEST_ASSERT_EQUAL_INT(WIDE_DESCRIPTOR_N_WORDS, WIDE_TX_DESCRIPTOR_N_WORDS);
+    const uint32_t raw[3] = { 0xab00c351u, 0x12345678u, 0x80000123u };
+    WIDE_TX_DESCRIPTOR tx = WIDE_TX_DESCRIPTOR_FROM_RAW(raw);
+    WIDE_DESCRIPTOR *desc = &tx;
+    TEST_ASSERT_EQUAL_HEX32(0xc35, desc->length);
+    uint32_t out[3];
+    WIDE_TX_DESCRIPTOR_RAW(tx, out);
+    TEST_ASSERT_EQUAL_HEX32(0x80000123u, out[2]);
+
+    WIDE_NEXT_KEY key = { .key = { 1, 2, 3, 4 }, .slot = 5 };
+    TEST_ASSERT_EQUAL_HEX8(0x50u, WIDE_NEXT_KEY_ADDRESS);
+    TEST_ASSERT_EQUAL_HEX32(5, WIDE_NEXT_KEY_RAW_4(key));
+}
+
 
 int main(void)
 {
@@ -111,6 +331,14 @@ int main(void)
     RUN_TEST(test_GSTAT_from_raw);
     RUN_TEST(test_GSTAT_to_raw);
     RUN_TEST(test_datasheet_examples);
+    RUN_TEST(test_dispatch_lookup);
+    RUN_TEST(test_shadow_flush_bursts);
+    RUN_TEST(test_shadow_read_cache);
+    RUN_TEST(test_frame_pack);
+    RUN_TEST(test_field_helpers);
+    RUN_TEST(test_wide_from_raw);
+    RUN_TEST(test_wide_to_raw);
+    RUN_TEST(test_wide_dedup_alias);
     return UNITY_END();
 }
 
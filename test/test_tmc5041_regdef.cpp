@@ -1,6 +1,10 @@
 #include "unity.h"
 #include "tmc5041_regdef.hpp"
 
+namespace wide {
+#include "wide_regdef.gen.hpp"
+}
+
 void test_GCONF_address()
 {
     TEST_ASSERT_EQUAL_HEX8(0x00u, tmc5041::GCONF::address);
@@ -102,6 +106,235 @@ void test_datasheet_examples()
     TEST_ASSERT_EQUAL_HEX32(RAMPMODE  ::from_raw(0x00000001u).raw(), rampmode.raw());
 }
 
+void test_dispatch_lookup()
+{
+    using namespace tmc5041;
+    const reg_info *info = reg_lookup(0x50);
+    TEST_ASSERT_NOT_NULL(info);
+    TEST_ASSERT_EQUAL_INT(IHOLD_IRUN_INDEX, info->index);
+    TEST_ASSERT_EQUAL_INT(1, info->instance);
+    TEST_ASSERT_EQUAL_INT(IHOLD_IRUN::n_bits, info->n_bits);
+    TEST_ASSERT_EQUAL_HEX32(0x000f1f1fu, info->valid_mask);
+    TEST_ASSERT_EQUAL_HEX32(0x0000e0e0u, info->reserved_mask);
+    TEST_ASSERT_EQUAL_STRING("IHOLD_IRUN", info->name);
+
+    info = reg_lookup(GCONF::address);
+    TEST_ASSERT_NOT_NULL(info);
+    TEST_ASSERT_EQUAL_INT(GCONF_INDEX, info->index);
+    TEST_ASSERT_EQUAL_INT(0, info->instance);
+
+    TEST_ASSERT_NULL(reg_lookup(0x02));
+    TEST_ASSERT_NULL(reg_lookup(0xff));
+}
+
+
+struct fake_bus {
+    int n_writes = 0;
+    uint8_t write_address[8];
+    size_t write_count[8];
+    tmc5041::shadow_word write_values[8][tmc5041::SHADOW_MAX_BURST];
+    int n_reads = 0;
+    tmc5041::shadow_word read_value = 0;
+};
+
+static int fake_write(void *ctx, uint8_t address, const tmc5041::shadow_word *values, size_t count)
+{
+    fake_bus *bus = static_cast<fake_bus *>(ctx);
+    bus->write_address[bus->n_writes] = address;
+    bus->write_count[bus->n_writes] = count;
+    for (size_t i = 0; i < count; i++)
+        bus->write_values[bus->n_writes][i] = values[i];
+    bus->n_writes++;
+    return 0;
+}
+
+static int fake_read(void *ctx, uint8_t, tmc5041::shadow_word *values, size_t count)
+{
+    fake_bus *bus = static_cast<fake_bus *>(ctx);
+    for (size_t i = 0; i < count; i++)
+        values[i] = bus->read_value;
+    bus->n_reads++;
+    return 0;
+}
+
+void test_shadow_flush_bursts()
+{
+    using namespace tmc5041;
+    fake_bus bus;
+    shadow_transport transport = { fake_write, fake_read, &bus };
+    shadow s;
+    shadow_init(&s, &transport);
+
+    shadow_set_GCONF(&s, GCONF{ .shaft1 = 1 });
+    shadow_set_GSTAT(&s, GSTAT{ .reset = 1 });
+    shadow_set_IHOLD_IRUN(&s, 1, IHOLD_IRUN{ .irun = 31 });
+    shadow_set_VCOOLTHRS_raw(&s, 1, 0x1234);
+    TEST_ASSERT_EQUAL_INT(0, shadow_flush(&s));
+
+    TEST_ASSERT_EQUAL_INT(2, bus.n_writes);
+    TEST_ASSERT_EQUAL_HEX8(0x00, bus.write_address[0]);
+    TEST_ASSERT_EQUAL_INT(2, bus.write_count[0]);
+    TEST_ASSERT_EQUAL_HEX32(1 << 8, bus.write_values[0][0]);
+    TEST_ASSERT_EQUAL_HEX32(1, bus.write_values[0][1]);
+    TEST_ASSERT_EQUAL_HEX8(0x50, bus.write_address[1]);
+    TEST_ASSERT_EQUAL_INT(2, bus.write_count[1]);
+    TEST_ASSERT_EQUAL_HEX32(31 << 8, bus.write_values[1][0]);
+    TEST_ASSERT_EQUAL_HEX32(0x1234, bus.write_values[1][1]);
+
+    // nothing changed, nothing to write
+    shadow_set_GCONF(&s, GCONF{ .shaft1 = 1 });
+    TEST_ASSERT_EQUAL_INT(0, shadow_flush(&s));
+    TEST_ASSERT_EQUAL_INT(2, bus.n_writes);
+
+    shadow_set_GCONF(&s, GCONF{ .shaft2 = 1 });
+    TEST_ASSERT_EQUAL_INT(0, shadow_flush(&s));
+    TEST_ASSERT_EQUAL_INT(3, bus.n_writes);
+    TEST_ASSERT_EQUAL_INT(1, bus.write_count[2]);
+    TEST_ASSERT_EQUAL_HEX32(1 << 9, bus.write_values[2][0]);
+}
+
+void test_shadow_read_cache()
+{
+    using namespace tmc5041;
+    fake_bus bus;
+    shadow_transport transport = { fake_write, fake_read, &bus };
+    shadow s;
+    shadow_init(&s, &transport);
+    GCONF gconf;
+    GSTAT gstat;
+
+    // GCONF has "cache_reads", so it is read from the bus only once
+    bus.read_value = 1 << 10;
+    TEST_ASSERT_EQUAL_INT(0, shadow_read_GCONF(&s, &gconf));
+    TEST_ASSERT_EQUAL_INT(0, shadow_read_GCONF(&s, &gconf));
+    TEST_ASSERT_EQUAL_INT(1, bus.n_reads);
+    TEST_ASSERT_EQUAL_INT(1, gconf.lock_gconf);
+
+    shadow_invalidate(&s);
+    bus.read_value = 1 << 9;
+    TEST_ASSERT_EQUAL_INT(0, shadow_read_GCONF(&s, &gconf));
+    TEST_ASSERT_EQUAL_INT(2, bus.n_reads);
+    TEST_ASSERT_EQUAL_INT(1, gconf.shaft2);
+
+    // GSTAT is always read from the bus
+    bus.read_value = 0x3;
+    TEST_ASSERT_EQUAL_INT(0, shadow_read_GSTAT(&s, &gstat));
+    TEST_ASSERT_EQUAL_INT(0, shadow_read_GSTAT(&s, &gstat));
+    TEST_ASSERT_EQUAL_INT(4, bus.n_reads);
+    TEST_ASSERT_EQUAL_INT(1, gstat.drv_err1);
+}
+
+// registers packed straight into SPI frame: 1 address byte and 4 bytes of value, big endian
+void test_frame_pack()
+{
+    using namespace tmc5041;
+    uint8_t frame[3 * FRAME_RECORD_BYTES];
+    uint8_t *ptr = frame;
+    ptr = frame_pack_IHOLD_IRUN(ptr, 1, { .ihold = 5, .irun = 31, .iholddelay = 1 });
+    ptr = frame_pack_VMAX_raw(ptr, 0, 20000);
+    TEST_ASSERT_EQUAL_INT(10, ptr - frame);
+    const uint8_t expected[10] = { 0x50, 0x00, 0x01, 0x1f, 0x05, 0x27, 0x00, 0x00, 0x4e, 0x20 };
+    TEST_ASSERT_EQUAL_HEX8_ARRAY(expected, frame, 10);
+
+    // batch of writes as one contiguous frame
+    const frame_record writes[3] = { {0x50, 0x00011f05u}, {0x27, 20000}, {0x00, 0x8} };
+    TEST_ASSERT_EQUAL_INT(15, frame_pack_many(frame, writes, 3));
+    TEST_ASSERT_EQUAL_HEX8_ARRAY(expected, frame, 10);
+
+    frame_record records[4];
+    TEST_ASSERT_EQUAL_INT(3, frame_unpack_many(frame, sizeof(frame), records, 4));
+    TEST_ASSERT_EQUAL_HEX8(0x27, records[1].address);
+    TEST_ASSERT_EQUAL_HEX32(20000, records[1].value);
+    TEST_ASSERT_EQUAL_HEX8(0x00, records[2].address);
+    TEST_ASSERT_EQUAL_HEX32(0x8, records[2].value);
+}
+
+// fields modified directly in raw value, without conversion to struct and back
+void test_field_helpers()
+{
+    using namespace tmc5041;
+    uint32_t raw = 0x00011f05u;
+    TEST_ASSERT_EQUAL_HEX32(31, IHOLD_IRUN::get_irun(raw));
+    TEST_ASSERT_EQUAL_HEX32(0x00010f05u, IHOLD_IRUN::update_irun(raw, 15));
+    // values are truncated to field width
+    TEST_ASSERT_EQUAL_HEX32(0x00011005u, IHOLD_IRUN::update_irun(raw, 0x30));
+    IHOLD_IRUN::set_ihold(raw, 10);
+    TEST_ASSERT_EQUAL_HEX32(0x00011f0au, raw);
+
+    // many fields in a single masked write, all constant masks
+    static_assert(IHOLD_IRUN::update_raw(0, IHOLD_IRUN::mask_irun, IHOLD_IRUN::bits_irun(31)) == 0x1f00u, "");
+    raw = IHOLD_IRUN::update_raw(raw,
+        IHOLD_IRUN::mask_ihold | IHOLD_IRUN::mask_iholddelay,
+        IHOLD_IRUN::bits_ihold(3) | IHOLD_IRUN::bits_iholddelay(7));
+    TEST_ASSERT_EQUAL_HEX32(0x00071f03u, raw);
+    IHOLD_IRUN reg = IHOLD_IRUN::from_raw(raw);
+    TEST_ASSERT_EQUAL_INT(3, reg.ihold);
+    TEST_ASSERT_EQUAL_INT(31, reg.irun);
+    TEST_ASSERT_EQUAL_INT(7, reg.iholddelay);
+}
+
+// registers wider than 32 bits are arrays of 32-bit words (least significant first)
+void test_wide_from_raw()
+{
+    using namespace wide;
+    const uint32_t raw[3] = { 0xab00c351u, 0x12345678u, 0x80000123u };
+    DESCRIPTOR desc = DESCRIPTOR::from_raw(raw);
+    TEST_ASSERT_EQUAL_INT(3, DESCRIPTOR::n_words);
+    TEST_ASSERT_EQUAL_INT(1, desc.valid);
+    TEST_ASSERT_EQUAL_HEX32(0xc35, desc.length);
+    TEST_ASSERT_EQUAL_HEX32(0x00, desc.flags);
+    // crosses word boundary: 8 bits from word 0 and 32 bits from word 1
+    TEST_ASSERT_TRUE(desc.buffer == 0x12345678abull);
+    TEST_ASSERT_EQUAL_HEX32(0x123, desc.next);
+    TEST_ASSERT_EQUAL_INT(1, desc.last);
+
+    uint32_t out[3];
+    desc.raw(out);
+    TEST_ASSERT_EQUAL_HEX32(0xab00c351u, out[0]);
+    TEST_ASSERT_EQUAL_HEX32(0x12345678u, out[1]);
+    TEST_ASSERT_EQUAL_HEX32(0x80000123u, out[2]);
+}
+
+void test_wide_to_raw()
+{
+    using namespace wide;
+    TIMESTAMP ts = { .ticks = 0xfe12345678ull };
+    TEST_ASSERT_EQUAL_HEX32(0x12345678u, ts.raw_0());
+    TEST_ASSERT_EQUAL_HEX32(0xfeu, ts.raw_1());
+
+    KEY key = { .key = { 0x03020100u, 0x07060504u, 0x0b0a0908u, 0x0f0e0d0cu }, .slot = 9 };
+    uint32_t raw[KEY::n_words];
+    key.raw(raw);
+    TEST_ASSERT_EQUAL_HEX32(0x03020100u, raw[0]);
+    TEST_ASSERT_EQUAL_HEX32(0x0f0e0d0cu, raw[3]);
+    TEST_ASSERT_EQUAL_HEX32(9, raw[4]);
+    KEY back = KEY::from_raw(raw);
+    TEST_ASSERT_EQUAL_HEX32(0x07060504u, back.key[1]);
+    TEST_ASSERT_EQUAL_INT(9, back.slot);
+}
+
+// with --dedup registers with the same fields derive from the first one
+void test_wide_dedup_alias()
+{
+    using namespace wide;
+    TEST_ASSERT_EQUAL_HEX8(0x40u, TX_DESCRIPTOR::address);
+    TEST_ASSERT_EQUAL_HEX8(0x20u, DESCRIPTOR::address[0]);
+    TEST_ASSERT_EQUAL_INT(DESCRIPTOR::n_words, TX_DESCRIPTOR::n_words);
+    const uint32_t raw[3] = { 0xab00c351u, 0x12345678u, 0x80000123u };
+    TX_DESCRIPTOR tx = TX_DESCRIPTOR::from_raw(raw);
+    const DESCRIPTOR &desc = tx;
+    TEST_ASSERT_EQUAL_HEX32(0xc35, desc.length);
+    uint32_t out[3];
+    tx.raw(out);
+    TEST_ASSERT_EQUAL_HEX32(0x80000123u, out[2]);
+
+    const uint32_t key_raw[NEXT_KEY::n_words] = { 1, 2, 3, 4, 5 };
+    NEXT_KEY key = NEXT_KEY::from_raw(key_raw);
+    TEST_ASSERT_EQUAL_HEX8(0x50u, NEXT_KEY::address);
+    TEST_ASSERT_EQUAL_HEX32(2, key.key[1]);
+    TEST_ASSERT_EQUAL_INT(5, key.slot);
+}
+
 
 int main(void)
 {
@@ -113,5 +346,13 @@ int main(void)
     RUN_TEST(test_GSTAT_from_raw);
     RUN_TEST(test_GSTAT_to_raw);
     RUN_TEST(test_datasheet_examples);
+    RUN_TEST(test_dispatch_lookup);
+    RUN_TEST(test_shadow_flush_bursts);
+    RUN_TEST(test_shadow_read_cache);
+    RUN_TEST(test_frame_pack);
+    RUN_TEST(test_field_helpers);
+    RUN_TEST(test_wide_from_raw);
+    RUN_TEST(test_wide_to_raw);
+    RUN_TEST(test_wide_dedup_alias);
     return UNITY_END();
 }